@@ -0,0 +1,98 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the masked LM predictions of `create_pretraining_data.py`, the
+per-instance `create_masked_lm_predictions` against the vectorized
+`create_masked_lm_predictions_batch`, on synthetic instances.
+
+Example:
+    python3 bert_data/benchmark_masking.py --num-instances 100000 --sequence-length 128
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+import create_pretraining_data
+from create_pretraining_data import create_masked_lm_predictions, create_masked_lm_predictions_batch
+
+
+def timed(name, num_instances, fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    elapsed = time.time() - start
+    print(f"{name:<12} {elapsed:10.2f} s {num_instances / elapsed:12.0f} instances/s")
+    return result, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-instances', default=100000, type=int,
+                        help='number of synthetic instances')
+    parser.add_argument('--sequence-length', default=128, type=int)
+    parser.add_argument('--mask-tokens', default=20, type=int)
+    parser.add_argument('--mlm-prob', default=0.15, type=float)
+    parser.add_argument('--vocab-size', default=30522, type=int)
+    parser.add_argument('--batch-size', default=4096, type=int,
+                        help='number of instances masked at once by the vectorized path')
+    parser.add_argument('--do-whole-word-mask', action='store_true')
+    parser.add_argument('--seed', type=int, default=1984, help='random seed')
+    args = parser.parse_args()
+    # create_masked_lm_predictions reads the options of the script from the global `args`
+    create_pretraining_data.args = args
+
+    # Ids 0-4 are [PAD], [UNK], [CLS], [SEP], [MASK], every third word is a subword
+    cls_id, sep_id, mask_id = 2, 3, 4
+    vocab_words = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + \
+        [f"##w{i}" if i % 3 == 0 else f"w{i}" for i in range(5, args.vocab_size)]
+    is_subword = np.array([word.startswith("##") for word in vocab_words])
+
+    np_rng = np.random.default_rng(args.seed)
+    input_ids = np.zeros((args.num_instances, args.sequence_length), dtype=np.int64)
+    lengths = np_rng.integers(args.sequence_length // 2, args.sequence_length + 1, args.num_instances)
+    for i, length in enumerate(lengths):
+        input_ids[i, :length] = np_rng.integers(5, args.vocab_size, length)
+        separator = np_rng.integers(2, length - 2)
+        input_ids[i, [0, separator, length - 1]] = [cls_id, sep_id, sep_id]
+    instances = [[vocab_words[token] for token in ids[:length]] for ids, length in zip(input_ids, lengths)]
+    candidates = (input_ids != 0) & (input_ids != cls_id) & (input_ids != sep_id)
+    word_starts = candidates & ~is_subword[input_ids] if args.do_whole_word_mask else candidates
+    print(f"{args.num_instances} instances of {lengths.mean():.1f} tokens on average")
+
+    def per_instance():
+        rng = random.Random(args.seed)
+        return [create_masked_lm_predictions(tokens, args.mlm_prob, args.mask_tokens, vocab_words,
+                                             rng, args.sequence_length) for tokens in instances]
+
+    def vectorized():
+        rng = np.random.default_rng(args.seed)
+        results = []
+        for start in range(0, args.num_instances, args.batch_size):
+            rows = slice(start, start + args.batch_size)
+            results.append(create_masked_lm_predictions_batch(
+                input_ids[rows], candidates[rows], word_starts[rows], args.mlm_prob, args.mask_tokens,
+                args.sequence_length, mask_id, args.vocab_size, rng))
+        return results
+
+    reference, reference_time = timed("python", args.num_instances, per_instance)
+    batches, vectorized_time = timed("vectorized", args.num_instances, vectorized)
+    print(f"Speedup: {reference_time / vectorized_time:.1f}x")
+
+    # Both paths mask the same number of tokens of each instance
+    num_masked = np.concatenate([batch[3] for batch in batches])
+    reference_masked = np.array([len(positions) for _, positions, _ in reference])
+    assert np.array_equal(num_masked, reference_masked), "The number of masked tokens does not match"
+    print(f"Masked {num_masked.sum()} tokens with both paths.")
@@ -0,0 +1,163 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import numpy as np
+
+KEYS = ('masked_lm_ids', 'masked_lm_weights', 'segment_ids',
+        'input_ids', 'input_mask', 'next_sentence_labels',
+        'masked_lm_positions')
+
+
+def is_columnar_dataset(path):
+    return os.path.isfile(os.path.join(path, "columns.json"))
+
+
+def format_pretraining_batch(samples, max_seq_length, max_mask_tokens, pad_position_value=511):
+    """
+    Convert a batch of TFRecord features into the 7 arrays of the PopART BERT inputs,
+    with the masked tokens moved to the first `max_mask_tokens` positions.
+    See PretrainingTfRecordDataLoader for the description of the outputs.
+    """
+    batch_size, seq_len = samples['input_ids'].shape
+    formatted_pos = pad_position_value * np.ones_like(samples['input_ids'])
+    formatted_input = np.zeros_like(samples['input_ids'])
+    formatted_seg = np.zeros_like(samples['segment_ids'])
+    formatted_mask_labels = np.zeros((batch_size, max_mask_tokens),
+                                     dtype=samples['masked_lm_ids'].dtype)
+
+    valid_seq_positions = []
+    valid_mask_positions = samples['masked_lm_weights'] == 1
+    valid_mask_len = np.sum(valid_mask_positions, axis=1)
+    for i, mask_pos in enumerate(samples['masked_lm_positions']):
+        pos = [True] * seq_len
+        for mask_index, m in enumerate(mask_pos):
+            if mask_index < valid_mask_len[i]:
+                pos[m] = False
+        valid_seq_positions.append(np.logical_and(pos, samples['input_ids'][i] != 0))
+    valid_seq_len = np.minimum(np.sum(valid_seq_positions, axis=1) + max_mask_tokens,
+                               max_seq_length)
+    unmasked_len = np.minimum(np.sum(valid_seq_positions, axis=1),
+                              max_seq_length - max_mask_tokens)
+    for i in range(batch_size):
+        target_mask_indices = np.arange(valid_mask_len[i])
+        target_seq_indices = max_mask_tokens + np.arange(unmasked_len[i])
+        source_mask_indices = samples['masked_lm_positions'][i][valid_mask_positions[i]]
+        source_seq_indices = np.arange(seq_len)[valid_seq_positions[i]][:unmasked_len[i]]
+
+        target_indices = np.hstack([target_mask_indices, target_seq_indices])
+        source_indices = np.hstack([source_mask_indices, source_seq_indices])
+
+        formatted_pos[i, target_indices] = source_indices
+        formatted_input[i, target_indices] = samples['input_ids'][i, source_indices]
+        formatted_seg[i, target_indices] = samples['segment_ids'][i, source_indices]
+        formatted_mask_labels[i] = samples['masked_lm_ids'][i, :max_mask_tokens]
+
+    return [formatted_input, formatted_pos, formatted_seg,
+            valid_mask_len, valid_seq_len, formatted_mask_labels,
+            samples['next_sentence_labels']]
+
+
+class ColumnarDataLoader(object):
+    '''
+    Iterates a columnar dataset, written from TFRecord files by
+    bert_data/convert_to_columnar.py, into batches of the same
+    7 np.ndarrays as PretrainingTfRecordDataLoader.
+
+    Each feature is memory-mapped in its narrow storage dtype, so a batch is a
+    single gather of its rows from each column, without any decoding.
+
+    :param input_path: Folder of the columnar dataset
+    :param max_seq_length: Sequence length of the model
+    :param max_mask_tokens: Number of masked tokens of the model
+    :param batch_size: Number of samples to return each iteration
+    :param dtype: Numpy type of the returned arrays
+    :param shuffle: If True, iterate the samples in a different random order each epoch
+    :param duplication_factor:
+        The number of times each input file contains the same sample, as contiguous copies
+        of its samples. Each epoch only reads 1/duplication_factor of each file, the next copy.
+    :param start_data_at_epoch: Epoch of the first iteration, which selects its copy and order
+    :param popdist_size: Number of instances sharing the dataset
+    :param popdist_rank: Index of this instance, which reads every popdist_size-th sample
+    '''
+    def __init__(self,
+                 input_path,
+                 max_seq_length,
+                 max_mask_tokens,
+                 batch_size=1,
+                 dtype=np.int32,
+                 shuffle=True,
+                 seed=1984,
+                 pad_position_value=511,
+                 popdist_size=1,
+                 popdist_rank=0,
+                 duplication_factor=1,
+                 start_data_at_epoch=0):
+        with open(os.path.join(input_path, "columns.json")) as f:
+            metadata = json.load(f)
+        missing = [key for key in KEYS if key not in metadata["columns"]]
+        if missing:
+            raise RuntimeError(f"Columnar dataset {input_path} does not contain the features {missing}")
+        self.num_samples = metadata["num_samples"]
+        # Datasets without the per file counts were written as a single file
+        file_num_samples = np.array(metadata.get("file_num_samples", [self.num_samples]))
+        if file_num_samples.sum() != self.num_samples:
+            raise RuntimeError(f"Columnar dataset {input_path} file_num_samples do not add up to num_samples")
+        self.columns = {key: np.memmap(os.path.join(input_path, f"{key}.bin"),
+                                       dtype=metadata["columns"][key]["dtype"],
+                                       mode="r",
+                                       shape=(self.num_samples, metadata["columns"][key]["width"]))
+                        for key in KEYS}
+        self.max_seq_length = max_seq_length
+        self.max_mask_tokens = max_mask_tokens
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.shuffle = shuffle
+        self.pad_position_value = pad_position_value
+        self.popdist_size = popdist_size
+        self.popdist_rank = popdist_rank
+        self.seed = seed
+        self.duplication_factor = duplication_factor
+        self.epoch = start_data_at_epoch
+        self.file_starts = np.cumsum(file_num_samples) - file_num_samples
+        self.samples_per_copy = file_num_samples // duplication_factor
+        self.samples_per_epoch = int(self.samples_per_copy.sum())
+        self.len = self.samples_per_epoch // self.popdist_size // self.batch_size
+
+    def __len__(self):
+        return self.len
+
+    def epoch_indices(self, epoch):
+        """Indices of the samples of the copy of each file read in this epoch."""
+        copy = epoch % self.duplication_factor
+        return np.concatenate([start + copy * size + np.arange(size)
+                               for start, size in zip(self.file_starts, self.samples_per_copy)])
+
+    def __iter__(self):
+        indices = self.epoch_indices(self.epoch)
+        if self.shuffle:
+            # All instances draw the same permutation of the epoch and take a strided part of it
+            indices = np.random.default_rng([self.seed, self.epoch]).permutation(indices)
+        self.epoch += 1
+        indices = indices[self.popdist_rank::self.popdist_size]
+        self.batches = iter(indices[:self.len * self.batch_size].reshape(self.len, self.batch_size))
+        return self
+
+    def __next__(self):
+        # Sorting the indices of the batch makes the reads sequential
+        indices = np.sort(next(self.batches))
+        samples = {key: column[indices].astype(self.dtype) for key, column in self.columns.items()}
+        return format_pretraining_batch(samples, self.max_seq_length, self.max_mask_tokens, self.pad_position_value)
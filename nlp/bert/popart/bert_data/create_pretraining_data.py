@@ -31,27 +31,23 @@ from __future__ import division
 from __future__ import print_function
 
 import time
+import numpy as np
 from tqdm import tqdm
 import collections
 import random
 import argparse
 import glob
+import os
 import struct
 from itertools import chain, repeat
-from functools import reduce
 from concurrent.futures import ProcessPoolExecutor
 
 import tokenization
 
 def parallel_tokenizer(chunk, tokenizer):
   indices, lines = chunk
-  tokens = {}
-  for i, index in enumerate(indices):
-    line = tokenization.convert_to_unicode(lines[i])
-    line = line.strip()
-    t = tokenizer.tokenize(line)
-    tokens[index] = t
-  return tokens
+  lines = [tokenization.convert_to_unicode(line).strip() for line in lines]
+  return dict(zip(indices, tokenizer.tokenize_batch(lines)))
 
 
 class TrainingInstance(object):
@@ -82,8 +78,94 @@ class TrainingInstance(object):
     return self.__str__()
 
 
+def instance_to_features(instance, tokenizer, max_seq_length):
+  """Convert a `TrainingInstance` to padded lists of ids."""
+  input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
+  input_mask = [1] * len(input_ids)
+  segment_ids = list(instance.segment_ids)
+  assert len(input_ids) <= max_seq_length
+
+  while len(input_ids) < max_seq_length:
+    input_ids.append(0)
+    input_mask.append(0)
+    segment_ids.append(0)
+
+  assert len(input_ids) == max_seq_length
+  assert len(input_mask) == max_seq_length
+  assert len(segment_ids) == max_seq_length
+
+  masked_lm_positions = list(instance.masked_lm_positions)
+  masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
+  masked_lm_weights = [1] * len(masked_lm_ids)
+  next_sentence_label = 1 if instance.is_random_next else 0
+
+  features = collections.OrderedDict()
+  features["input_ids"] = input_ids
+  features["input_mask"] = input_mask
+  features["segment_ids"] = segment_ids
+  features["masked_lm_positions"] = masked_lm_positions
+  features["masked_lm_ids"] = masked_lm_ids
+  features["masked_lm_weights"] = masked_lm_weights
+  features["next_sentence_labels"] = [next_sentence_label]
+  return features
+
+
+def features_to_binary(features, max_seq_length, mask_tokens, pad_position_value):
+  """Pack the features of an instance into a binary sample, with the mask tokens at the start."""
+  input_ids = features["input_ids"]
+  segment_ids = features["segment_ids"]
+  masked_lm_positions = features["masked_lm_positions"]
+  masked_lm_ids = features["masked_lm_ids"]
+
+  # -----------------------------------------
+  # Main Change to original script. This handles the re-arranging of samples to put mask_tokens at the start.
+  formatted_input = [0] * max_seq_length
+  formatted_pos = [pad_position_value] * max_seq_length
+  formatted_seg = [0] * max_seq_length
+  formatted_label = [0] * mask_tokens
+  current_mask_idx = 0
+  current_seq_idx = mask_tokens
+  for idx, input_id in enumerate(input_ids):
+    if input_id == 0:
+      continue
+    try:
+      masked_lm_idx = masked_lm_positions.index(idx)
+      formatted_input[current_mask_idx] = input_id
+      formatted_pos[current_mask_idx] = idx
+      formatted_seg[current_mask_idx] = segment_ids[idx]
+      formatted_label[current_mask_idx] = masked_lm_ids[masked_lm_idx]
+      current_mask_idx += 1
+    except ValueError:
+      formatted_input[current_seq_idx] = input_id
+      formatted_pos[current_seq_idx] = idx
+      formatted_seg[current_seq_idx] = segment_ids[idx]
+      current_seq_idx += 1
+
+  mask_tokens_padding_idx = [current_mask_idx]
+  sequence_padding_idx = [current_seq_idx]
+  nsp_label = features["next_sentence_labels"]
+
+  # Pack into binary format
+  values = list(chain(formatted_input,
+                      formatted_pos,
+                      formatted_seg,
+                      mask_tokens_padding_idx,
+                      sequence_padding_idx,
+                      formatted_label,
+                      nsp_label))
+  return struct.pack(f'<{len(values)}I', *values)
+
+
+def instances_to_features(instances, tokenizer, max_seq_length, mask_tokens, args, np_rng=None):
+  """Yield the features of `instances`, masking them in batches if `np_rng` is given."""
+  if np_rng is not None:
+    return vectorized_instance_features(instances, tokenizer, max_seq_length, mask_tokens,
+                                        args.mlm_prob, args.do_whole_word_mask, np_rng)
+  return (instance_to_features(instance, tokenizer, max_seq_length) for instance in instances)
+
+
 def write_instance_to_example_files(instances, tokenizer, max_seq_length,
-                                    mask_tokens, output_files, args, max_samples=-1):
+                                    mask_tokens, output_files, args, max_samples=-1, np_rng=None):
   """Create Binary files from `TrainingInstance`s."""
   writers = []
   for output_file in output_files:
@@ -92,80 +174,18 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
   writer_index = 0
 
   total_written = 0
-  for (inst_index, instance) in enumerate(tqdm(instances)):
-    input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
-    input_mask = [1] * len(input_ids)
-    segment_ids = list(instance.segment_ids)
-    assert len(input_ids) <= max_seq_length
-
-    while len(input_ids) < max_seq_length:
-      input_ids.append(0)
-      input_mask.append(0)
-      segment_ids.append(0)
-
-    assert len(input_ids) == max_seq_length
-    assert len(input_mask) == max_seq_length
-    assert len(segment_ids) == max_seq_length
-
-    masked_lm_positions = list(instance.masked_lm_positions)
-    masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
-    masked_lm_weights = [1] * len(masked_lm_ids)
-    next_sentence_label = 1 if instance.is_random_next else 0
-
-    features = collections.OrderedDict()
-    features["input_ids"] = input_ids
-    features["input_mask"] = input_mask
-    features["segment_ids"] = segment_ids
-    features["masked_lm_positions"] = masked_lm_positions
-    features["masked_lm_ids"] = masked_lm_ids
-    features["masked_lm_weights"] = masked_lm_weights
-    features["next_sentence_labels"] = [next_sentence_label]
-
-    # -----------------------------------------
-    # Main Change to original script. This handles the re-arranging of samples to put mask_tokens at the start.
-    formatted_input = [0] * max_seq_length
-    formatted_pos = [args.pad_position_value] * max_seq_length
-    formatted_seg = [0] * max_seq_length
-    formatted_label = [0] * mask_tokens
-    current_mask_idx = 0
-    current_seq_idx = mask_tokens
-    for idx, input_id in enumerate(input_ids):
-      if input_id == 0:
-        continue
-      try:
-        masked_lm_idx = masked_lm_positions.index(idx)
-        formatted_input[current_mask_idx] = input_id
-        formatted_pos[current_mask_idx] = idx
-        formatted_seg[current_mask_idx] = segment_ids[idx]
-        formatted_label[current_mask_idx] = masked_lm_ids[masked_lm_idx]
-        current_mask_idx += 1
-      except ValueError:
-        formatted_input[current_seq_idx] = input_id
-        formatted_pos[current_seq_idx] = idx
-        formatted_seg[current_seq_idx] = segment_ids[idx]
-        current_seq_idx += 1
-
-    mask_tokens_padding_idx = [current_mask_idx]
-    sequence_padding_idx = [current_seq_idx]
-    nsp_label = [next_sentence_label]
-
-    # Pack into binary format
-    line = reduce(lambda accl, i: accl + struct.pack('<I', i),
-                  chain(formatted_input,
-                        formatted_pos,
-                        formatted_seg,
-                        mask_tokens_padding_idx,
-                        sequence_padding_idx,
-                        formatted_label,
-                        nsp_label), b'')
+  all_features = instances_to_features(instances, tokenizer, max_seq_length, mask_tokens, args, np_rng)
+  for (inst_index, (instance, features)) in enumerate(zip(tqdm(instances), all_features)):
+    line = features_to_binary(features, max_seq_length, mask_tokens, args.pad_position_value)
     writers[writer_index].write(line)
     writer_index = (writer_index + 1) % len(writers)
     total_written += 1
 
     if inst_index < 20:
       print("*** Example ***")
+      tokens = tokenizer.convert_ids_to_tokens(features["input_ids"][:len(instance.tokens)])
       print("tokens: %s" % " ".join(
-          [tokenization.printable_text(x) for x in instance.tokens]))
+          [tokenization.printable_text(x) for x in tokens]))
 
       for feature_name in features.keys():
         print(
@@ -182,7 +202,7 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
 
 def create_training_instances(input_files, tokenizer, max_seq_length,
                               dupe_factor, short_seq_prob, mlm_prob,
-                              mask_tokens, rng):
+                              mask_tokens, rng, mask_instances=True):
   """Create `TrainingInstance`s from raw text."""
   all_documents = [[]]
 
@@ -235,7 +255,7 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
       instances.extend(
           create_instances_from_document(
               all_documents, document_index, max_seq_length, short_seq_prob,
-              mlm_prob, mask_tokens, vocab_words, rng))
+              mlm_prob, mask_tokens, vocab_words, rng, mask_instances))
 
   rng.shuffle(instances)
   return instances
@@ -243,8 +263,12 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
 
 def create_instances_from_document(
         all_documents, document_index, max_seq_length, short_seq_prob,
-        mlm_prob, mask_tokens, vocab_words, rng):
-  """Creates `TrainingInstance`s for a single document."""
+        mlm_prob, mask_tokens, vocab_words, rng, mask_instances=True):
+  """Creates `TrainingInstance`s for a single document.
+
+  If `mask_instances` is False, the instances have no masked tokens, they are masked by
+  `create_masked_lm_predictions_batch` when written.
+  """
   document = all_documents[document_index]
 
   # Account for [CLS], [SEP], [SEP]
@@ -339,9 +363,12 @@ def create_instances_from_document(
         tokens.append("[SEP]")
         segment_ids.append(1)
 
-        (tokens, masked_lm_positions,
-         masked_lm_labels) = create_masked_lm_predictions(
-             tokens, mlm_prob, mask_tokens, vocab_words, rng, max_seq_length)
+        if mask_instances:
+          (tokens, masked_lm_positions,
+           masked_lm_labels) = create_masked_lm_predictions(
+               tokens, mlm_prob, mask_tokens, vocab_words, rng, max_seq_length)
+        else:
+          masked_lm_positions, masked_lm_labels = [], []
         instance = TrainingInstance(
             tokens=tokens,
             segment_ids=segment_ids,
@@ -443,6 +470,106 @@ def create_masked_lm_predictions(tokens, mlm_prob,
   return (output_tokens, masked_lm_positions, masked_lm_labels)
 
 
+def create_masked_lm_predictions_batch(input_ids, candidates, word_starts, mlm_prob, mask_tokens,
+                                       max_seq_length, mask_id, vocab_size, np_rng):
+  """Vectorized version of `create_masked_lm_predictions` for a batch of instances.
+
+  Args:
+    input_ids: [batch_size, max_seq_length] token ids, padded with 0.
+    candidates: [batch_size, max_seq_length] bool, the tokens which can be masked.
+    word_starts: [batch_size, max_seq_length] bool, the first token of each word
+      (equal to `candidates` without whole word masking).
+    np_rng: np.random.Generator
+
+  Returns:
+    (masked input_ids, [batch_size, mask_tokens] masked positions, [batch_size, mask_tokens]
+    labels, [batch_size] number of masked tokens)
+  """
+  batch_size, seq_len = input_ids.shape
+  rows = np.arange(batch_size)[:, None]
+  lengths = (input_ids != 0).sum(1)
+  num_to_predict = np.minimum(mask_tokens, np.maximum(1, np.round(lengths * mlm_prob).astype(np.int64)))
+  num_to_predict = np.maximum(num_to_predict, lengths - max_seq_length + mask_tokens)
+
+  # Every token of a word gets the random key of the word, then sorting the tokens
+  # by key gives the words in random order, with the tokens of a word contiguous.
+  word_index = np.cumsum(word_starts, axis=1) - 1
+  word_keys = np_rng.random((batch_size, seq_len))
+  token_keys = np.where(candidates, word_keys[rows, np.maximum(word_index, 0)], 2.)
+  order = np.argsort(token_keys, axis=1, kind="stable")
+  sorted_candidates = candidates[rows, order]
+  sorted_words = word_index[rows, order]
+  new_word = np.ones_like(sorted_candidates)
+  new_word[:, 1:] = sorted_words[:, 1:] != sorted_words[:, :-1]
+  word_rank = np.cumsum(new_word, axis=1) - 1
+  # Number of candidate tokens of the k-th word of each row, as [seq_len, batch_size]
+  # so that each step of the loop below reads a contiguous row
+  word_sizes = np.bincount((word_rank * batch_size + rows).ravel(), weights=sorted_candidates.ravel(),
+                           minlength=seq_len * batch_size).astype(np.int64).reshape(seq_len, batch_size)
+
+  # Take the words in order, skipping those which would exceed num_to_predict,
+  # until every row has all its predictions
+  num_masked = np.zeros(batch_size, dtype=np.int64)
+  taken = np.zeros((seq_len, batch_size), dtype=bool)
+  for k in range(int(word_rank[:, -1].max()) + 1):
+    take = (word_sizes[k] > 0) & (num_masked + word_sizes[k] <= num_to_predict)
+    num_masked += np.where(take, word_sizes[k], 0)
+    taken[k] = take
+    if (num_masked == num_to_predict).all():
+      break
+  taken = taken.T
+  masked = np.zeros_like(candidates)
+  masked[rows, order] = taken[rows, word_rank] & sorted_candidates
+
+  # 80% of the time, replace with [MASK], 10% keep the original, 10% replace with random word
+  replacement = np_rng.random((batch_size, seq_len))
+  random_ids = np_rng.integers(0, vocab_size, (batch_size, seq_len))
+  output_ids = np.where(masked & (replacement < 0.8), mask_id, input_ids)
+  output_ids = np.where(masked & (replacement >= 0.9), random_ids, output_ids)
+
+  # Positions of the masked tokens in increasing order, padded with 0
+  positions = np.argsort(~masked, axis=1, kind="stable")[:, :mask_tokens]
+  valid = np.arange(mask_tokens) < num_masked[:, None]
+  positions = np.where(valid, positions, 0)
+  labels = np.where(valid, input_ids[rows, positions], 0)
+  return output_ids, positions, labels, num_masked
+
+
+def vectorized_instance_features(instances, tokenizer, max_seq_length, mask_tokens,
+                                 mlm_prob, do_whole_word_mask, np_rng, batch_size=4096):
+  """Mask un-masked `TrainingInstance`s in batches and yield the features of each instance."""
+  vocab_words = list(tokenizer.vocab.keys())
+  is_subword = np.array([w.startswith("##") for w in vocab_words])
+  special_ids = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+  mask_id = tokenizer.convert_tokens_to_ids(["[MASK]"])[0]
+
+  for start in range(0, len(instances), batch_size):
+    batch = instances[start:start + batch_size]
+    input_ids = np.zeros((len(batch), max_seq_length), dtype=np.int64)
+    segment_ids = np.zeros((len(batch), max_seq_length), dtype=np.int64)
+    for i, instance in enumerate(batch):
+      input_ids[i, :len(instance.tokens)] = tokenizer.convert_tokens_to_ids(instance.tokens)
+      segment_ids[i, :len(instance.segment_ids)] = instance.segment_ids
+    candidates = (input_ids != 0) & ~np.isin(input_ids, special_ids)
+    word_starts = candidates & ~is_subword[input_ids] if do_whole_word_mask else candidates
+
+    output_ids, positions, labels, num_masked = create_masked_lm_predictions_batch(
+        input_ids, candidates, word_starts, mlm_prob, mask_tokens,
+        max_seq_length, mask_id, len(vocab_words), np_rng)
+    input_mask = (input_ids != 0).astype(np.int64)
+
+    for i, instance in enumerate(batch):
+      features = collections.OrderedDict()
+      features["input_ids"] = output_ids[i].tolist()
+      features["input_mask"] = input_mask[i].tolist()
+      features["segment_ids"] = segment_ids[i].tolist()
+      features["masked_lm_positions"] = positions[i, :num_masked[i]].tolist()
+      features["masked_lm_ids"] = labels[i, :num_masked[i]].tolist()
+      features["masked_lm_weights"] = [1] * int(num_masked[i])
+      features["next_sentence_labels"] = [1 if instance.is_random_next else 0]
+      yield features
+
+
 def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
   """Truncates a pair of sequences to a maximum sequence length."""
   while True:
@@ -461,6 +588,107 @@ def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
       trunc_tokens.pop()
 
 
+def read_document_shards(input_files, documents_per_shard):
+  """Lazily read the input files, yielding lists of `documents_per_shard` documents (lists of lines)."""
+  shard = []
+  document = []
+  for input_file in input_files:
+    with open(input_file, "r") as reader:
+      for line in chain(reader, ["\n"]):
+        # Empty lines are used as document delimiters
+        if line.strip():
+          document.append(line)
+        elif document:
+          shard.append(document)
+          document = []
+          if len(shard) == documents_per_shard:
+            yield shard
+            shard = []
+  if shard:
+    yield shard
+
+
+def _init_shard_worker(shard_args):
+  # create_masked_lm_predictions reads the options of the script from the global `args`,
+  # which worker processes only inherit when they are forked from the script
+  global shard_tokenizer, args
+  args = shard_args
+  shard_tokenizer = tokenization.FullTokenizer(
+      vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+
+
+def write_shard(shard_index, documents, output_file, args):
+  """
+  Tokenize a shard of documents, create its `TrainingInstance`s and write them to `output_file`.
+
+  Random next sentences are sampled from the documents of the same shard. The
+  instances of each duplicate are shuffled and written as a contiguous block,
+  so that BinaryDataLoader reads a different duplicate of the file each epoch.
+  """
+  rng = random.Random(f"{args.seed}:{shard_index}")
+  np_rng = np.random.default_rng((args.seed, shard_index)) if args.vectorized_masking else None
+  all_documents = []
+  for document in documents:
+    lines = shard_tokenizer.tokenize_batch([tokenization.convert_to_unicode(line).strip() for line in document])
+    lines = [line for line in lines if line]
+    if lines:
+      all_documents.append(lines)
+  rng.shuffle(all_documents)
+
+  vocab_words = list(shard_tokenizer.vocab.keys())
+  duplicates = []
+  for _ in range(args.duplication_factor):
+    instances = []
+    for document_index in range(len(all_documents)):
+      instances.extend(
+          create_instances_from_document(
+              all_documents, document_index, args.sequence_length, args.short_seq_prob,
+              args.mlm_prob, args.mask_tokens, vocab_words, rng, not args.vectorized_masking))
+    rng.shuffle(instances)
+    duplicates.append(instances)
+
+  # Duplicates must have the same size for BinaryDataLoader to find their boundaries
+  samples_per_duplicate = min(len(instances) for instances in duplicates)
+  with open(output_file, "wb") as writer:
+    for instances in duplicates:
+      for features in instances_to_features(instances[:samples_per_duplicate], shard_tokenizer,
+                                            args.sequence_length, args.mask_tokens, args, np_rng):
+        writer.write(features_to_binary(features, args.sequence_length, args.mask_tokens, args.pad_position_value))
+  return samples_per_duplicate * args.duplication_factor
+
+
+def bounded_submit(executor, fn, tasks, max_pending):
+  """
+  Submit `fn(*task)` to `executor` for each task of the lazy iterable `tasks` and yield
+  the results in order. At most `max_pending` tasks are submitted and not yet returned,
+  so the next tasks are only read as the results are consumed.
+  """
+  pending = collections.deque()
+  for task in tasks:
+    if len(pending) >= max_pending:
+      yield pending.popleft().result()
+    pending.append(executor.submit(fn, *task))
+  while pending:
+    yield pending.popleft().result()
+
+
+def write_streaming_shards(input_files, args):
+  """
+  Create the pretraining data in shards of `args.documents_per_shard` documents, each processed
+  and written to its own output file by a worker process. The input files are read lazily and at
+  most two shards per worker are in flight, so memory use does not depend on the size of the dataset.
+  """
+  num_workers = args.num_workers or os.cpu_count()
+  tasks = ((shard_index, documents, args.output_file + f"_{shard_index}", args)
+           for shard_index, documents in enumerate(read_document_shards(input_files, args.documents_per_shard)))
+  with ProcessPoolExecutor(max_workers=num_workers,
+                           initializer=_init_shard_worker,
+                           initargs=(args,)) as executor:
+    samples_per_shard = list(bounded_submit(executor, write_shard, tasks, 2 * num_workers))
+  print(f"Wrote {sum(samples_per_shard)} total instances in {len(samples_per_shard)} shards")
+  return samples_per_shard
+
+
 def main(args):
   tokenizer = tokenization.FullTokenizer(
       vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
@@ -469,7 +697,12 @@ def main(args):
   for input_pattern in args.input_file.split(","):
     input_files_glob.extend(sorted(glob.glob(input_pattern)))
 
+  if args.streaming:
+    write_streaming_shards(input_files_glob, args)
+    return
+
   rng = random.Random(args.seed)
+  np_rng = np.random.default_rng(args.seed) if args.vectorized_masking else None
   num_files = len(input_files_glob)
   print(f"*** Reading {num_files} input files in batches of {args.max_open_files}***")
   for i in tqdm(range(0, num_files, args.max_open_files)):
@@ -479,13 +712,14 @@ def main(args):
 
     instances = create_training_instances(input_files, tokenizer, args.sequence_length,
                                           args.duplication_factor, args.short_seq_prob,
-                                          args.mlm_prob, args.mask_tokens, rng)
+                                          args.mlm_prob, args.mask_tokens, rng,
+                                          mask_instances=np_rng is None)
 
     output_files = [args.output_file + f"_{i//args.max_open_files}"]
     print("*** Writing to output files ***")
 
     write_instance_to_example_files(instances, tokenizer, args.sequence_length,
-                                    args.mask_tokens, output_files, args, args.max_samples)
+                                    args.mask_tokens, output_files, args, args.max_samples, np_rng)
 
 
 if __name__ == "__main__":
@@ -506,5 +740,17 @@ if __name__ == "__main__":
                       help="Value in the positional input for [PAD] tokens")
   parser.add_argument("--do-whole-word-mask", type=bool, default=False)
   parser.add_argument("--max-open-files", type=int, default=1)
+  parser.add_argument("--vectorized-masking", action="store_true",
+                      help="Create the masked LM predictions with NumPy for batches of instances, "
+                           "seeded by --seed (and the shard index with --streaming)")
+  parser.add_argument("--streaming", action="store_true",
+                      help="Read the input files lazily and process them in shards of documents by worker processes, "
+                           "writing one output file per shard (<output-file>_<shard>)")
+  parser.add_argument("--documents-per-shard", type=int, default=10000,
+                      help="Number of documents of each shard in streaming mode")
+  parser.add_argument("--num-workers", type=int, default=None,
+                      help="Number of worker processes in streaming mode. Defaults to the number of CPUs")
   args = parser.parse_args()
+  if args.streaming and args.max_samples != -1:
+    parser.error("--max-samples is not supported with --streaming")
   main(args)
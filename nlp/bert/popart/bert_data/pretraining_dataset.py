@@ -24,6 +24,7 @@ from logging import getLogger
 from functools import reduce
 import popdist.popart
 from .dataset import DataSet
+from .columnar_dataset import ColumnarDataLoader, is_columnar_dataset
 from .data_sampler import DistributedDataSampler, SampleGenerator
 from utils.distributed import distributed_barrier
 
@@ -86,6 +87,21 @@ def packed_data_ranges(sequence_length, mask_tokens, vocab_length, max_sequences
             1]
 
 
+# Concatenate and shuffle the data that has been read in
+@nb.jit(nopython=True, parallel=True, cache=True)
+def concat_shuffle(buffer, data, indices, samples_per_file):
+    cumulative_samples_per_epoch = np.zeros((len(samples_per_file)), dtype=nb.int32)
+    cumulative_samples_per_epoch[1:] = np.cumsum(samples_per_file)[:-1]
+
+    for i in nb.prange(len(data)):
+        start = cumulative_samples_per_epoch[i]
+        end = cumulative_samples_per_epoch[i] + samples_per_file[i]
+        access_pattern = indices[start:end]
+        for k, j in enumerate(access_pattern):
+            buffer[j] = data[i][k]
+    return buffer
+
+
 # This could be replaced by a pytorch dataloader
 class BinaryDataLoader(object):
     '''
@@ -202,6 +218,38 @@ class BinaryDataLoader(object):
         return new_data
 
 
+class PermutedEpoch(object):
+    """
+    A view of one epoch of the memory-mapped input files, in the order given by a permutation.
+    Slicing it gathers the selected samples from the files.
+
+    :param memmaps: The [samples, sample_size] memory maps of the input files
+    :param offsets: The first sample of each file used in this epoch (selects the duplicate of the data)
+    :param samples_per_file: The number of samples of each file used in this epoch
+    :param indices: The permutation of the samples of the epoch
+    """
+    def __init__(self, memmaps, offsets, samples_per_file, indices):
+        self.memmaps = memmaps
+        self.offsets = offsets
+        self.file_starts = np.concatenate([[0], np.cumsum(samples_per_file)])
+        self.indices = indices
+
+    @property
+    def shape(self):
+        return (len(self.indices), self.memmaps[0].shape[1])
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self[key[0]][(slice(None),) + key[1:]]
+        rows = self.indices[key]
+        file_ids = np.searchsorted(self.file_starts, rows, side="right") - 1
+        batch = np.empty((len(rows), self.shape[1]), self.memmaps[0].dtype)
+        for file_id in np.unique(file_ids):
+            selected = file_ids == file_id
+            batch[selected] = self.memmaps[file_id][rows[selected] - self.file_starts[file_id] + self.offsets[file_id]]
+        return batch
+
+
 class CachedDataLoader(BinaryDataLoader):
     """
     Same as the BinaryDataLoader but preloads the specified number of epochs into memory ahead of time.
@@ -209,13 +257,20 @@ class CachedDataLoader(BinaryDataLoader):
         Specify the number of epochs to keep loaded in memory. This can reduce the number of times the inputs
         are read. It is recommended to make this as large as possible as the dataset files can be very large due to duplication factor.
         Must be greater than 0.
+    :param cache_permutations:
+        If True, the input files are memory-mapped once and each cached epoch only stores a permutation of
+        the sample indices, from which the batches are gathered. Caching an epoch then costs an index array
+        instead of a full copy of the dataset.
     """
     def __init__(self,
                  *args,
                  epochs_to_cache=1,
+                 cache_permutations=False,
                  **kwargs):
         super().__init__(*args, **kwargs)
         self.epochs_to_cache = epochs_to_cache
+        self.cache_permutations = cache_permutations
+        self.memmaps = None
         self.data_cache = []
         self.cache_index = 0
 
@@ -243,6 +298,9 @@ class CachedDataLoader(BinaryDataLoader):
         self.cache_index += 1
 
     def load_cache(self):
+        if self.cache_permutations:
+            self.load_permutation_cache()
+            return
         self.cache_index = 0
         self.data_cache = []
         logger.info("Filling Dataset Cache")
@@ -252,20 +310,6 @@ class CachedDataLoader(BinaryDataLoader):
             for __ in tqdm(self.files):
                 data.append(self.load_file())
 
-            # Concatenate and shuffle the data that has been read in
-            @nb.jit(nopython=True, parallel=True, cache=True)
-            def concat_shuffle(buffer, data, indices, samples_per_file):
-                cumulative_samples_per_epoch = np.zeros((len(samples_per_file)), dtype=nb.int32)
-                cumulative_samples_per_epoch[1:] = np.cumsum(samples_per_file)[:-1]
-
-                for i in nb.prange(len(data)):
-                    start = cumulative_samples_per_epoch[i]
-                    end = cumulative_samples_per_epoch[i] + samples_per_file[i]
-                    access_pattern = indices[start:end]
-                    for k, j in enumerate(access_pattern):
-                        buffer[j] = data[i][k]
-                return buffer
-
             # Create an array to hold the samples
             samples_per_file = np.array([self.samples_in_file(f) for f in self.files])
             total_samples_per_epoch = int(sum(samples_per_file))
@@ -289,6 +333,27 @@ class CachedDataLoader(BinaryDataLoader):
             self.file_index = 0
 
 
+    def load_permutation_cache(self):
+        self.cache_index = 0
+        self.data_cache = []
+        if self.memmaps is None:
+            # self.files is shuffled in place when iterating, so keep the order of the memory maps
+            self.mapped_files = list(self.files)
+            self.memmaps = [np.memmap(f, self.dtype, mode="r").reshape(-1, self.sample_size) for f in self.mapped_files]
+        samples_per_file = np.array([self.samples_in_file(f) for f in self.mapped_files])
+        total_samples_per_epoch = int(sum(samples_per_file))
+        for __ in range(self.epochs_to_cache):
+            # Each file contains duplication_factor copies of its samples, one for each epoch
+            offsets = samples_per_file * np.array(self.file_duplication_index)
+            self.file_duplication_index = [(i + 1) % self.duplication_factor for i in self.file_duplication_index]
+
+            indices = np.arange(total_samples_per_epoch)
+            if self.shuffle:
+                self._rng.shuffle(indices)
+            self.data_cache.append(PermutedEpoch(self.memmaps, offsets, samples_per_file, indices))
+        self.file_index = 0
+
+
 class GeneratedDataLoader(BinaryDataLoader):
     """
     Same as the BinaryDataLoader but generates random data instead of reading from input_files
@@ -381,6 +446,7 @@ def get_bert_dataset(args, tensor_shapes):
         shuffle=args.shuffle,
         seed=args.seed)
     tfrecord_input = args.input_files[0].lower().endswith('tfrecord') if len(args.input_files) > 0 else False
+    columnar_input = is_columnar_dataset(args.input_files[0]) if len(args.input_files) > 0 else False
     if generated_data:
         length = 1
         if args.use_popdist:
@@ -388,6 +454,20 @@ def get_bert_dataset(args, tensor_shapes):
         dl = GeneratedDataLoader(**data_loader_args,
                                  length=length,
                                  generated_ranges=synthetic_data_ranges)
+    elif columnar_input:
+        if args.use_packed_sequence_format:
+            raise RuntimeError("columnar dataset not supported for packed sequence data format")
+
+        dl = ColumnarDataLoader(args.input_files[0],
+                                args.sequence_length,
+                                args.mask_tokens,
+                                samples_per_step,
+                                shuffle=args.shuffle,
+                                seed=args.seed,
+                                popdist_size=args.popdist_size if args.use_popdist else 1,
+                                popdist_rank=args.popdist_rank if args.use_popdist else 0,
+                                duplication_factor=args.duplication_factor,
+                                start_data_at_epoch=args.continue_training_from_epoch)
     elif tfrecord_input:
         if args.use_packed_sequence_format:
             raise RuntimeError("tfrecord dataset not supported for packed sequence data format")
@@ -399,11 +479,12 @@ def get_bert_dataset(args, tensor_shapes):
                                            samples_per_step)
     elif args.epochs_to_cache > 0:
         dl = CachedDataLoader(**data_loader_args,
-                              epochs_to_cache=args.epochs_to_cache)
+                              epochs_to_cache=args.epochs_to_cache,
+                              cache_permutations=args.cache_permutations)
     else:
         dl = BinaryDataLoader(**data_loader_args)
 
-    if args.use_popdist:
+    if args.use_popdist and not columnar_input:
         sampler = DistributedDataSampler(
             dl,
             popdist_size=args.popdist_size,
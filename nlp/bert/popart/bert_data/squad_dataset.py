@@ -15,17 +15,18 @@
 import os
 import numpy as np
 import random
-import pickle
 import json
 import fractions
 import math
 import subprocess
 from logging import getLogger
 from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 from .dataset import DataSet
 from .data_sampler import SequentialSampler, ShuffledSampler, DistributedDataSampler
-from .tokenization import FullTokenizer
+from .tokenization import FullTokenizer, load_vocab
 from .squad_utils import read_squad_examples, convert_examples_to_features, RawResult, write_predictions, InputFeatures
 
 logger = getLogger(__name__)
@@ -47,12 +48,132 @@ def generate_random_features(sequence_length, vocab_length, batch_size):
             0,
             None,
             None,
-            np.random.randint(0, sequence_length, size=1),
-            np.random.randint(0, sequence_length, size=1),
+            np.random.randint(0, sequence_length),
+            np.random.randint(0, sequence_length),
             None,
-            np.random.randint(0, sequence_length+1, size=1)
+            np.random.randint(0, sequence_length+1)
         ))
-    return features
+    return SquadFeatures.from_input_features(features)
+
+
+class SquadFeatures(object):
+    '''
+    The InputFeatures of a SQuAD dataset stored as numpy arrays, with a row per feature
+    for the fixed size fields and flat arrays indexed by `context_offset` for the
+    `token_to_orig_map` and `token_is_max_context` of the paragraph tokens.
+
+    Batches are gathered directly from the arrays. Indexing or iterating returns
+    InputFeatures, as used by write_predictions, whose `tokens` are recovered from
+    the input ids with `inv_vocab`.
+
+    :param arrays: Dict of the arrays in ARRAYS
+    :param inv_vocab: Dict from token id to token, required to recover the tokens
+    '''
+    ARRAYS = ("unique_id", "example_index", "doc_span_index", "input_ids", "input_mask",
+              "segment_ids", "p_mask", "cls_index", "paragraph_len", "start_position",
+              "end_position", "is_impossible", "padding_start_index", "doc_offset",
+              "context_offset", "token_to_orig", "token_is_max_context")
+    # Written last when saving, so an interrupted save is not loaded as a cache
+    METADATA_FILENAME = "features.json"
+    # Stored in place of a None position
+    NO_POSITION = -1
+
+    def __init__(self, arrays, inv_vocab=None):
+        self.arrays = arrays
+        self.inv_vocab = inv_vocab
+        for key in self.ARRAYS:
+            setattr(self, key, arrays[key])
+
+    def __len__(self):
+        return len(self.unique_id)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, index):
+        def position(value):
+            return None if value == self.NO_POSITION else int(value)
+
+        begin, end = self.context_offset[index], self.context_offset[index + 1]
+        positions = range(self.doc_offset[index], self.doc_offset[index] + end - begin)
+        padding_start_index = int(self.padding_start_index[index])
+        tokens = None
+        if self.inv_vocab is not None:
+            tokens = [self.inv_vocab[i] for i in self.input_ids[index, :padding_start_index].tolist()]
+        return InputFeatures(
+            unique_id=int(self.unique_id[index]),
+            example_index=int(self.example_index[index]),
+            doc_span_index=int(self.doc_span_index[index]),
+            tokens=tokens,
+            token_to_orig_map=dict(zip(positions, self.token_to_orig[begin:end].tolist())),
+            token_is_max_context=dict(zip(positions, self.token_is_max_context[begin:end].tolist())),
+            input_ids=self.input_ids[index],
+            input_mask=self.input_mask[index],
+            segment_ids=self.segment_ids[index],
+            cls_index=int(self.cls_index[index]),
+            p_mask=self.p_mask[index],
+            paragraph_len=int(self.paragraph_len[index]),
+            start_position=position(self.start_position[index]),
+            end_position=position(self.end_position[index]),
+            is_impossible=bool(self.is_impossible[index]),
+            padding_start_index=padding_start_index)
+
+    @classmethod
+    def from_input_features(cls, features, inv_vocab=None):
+        def column(key, dtype, default):
+            return np.array([default if getattr(f, key) is None else getattr(f, key) for f in features], dtype=dtype)
+
+        input_ids = np.array([f.input_ids for f in features]).reshape(len(features), -1)
+        sequence_length = input_ids.shape[1]
+        contexts = [sorted(f.token_to_orig_map.items()) if f.token_to_orig_map else [] for f in features]
+        arrays = {
+            "unique_id": column("unique_id", np.int64, 0),
+            "example_index": column("example_index", np.int32, 0),
+            "doc_span_index": column("doc_span_index", np.int32, 0),
+            "input_ids": input_ids.astype(np.uint16 if input_ids.max(initial=0) < 2**16 else np.int32),
+            "input_mask": np.array([np.ones(sequence_length) if f.input_mask is None else f.input_mask
+                                    for f in features], dtype=np.uint8).reshape(len(features), -1),
+            "segment_ids": np.array([f.segment_ids for f in features], dtype=np.uint8).reshape(len(features), -1),
+            "p_mask": np.array([np.zeros(sequence_length) if f.p_mask is None else f.p_mask
+                                for f in features], dtype=np.uint8).reshape(len(features), -1),
+            "cls_index": column("cls_index", np.int32, 0),
+            "paragraph_len": np.array([len(c) for c in contexts], dtype=np.int32),
+            "start_position": column("start_position", np.int32, cls.NO_POSITION),
+            "end_position": column("end_position", np.int32, cls.NO_POSITION),
+            "is_impossible": column("is_impossible", np.bool_, False),
+            "padding_start_index": column("padding_start_index", np.int32, sequence_length),
+            "doc_offset": np.array([c[0][0] if c else 0 for c in contexts], dtype=np.int32),
+            "context_offset": np.cumsum([0] + [len(c) for c in contexts], dtype=np.int64),
+            "token_to_orig": np.array([orig for c in contexts for _, orig in c], dtype=np.int32),
+            "token_is_max_context": np.array([f.token_is_max_context[position]
+                                              for f, c in zip(features, contexts) for position, _ in c],
+                                             dtype=np.bool_),
+        }
+        return cls(arrays, inv_vocab)
+
+    @classmethod
+    def concatenate(cls, parts, inv_vocab=None):
+        arrays = {key: np.concatenate([part[key] for part in parts]) for key in cls.ARRAYS if key != "context_offset"}
+        offsets = [part["context_offset"] for part in parts]
+        bases = np.cumsum([0] + [o[-1] for o in offsets[:-1]])
+        arrays["context_offset"] = np.concatenate([offsets[0][:1]] + [o[1:] + base for o, base in zip(offsets, bases)])
+        return cls(arrays, inv_vocab)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for key in self.ARRAYS:
+            np.save(os.path.join(path, f"{key}.npy"), self.arrays[key])
+        with open(os.path.join(path, self.METADATA_FILENAME), "w") as f:
+            json.dump({"num_features": len(self), "sequence_length": self.input_ids.shape[1]}, f)
+
+    @classmethod
+    def load(cls, path, inv_vocab=None, mmap_mode="r"):
+        arrays = {key: np.load(os.path.join(path, f"{key}.npy"), mmap_mode=mmap_mode) for key in cls.ARRAYS}
+        return cls(arrays, inv_vocab)
+
+    @classmethod
+    def is_cache(cls, path):
+        return os.path.isfile(os.path.join(path, cls.METADATA_FILENAME))
 
 
 class SquadDataLoader(object):
@@ -76,42 +197,26 @@ class SquadDataLoader(object):
         return self.num_batches
 
     def __iter__(self):
-        self.feature_iterator = iter([self.features[idx] for idx in self.sampler])
+        self.index_iterator = iter(self.sampler)
         return self
 
     def __next__(self):
-        items = [next(self.feature_iterator) for _ in range(self.batch_size)]
-
-        indicies = []
-        positions = []
-        segments = []
-        sequence_mask_idx = []
-        start_pos = []
-        end_pos = []
-        uid = []
-
-        for item in items:
-            indicies.append(item.input_ids)
-            padding_max = self.sequence_length if self.sequence_length is not None else len(item.input_ids)
-            padding_length = len(item.input_ids) - item.padding_start_index
-            position_padding = np.full(padding_length, padding_max)
-            position_ids = np.arange(0, item.padding_start_index)
-            positions.append(np.concatenate((position_ids, position_padding)).astype(np.int32))
-            segments.append(item.segment_ids)
-            sequence_mask_idx.append(item.padding_start_index)
-            start_pos.append(item.start_position)
-            end_pos.append(item.end_position)
-            uid.append(item.unique_id)
-            # Including impossible samples during training is under investigation. T12851
-            # if item.is_impossible:
-            #     logger.warning("Impossible sample exists in the dataset. "
-            #                 f"start pos: {item.start_position}, end pos: {item.end_position}")
-
-        inputs = []
-        for i in [indicies, positions, segments, sequence_mask_idx, start_pos, end_pos, uid]:
-            inputs.append(np.stack(i))
-
-        return inputs
+        indices = np.array([next(self.index_iterator) for _ in range(self.batch_size)])
+        features = self.features
+
+        input_ids = features.input_ids[indices].astype(self.dtype)
+        padding_max = self.sequence_length if self.sequence_length is not None else input_ids.shape[1]
+        padding_start_index = features.padding_start_index[indices]
+        position_ids = np.arange(input_ids.shape[1], dtype=np.int32)
+        positions = np.where(position_ids < padding_start_index[:, np.newaxis], position_ids, padding_max).astype(np.int32)
+
+        return [input_ids,
+                positions,
+                features.segment_ids[indices].astype(self.dtype),
+                padding_start_index.astype(self.dtype),
+                features.start_position[indices].astype(self.dtype),
+                features.end_position[indices].astype(self.dtype),
+                features.unique_id[indices]]
 
 
 class BertDataTransform(object):
@@ -161,21 +266,41 @@ class BertDataTransform(object):
         return items
 
 
+def _init_feature_worker(vocab_file, do_lower_case):
+    global feature_tokenizer
+    feature_tokenizer = FullTokenizer(vocab_file, do_lower_case=do_lower_case)
+
+
+def _convert_examples_chunk(examples, sequence_length, doc_stride, is_training):
+    features = convert_examples_to_features(examples=examples,
+                                            tokenizer=feature_tokenizer,
+                                            max_seq_length=sequence_length,
+                                            doc_stride=doc_stride,
+                                            max_query_length=64,
+                                            is_training=is_training)
+    return SquadFeatures.from_input_features(features).arrays
+
+
 def load_or_cache_features(input_file,
                            vocab_file,
                            sequence_length,
                            is_training=True,
                            cache_file=None,
                            overwrite_cache=False,
-                           do_lower_case=False):
+                           do_lower_case=False,
+                           num_workers=None,
+                           examples_per_chunk=256):
     if cache_file is None:
         cache_file = input_file + f".{sequence_length}.cache"
+    # The tokens of the features are only needed to write predictions
+    inv_vocab = None
+    if vocab_file is not None:
+        inv_vocab = {v: k for k, v in load_vocab(vocab_file).items()}
 
-    if os.path.exists(cache_file) and not overwrite_cache:
+    if SquadFeatures.is_cache(cache_file) and not overwrite_cache:
         examples = None
         logger.info(f"Loading Cache {cache_file}")
-        with open(cache_file, "rb") as f:
-            features = pickle.load(f)
+        features = SquadFeatures.load(cache_file, inv_vocab)
     else:
         logger.info("Reading Examples")
         examples = read_squad_examples(input_file=input_file,
@@ -189,16 +314,24 @@ def load_or_cache_features(input_file,
             doc_stride = 64
 
         logger.info("Converting to Features")
-        features = convert_examples_to_features(examples=examples,
-                                                tokenizer=FullTokenizer(vocab_file, do_lower_case=do_lower_case),
-                                                max_seq_length=sequence_length,
-                                                doc_stride=doc_stride,
-                                                max_query_length=64,
-                                                is_training=is_training)
+        chunk_starts = range(0, len(examples), examples_per_chunk)
+        chunks = [examples[start:start + examples_per_chunk] for start in chunk_starts]
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 initializer=_init_feature_worker,
+                                 initargs=(vocab_file, do_lower_case)) as executor:
+            parts = list(executor.map(_convert_examples_chunk, chunks, repeat(sequence_length),
+                                      repeat(doc_stride), repeat(is_training)))
+        # Each chunk numbers its examples and features from the start
+        for start, part in zip(chunk_starts, parts):
+            part["example_index"] += start
+        features = SquadFeatures.concatenate(parts, inv_vocab)
+        features.unique_id[:] = 1000000000 + np.arange(len(features))
 
         logger.info(f"Saving Cache {cache_file}")
-        with open(cache_file, "wb") as f:
-            pickle.dump(features, f)
+        if os.path.isfile(cache_file):
+            # A pickled cache from a previous version
+            os.remove(cache_file)
+        features.save(cache_file)
 
     return features, examples
 
@@ -17,6 +17,7 @@ import random
 from collections import deque
 
 import numpy as np
+from .columnar_dataset import format_pretraining_batch
 try:
     from torch_xla.utils.tf_record_reader import TfRecordReader
 except ImportError:
@@ -121,43 +122,7 @@ class PretrainingTfRecordDataLoader:
         return self
 
     def post_process(self, samples):
-        batch_size, seq_len = samples['input_ids'].shape
-        formatted_pos = self.pad_position_value * np.ones_like(samples['input_ids'])
-        formatted_input = np.zeros_like(samples['input_ids'])
-        formatted_seg = np.zeros_like(samples['segment_ids'])
-        formatted_mask_labels = np.zeros((batch_size, self.max_mask_tokens),
-                                         dtype=samples['masked_lm_ids'].dtype)
-
-        valid_seq_positions = []
-        valid_mask_positions = samples['masked_lm_weights'] == 1
-        valid_mask_len = np.sum(valid_mask_positions, axis=1)
-        for i, mask_pos in enumerate(samples['masked_lm_positions']):
-            pos = [True] * seq_len
-            for mask_index, m in enumerate(mask_pos):
-                if mask_index < valid_mask_len[i]:
-                    pos[m] = False
-            valid_seq_positions.append(np.logical_and(pos, samples['input_ids'][i] != 0))
-        valid_seq_len = np.minimum(np.sum(valid_seq_positions, axis=1) + self.max_mask_tokens,
-                                   self.max_seq_length)
-        unmasked_len = np.minimum(np.sum(valid_seq_positions, axis=1),
-                                  self.max_seq_length - self.max_mask_tokens)
-        for i in range(batch_size):
-            target_mask_indices = np.arange(valid_mask_len[i])
-            target_seq_indices = self.max_mask_tokens + np.arange(unmasked_len[i])
-            source_mask_indices = samples['masked_lm_positions'][i][valid_mask_positions[i]]
-            source_seq_indices = np.arange(seq_len)[valid_seq_positions[i]][:unmasked_len[i]]
-
-            target_indices = np.hstack([target_mask_indices, target_seq_indices])
-            source_indices = np.hstack([source_mask_indices, source_seq_indices])
-
-            formatted_pos[i, target_indices] = source_indices
-            formatted_input[i, target_indices] = samples['input_ids'][i, source_indices]
-            formatted_seg[i, target_indices] = samples['segment_ids'][i, source_indices]
-            formatted_mask_labels[i] = samples['masked_lm_ids'][i, :self.max_mask_tokens]
-
-        return [formatted_input, formatted_pos, formatted_seg,
-                valid_mask_len, valid_seq_len, formatted_mask_labels,
-                samples['next_sentence_labels']]
+        return format_pretraining_batch(samples, self.max_seq_length, self.max_mask_tokens, self.pad_position_value)
 
     def __next__(self):
         if self.drop_remainder:
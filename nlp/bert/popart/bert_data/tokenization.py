@@ -21,6 +21,7 @@ from __future__ import print_function
 import collections
 import re
 import unicodedata
+import numpy as np
 import six
 
 
@@ -169,11 +170,20 @@ class FullTokenizer(object):
   def tokenize(self, text):
     split_tokens = []
     for token in self.basic_tokenizer.tokenize(text):
-      for sub_token in self.wordpiece_tokenizer.tokenize(token):
-        split_tokens.append(sub_token)
+      split_tokens.extend(self.wordpiece_tokenizer.tokenize_word(token))
 
     return split_tokens
 
+  def tokenize_batch(self, texts):
+    """Tokenizes a list of texts, returning a list of lists of tokens."""
+    return [self.tokenize(text) for text in texts]
+
+  def encode_batch(self, texts):
+    """Tokenizes a list of texts, returning a list of int32 numpy arrays of ids."""
+    vocab = self.vocab
+    return [np.array([vocab[token] for token in self.tokenize(text)], dtype=np.int32)
+            for text in texts]
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
@@ -195,6 +205,19 @@ class BasicTokenizer(object):
   def tokenize(self, text):
     """Tokenizes a piece of text."""
     text = convert_to_unicode(text)
+    if text.isascii():
+      return self._tokenize_ascii(text)
+    return self._tokenize_unicode(text)
+
+  def _tokenize_ascii(self, text):
+    """Same as `_tokenize_unicode` for ASCII text, without per character `unicodedata` lookups."""
+    text = text.translate(_ASCII_CLEAN_TABLE)
+    if self.do_lower_case:
+      text = text.lower()
+    return _ASCII_TOKEN_RE.findall(text)
+
+  def _tokenize_unicode(self, text):
+    """Tokenizes a piece of unicode text."""
     text = self._clean_text(text)
 
     # This was added on November 1st, 2018 for the multilingual and Chinese
@@ -299,10 +322,20 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
 
-  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200):
+  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200, cache_size=2**16):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    # Tries of the word-initial pieces and of the "##" continuation pieces
+    self._trie = {}
+    self._suffix_trie = {}
+    for token in vocab:
+      if token.startswith("##"):
+        _trie_insert(self._suffix_trie, token[2:], token)
+      else:
+        _trie_insert(self._trie, token, token)
+    self.cache_size = cache_size
+    self._cache = {}
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -326,36 +359,55 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
-        output_tokens.append(self.unk_token)
-        continue
+      output_tokens.extend(self.tokenize_word(token))
+    return output_tokens
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
+  def tokenize_word(self, token):
+    """Tokenizes a single word, caching the result of the most recent words."""
+    sub_tokens = self._cache.get(token)
+    if sub_tokens is None:
+      sub_tokens = self._tokenize_word(token)
+      if len(self._cache) >= self.cache_size:
+        # Evict the oldest entry
+        del self._cache[next(iter(self._cache))]
+      self._cache[token] = sub_tokens
+    return sub_tokens
+
+  def _tokenize_word(self, token):
+    if len(token) > self.max_input_chars_per_word:
+      return [self.unk_token]
+
+    sub_tokens = []
+    start = 0
+    trie = self._trie
+    while start < len(token):
+      # Walk the trie to find the longest piece in the vocab starting at `start`
+      node = trie
+      cur_substr = None
+      end = start
+      for i in range(start, len(token)):
+        node = node.get(token[i])
+        if node is None:
           break
-        sub_tokens.append(cur_substr)
-        start = end
+        if _TRIE_TOKEN in node:
+          cur_substr = node[_TRIE_TOKEN]
+          end = i + 1
+      if cur_substr is None:
+        return [self.unk_token]
+      sub_tokens.append(cur_substr)
+      start = end
+      trie = self._suffix_trie
+    return sub_tokens
+
+
+_TRIE_TOKEN = None
 
-      if is_bad:
-        output_tokens.append(self.unk_token)
-      else:
-        output_tokens.extend(sub_tokens)
-    return output_tokens
+
+def _trie_insert(trie, chars, token):
+  node = trie
+  for char in chars:
+    node = node.setdefault(char, {})
+  node[_TRIE_TOKEN] = token
 
 
 def _is_whitespace(char):
@@ -396,3 +448,12 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+# Removes the ASCII control characters and maps the whitespace ones to " ", as
+# `BasicTokenizer._clean_text` does.
+_ASCII_CLEAN_TABLE = {cp: None for cp in range(128) if cp == 0 or _is_control(chr(cp))}
+_ASCII_CLEAN_TABLE.update({cp: " " for cp in range(128) if _is_whitespace(chr(cp))})
+# A token is a single punctuation character or a run of other non-space characters
+_ASCII_PUNCTUATION = re.escape("".join(chr(cp) for cp in range(128) if cp > 32 and _is_punctuation(chr(cp))))
+_ASCII_TOKEN_RE = re.compile("[%s]|[^\\s%s]+" % (_ASCII_PUNCTUATION, _ASCII_PUNCTUATION))
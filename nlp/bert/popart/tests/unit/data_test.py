@@ -13,11 +13,11 @@
 # limitations under the License.
 
 import os
+import json
 import tempfile
 import numpy as np
 import struct
 import pytest
-import pickle
 import popart
 from functools import reduce
 from itertools import chain
@@ -27,11 +27,15 @@ from bert_model import Bert, BertConfig
 from bert_data.dataset import DataSet
 from bert_data.pretraining_dataset import (
     BinaryDataLoader,
+    CachedDataLoader,
     GeneratedDataLoader,
     BertDataTransform,
     data_file_format as pretraining_format,
     data_ranges as pretraining_ranges
 )
+from bert_data.columnar_dataset import ColumnarDataLoader, KEYS as COLUMNAR_KEYS, format_pretraining_batch
+from bert_data.tokenization import FullTokenizer
+from bert_data.squad_utils import InputFeatures, _get_best_indexes, _get_best_indexes_batch, _get_valid_spans
 from bert_data.squad_dataset import (
     SquadDataLoader,
     generate_random_features,
@@ -81,6 +85,130 @@ def test_dataloader():
         assert(np.all(lbl_ == lbl))
 
 
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_cached_permutations_dataloader(shuffle):
+    sample_size = 8
+    batch_size = 2
+    duplication_factor = 2
+
+    with tempfile.TemporaryDirectory() as pwd:
+        input_files = []
+        for i, num_samples in enumerate([6, 10]):
+            input_path = os.path.join(pwd, f"input_{i}.bin")
+            # Each file contains duplication_factor different copies of its samples
+            data = np.random.randint(0, 1000, (duplication_factor * num_samples, sample_size)).astype(np.int32)
+            data.tofile(input_path)
+            input_files.append(input_path)
+
+        def epochs(cache_permutations):
+            dl = CachedDataLoader(input_files,
+                                  [sample_size],
+                                  batch_size,
+                                  shuffle=shuffle,
+                                  duplication_factor=duplication_factor,
+                                  epochs_to_cache=2,
+                                  cache_permutations=cache_permutations)
+            return [np.concatenate([batch[0] for batch in dl]) for _ in range(4)]
+
+        for copied, permuted in zip(epochs(False), epochs(True)):
+            assert(copied.shape == permuted.shape == (16, sample_size))
+            if shuffle:
+                copied = np.unique(copied, axis=0)
+                permuted = np.unique(permuted, axis=0)
+            assert(np.all(copied == permuted))
+
+
+def write_columnar_dataset(path, num_samples, sequence_length, mask_tokens, file_num_samples=None):
+    widths = {'masked_lm_ids': mask_tokens, 'masked_lm_weights': mask_tokens, 'segment_ids': sequence_length,
+              'input_ids': sequence_length, 'input_mask': sequence_length, 'next_sentence_labels': 1,
+              'masked_lm_positions': mask_tokens}
+    dtypes = {'input_ids': 'uint16', 'masked_lm_ids': 'uint16', 'masked_lm_positions': 'uint16'}
+
+    samples = {'input_ids': np.random.randint(1, 30522, (num_samples, sequence_length)),
+               'segment_ids': np.random.randint(0, 2, (num_samples, sequence_length)),
+               'input_mask': np.ones((num_samples, sequence_length), dtype=np.int64),
+               'masked_lm_positions': np.stack([np.random.permutation(sequence_length)[:mask_tokens]
+                                                for _ in range(num_samples)]),
+               'masked_lm_ids': np.random.randint(1, 30522, (num_samples, mask_tokens)),
+               'masked_lm_weights': np.ones((num_samples, mask_tokens), dtype=np.int64),
+               'next_sentence_labels': np.random.randint(0, 2, (num_samples, 1))}
+
+    columns = {}
+    for key in COLUMNAR_KEYS:
+        dtype = dtypes.get(key, 'uint8')
+        samples[key].astype(dtype).tofile(os.path.join(path, f"{key}.bin"))
+        columns[key] = {"dtype": dtype, "width": widths[key], "feature_dtype": "int64"}
+    metadata = {"num_samples": num_samples, "columns": columns}
+    if file_num_samples is not None:
+        metadata["file_num_samples"] = file_num_samples
+    with open(os.path.join(path, "columns.json"), "w") as f:
+        json.dump(metadata, f)
+    return samples
+
+
+def test_columnar_dataloader():
+    sequence_length = 128
+    mask_tokens = 20
+    batch_size = 2
+    num_samples = 6
+
+    with tempfile.TemporaryDirectory() as pwd:
+        samples = write_columnar_dataset(pwd, num_samples, sequence_length, mask_tokens)
+
+        dl = ColumnarDataLoader(pwd, sequence_length, mask_tokens, batch_size, shuffle=False)
+        assert(len(dl) == num_samples // batch_size)
+
+        for i, batch in enumerate(dl):
+            rows = slice(i * batch_size, (i + 1) * batch_size)
+            expected = format_pretraining_batch({k: v[rows].astype(np.int32) for k, v in samples.items()},
+                                                sequence_length, mask_tokens)
+            for data, expected_data in zip(batch, expected):
+                assert(np.all(data == expected_data))
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+@pytest.mark.parametrize("start_data_at_epoch", [0, 1])
+def test_columnar_dataloader_duplication(shuffle, start_data_at_epoch):
+    sequence_length = 16
+    mask_tokens = 4
+    batch_size = 2
+    duplication_factor = 2
+    # Two input files, each holding 2 copies of its samples
+    file_num_samples = [4, 8]
+    copies = [[0, 1, 4, 5, 6, 7], [2, 3, 8, 9, 10, 11]]
+
+    with tempfile.TemporaryDirectory() as pwd:
+        samples = write_columnar_dataset(pwd, sum(file_num_samples), sequence_length, mask_tokens, file_num_samples)
+        # Make every sample identifiable by its first token
+        row_ids = np.arange(sum(file_num_samples)) + 1
+        samples['input_ids'][:, 0] = row_ids
+        samples['input_ids'].astype(np.uint16).tofile(os.path.join(pwd, "input_ids.bin"))
+
+        def epoch_rows(dl):
+            # The first token is at the first unmasked position of the formatted input
+            rows = []
+            for batch in dl:
+                tokens, positions = batch[0], batch[1]
+                rows.extend(tokens[positions == 0] - 1)
+            return sorted(rows) if shuffle else rows
+
+        dl = ColumnarDataLoader(pwd, sequence_length, mask_tokens, batch_size, shuffle=shuffle,
+                                duplication_factor=duplication_factor, start_data_at_epoch=start_data_at_epoch)
+        assert(len(dl) == sum(file_num_samples) // duplication_factor // batch_size)
+        for epoch in range(start_data_at_epoch, start_data_at_epoch + 3):
+            assert(epoch_rows(dl) == copies[epoch % duplication_factor])
+
+        if shuffle:
+            # A resumed run reads the samples in the same order as the continued run
+            continued = ColumnarDataLoader(pwd, sequence_length, mask_tokens, batch_size,
+                                           duplication_factor=duplication_factor)
+            resumed = ColumnarDataLoader(pwd, sequence_length, mask_tokens, batch_size,
+                                         duplication_factor=duplication_factor, start_data_at_epoch=1)
+            list(continued)
+            for batch, resumed_batch in zip(continued, resumed):
+                assert(np.all(batch[0] == resumed_batch[0]))
+
+
 def test_generated_data_pretraining():
     sequence_length = 128
     mask_tokens = 20
@@ -119,14 +247,14 @@ def test_generated_data_squad():
 
     assert(len(dl) == 1)
 
-    sizes = [sequence_length, sequence_length, sequence_length, 1, 1, 1]
+    sizes = [(sequence_length,), (sequence_length,), (sequence_length,), (), (), ()]
     ranges = [vocab_length, sequence_length + 1, 2, sequence_length + 1, sequence_length, sequence_length]
 
     dl_itr = iter(dl)
 
     for data, size, max_value in zip(next(dl_itr), sizes, ranges):
         assert(np.all(data < max_value))
-        assert(data.shape == (batch_size, size))
+        assert(data.shape == (batch_size, *size))
 
 
 def test_transform():
@@ -242,8 +370,7 @@ def get_squad(tmpdir_factory):
         dataset_size = 3333
         features = generate_random_features(128, 30, dataset_size)
         cache_file = input_file + f".{128}.cache"
-        with open(cache_file, "wb") as f:
-            pickle.dump(features, f)
+        features.save(cache_file)
         print(cache_file)
         return tmpdir
 
@@ -311,3 +438,253 @@ def test_no_drop_remainder(batch_size, shuffle, popdist_size, get_squad):
     args = MockArgs(device_iterations, batch_size, shuffle, popdist_size, tmpdir)
     ds = create_dataset(args)
     test(ds, args)
+
+
+def test_wordpiece_tokenizer():
+    def reference_wordpiece(vocab, word):
+        # The greedy longest-match-first algorithm of the original BERT tokenizer
+        sub_tokens = []
+        start = 0
+        while start < len(word):
+            for end in range(len(word), start, -1):
+                substr = ("##" if start > 0 else "") + word[start:end]
+                if substr in vocab:
+                    break
+            else:
+                return ["[UNK]"]
+            sub_tokens.append(substr)
+            start = end
+        return sub_tokens
+
+    vocab = ["[PAD]", "[UNK]", "un", "unaff", "##aff", "##able", "##a", "##ble", "run", "##s",
+             "##ning", "the", "a", ".", ",", "!", "'", "h", "##e", "##l", "##o", "w", "##r", "##d"]
+    texts = ["Unaffable runs the running!", "Hello, world.", "unable: the runner's \t\x00 aaa",
+             "Héllo naïve 東京", "", "   "]
+    with tempfile.TemporaryDirectory() as pwd:
+        vocab_file = os.path.join(pwd, "vocab.txt")
+        with open(vocab_file, "w") as f:
+            f.write("\n".join(vocab) + "\n")
+        tokenizer = FullTokenizer(vocab_file, do_lower_case=True)
+
+    tokens = tokenizer.tokenize_batch(texts)
+    for text, text_tokens in zip(texts, tokens):
+        words = tokenizer.basic_tokenizer._tokenize_unicode(text)
+        assert tokenizer.basic_tokenizer.tokenize(text) == words
+        assert text_tokens == [t for word in words for t in reference_wordpiece(tokenizer.vocab, word)]
+    # Cached words give the same results
+    assert tokenizer.tokenize_batch(texts) == tokens
+
+    ids = tokenizer.encode_batch(texts)
+    for text_ids, text_tokens in zip(ids, tokens):
+        assert text_ids.dtype == np.int32
+        assert list(text_ids) == tokenizer.convert_tokens_to_ids(text_tokens)
+
+
+@pytest.mark.parametrize('n_best_size', [1, 5, 20])
+def test_squad_best_spans(n_best_size):
+    sequence_length = 64
+    max_answer_length = 10
+    rng = np.random.default_rng(0)
+    # Rounding the logits gives many equal logits
+    start_logits = np.round(rng.normal(size=(16, sequence_length)), 1)
+    end_logits = np.round(rng.normal(size=(16, sequence_length)), 1)
+
+    start_indexes = _get_best_indexes_batch(start_logits, n_best_size)
+    end_indexes = _get_best_indexes_batch(end_logits, n_best_size)
+    for i in range(len(start_logits)):
+        assert start_indexes[i].tolist() == _get_best_indexes(start_logits[i].tolist(), n_best_size)
+        assert end_indexes[i].tolist() == _get_best_indexes(end_logits[i].tolist(), n_best_size)
+
+    features = []
+    for i in range(len(start_logits)):
+        doc_offset = rng.integers(2, 20)
+        doc_positions = range(doc_offset, rng.integers(doc_offset, sequence_length))
+        features.append(InputFeatures(
+            i, i, 0, ["token"] * (doc_positions.stop + 1),
+            {position: position - doc_offset for position in doc_positions},
+            {position: bool(rng.integers(2)) for position in doc_positions},
+            None, None, None, 0, None, len(doc_positions)))
+    spans = _get_valid_spans(features, start_logits, end_logits, n_best_size, max_answer_length)
+
+    expected = []
+    for row, feature in enumerate(features):
+        for start_index in start_indexes[row]:
+            for end_index in end_indexes[row]:
+                if (start_index in feature.token_to_orig_map and end_index in feature.token_to_orig_map and
+                        feature.token_is_max_context[start_index] and
+                        start_index <= end_index < start_index + max_answer_length):
+                    expected.append((row, start_index, end_index,
+                                     start_logits[row, start_index], end_logits[row, end_index]))
+    assert list(zip(*[s.tolist() for s in spans])) == expected
+
+
+def test_create_masked_lm_predictions_batch(monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(__file__), "..", "..", "bert_data"))
+    from bert_data.create_pretraining_data import create_masked_lm_predictions_batch
+
+    batch_size = 64
+    sequence_length = 128
+    mask_tokens = 20
+    mlm_prob = 0.15
+    cls_id, sep_id, mask_id, vocab_size = 101, 102, 103, 30522
+    rng = np.random.default_rng(0)
+
+    # [CLS] A [SEP] B [SEP], with words of 1 to 3 tokens, padded with 0
+    input_ids = np.zeros((batch_size, sequence_length), dtype=np.int64)
+    word_starts = np.zeros((batch_size, sequence_length), dtype=bool)
+    for i in range(batch_size):
+        length = rng.integers(10, sequence_length + 1)
+        input_ids[i, :length] = rng.integers(1000, vocab_size, length)
+        separator = rng.integers(2, length - 2)
+        input_ids[i, [0, separator, length - 1]] = [cls_id, sep_id, sep_id]
+        word_starts[i, :length] = rng.random(length) < 0.5
+        word_starts[i, [1, separator + 1]] = True
+    candidates = (input_ids != 0) & ~np.isin(input_ids, [cls_id, sep_id])
+    word_starts &= candidates
+
+    def mask(seed):
+        return create_masked_lm_predictions_batch(input_ids, candidates, word_starts, mlm_prob, mask_tokens,
+                                                  sequence_length, mask_id, vocab_size, np.random.default_rng(seed))
+
+    output_ids, positions, labels, num_masked = mask(1984)
+    for result, again in zip((output_ids, positions, labels, num_masked), mask(1984)):
+        assert np.array_equal(result, again)
+
+    lengths = (input_ids != 0).sum(1)
+    num_to_predict = np.minimum(mask_tokens, np.maximum(1, np.round(lengths * mlm_prob).astype(np.int64)))
+    assert np.all(num_masked > 0) and np.all(num_masked <= num_to_predict)
+    for i in range(batch_size):
+        masked = positions[i, :num_masked[i]]
+        assert np.all(np.diff(masked) > 0)
+        assert np.all(candidates[i, masked])
+        assert np.array_equal(labels[i, :num_masked[i]], input_ids[i, masked])
+        assert np.all(positions[i, num_masked[i]:] == 0) and np.all(labels[i, num_masked[i]:] == 0)
+        # Only the masked tokens are replaced
+        unmasked = np.ones(sequence_length, dtype=bool)
+        unmasked[masked] = False
+        assert np.array_equal(output_ids[i, unmasked], input_ids[i, unmasked])
+        # The tokens of a word are masked together
+        word_index = np.cumsum(word_starts[i]) - 1
+        is_masked = ~unmasked
+        for word in np.unique(word_index[candidates[i]]):
+            tokens = candidates[i] & (word_index == word)
+            assert np.all(is_masked[tokens]) or not np.any(is_masked[tokens])
+
+    # 80% of the masked tokens are replaced with [MASK]
+    is_masked = np.zeros_like(candidates)
+    for i in range(batch_size):
+        is_masked[i, positions[i, :num_masked[i]]] = True
+    assert 0.7 < np.mean(output_ids[is_masked] == mask_id) < 0.9
+
+
+def write_text_documents(path, num_documents, first_index=0, seed=0):
+    """Write `num_documents` documents of a few sentences, separated by empty lines.
+    The first word of each sentence is the index of its document."""
+    rng = np.random.default_rng(seed)
+    words = ["the", "ipu", "runs", "a", "model", "on", "graph", "data", "with", "many", "cores", "fast"]
+    documents = []
+    for d in range(first_index, first_index + num_documents):
+        documents.append([f"doc{d} " + " ".join(rng.choice(words, rng.integers(4, 20))) + " ."
+                          for _ in range(rng.integers(2, 8))])
+    with open(path, "w") as f:
+        f.write("\n\n".join("\n".join(document) for document in documents))
+    return documents
+
+
+@pytest.fixture(name="streaming_args")
+def streaming_args_fixture(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(__file__), "..", "..", "bert_data"))
+    input_files = [str(tmp_path / "input_0.txt"), str(tmp_path / "input_1.txt")]
+    documents = write_text_documents(input_files[0], 20) + write_text_documents(input_files[1], 17, first_index=20, seed=1)
+    vocab_file = tmp_path / "vocab.txt"
+    words = sorted({word for document in documents for line in document for word in line.split()})
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words) + "\n")
+
+    import argparse
+    args = argparse.Namespace(vocab_file=str(vocab_file), do_lower_case=True, sequence_length=32, mask_tokens=5,
+                              seed=1984, duplication_factor=3, mlm_prob=0.15, short_seq_prob=0.1,
+                              pad_position_value=384, do_whole_word_mask=False, vectorized_masking=False,
+                              documents_per_shard=6, num_workers=1, output_file=str(tmp_path / "out" / "shard"))
+    os.makedirs(tmp_path / "out")
+    return input_files, documents, args
+
+
+def test_read_document_shards(streaming_args):
+    from bert_data.create_pretraining_data import read_document_shards
+    input_files, documents, args = streaming_args
+
+    shards = list(read_document_shards(input_files, args.documents_per_shard))
+    assert [len(shard) for shard in shards] == [6] * 6 + [1]
+    # The fourth shard spans both input files, whose ends close the last document
+    assert shards[3][1][0].startswith("doc19 ") and shards[3][2][0].startswith("doc20 ")
+    read_documents = [[line.strip() for line in document] for shard in shards for document in shard]
+    assert read_documents == documents
+
+
+@pytest.mark.parametrize("vectorized_masking", [False, True])
+def test_write_streaming_shards(streaming_args, vectorized_masking):
+    from bert_data.create_pretraining_data import write_streaming_shards
+    input_files, _, args = streaming_args
+    args.vectorized_masking = vectorized_masking
+    sequence_length, mask_tokens, duplication_factor = args.sequence_length, args.mask_tokens, args.duplication_factor
+    sample_size = sum(pretraining_format(sequence_length, mask_tokens))
+
+    samples_per_shard = write_streaming_shards(input_files, args)
+    assert len(samples_per_shard) == 7
+    shards = []
+    for shard_index, num_samples in enumerate(samples_per_shard):
+        filename = f"{args.output_file}_{shard_index}"
+        data = np.fromfile(filename, dtype=np.int32).reshape(-1, sample_size)
+        # dupe_factor contiguous blocks of the same size
+        assert num_samples > 0 and num_samples % duplication_factor == 0
+        assert data.shape[0] == num_samples
+        shards.append(data)
+
+        # Each epoch BinaryDataLoader reads the next block of the file
+        dl = BinaryDataLoader([filename], pretraining_format(sequence_length, mask_tokens),
+                              batch_size=1, shuffle=False, duplication_factor=duplication_factor)
+        block_size = num_samples // duplication_factor
+        assert len(dl) == block_size
+        for epoch in range(duplication_factor + 1):
+            block = epoch % duplication_factor
+            read = np.concatenate([np.concatenate(batch, axis=1) for batch in dl])
+            assert np.array_equal(read, data[block * block_size:(block + 1) * block_size])
+
+    # The output does not depend on the number of workers
+    for shard_index in range(len(samples_per_shard)):
+        os.rename(f"{args.output_file}_{shard_index}", f"{args.output_file}_{shard_index}.1")
+    args.num_workers = 3
+    assert write_streaming_shards(input_files, args) == samples_per_shard
+    for shard_index, data in enumerate(shards):
+        with open(f"{args.output_file}_{shard_index}", "rb") as f, open(f"{args.output_file}_{shard_index}.1", "rb") as g:
+            assert f.read() == g.read()
+
+
+def test_bounded_submit(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import time
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(__file__), "..", "..", "bert_data"))
+    from bert_data.create_pretraining_data import bounded_submit
+
+    max_pending = 4
+    consumed = 0
+    max_in_flight = 0
+
+    def tasks():
+        nonlocal max_in_flight
+        for i in range(30):
+            # Tasks read and not yet returned
+            max_in_flight = max(max_in_flight, i - consumed)
+            yield (i,)
+
+    def slow_square(x):
+        time.sleep(0.002)
+        return x * x
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = []
+        for result in bounded_submit(executor, slow_square, tasks(), max_pending):
+            consumed += 1
+            results.append(result)
+    assert results == [i * i for i in range(30)]
+    assert max_in_flight == max_pending
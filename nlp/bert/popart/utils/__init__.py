@@ -303,7 +303,8 @@ def parse_bert_args(args_string=None):
     group = parser.add_argument_group("Data Config")
     group.add_argument("--input-files", type=str, nargs="*", default = [],
                        help="Files to load data from. "
-                            "For Pretraining: Binary files created by bert_data/create_pretraining_data.py. "
+                            "For Pretraining: Binary files created by bert_data/create_pretraining_data.py, "
+                            "or the folder of a columnar dataset created by bert_data/convert_to_columnar.py. "
                             "For SQuAD: Path to train-v1.1.json")
     group.add_argument("--shuffle", type=str_to_bool, nargs="?", const=True, default=False,
                        help="Shuffle Dataset")
@@ -325,6 +326,9 @@ def parse_bert_args(args_string=None):
                             " (# of samples in input-files)/duplication-factor")
     group.add_argument("--epochs-to-cache", type=int, default=0,
                        help="Number of epochs of data to load into memory during PRETRAINING. Default is to load input files as needed.")
+    group.add_argument("--cache-permutations", type=str_to_bool, nargs="?", const=True, default=False,
+                       help="Memory-map the input files once and only cache the order of the samples of each epoch, "
+                            "instead of a shuffled copy of the data (requires --epochs-to-cache > 0).")
 
     group = parser.add_argument_group("Execution Config")
     group.add_argument("--pipeline", type=str_to_bool, nargs="?", const=True, default=None,
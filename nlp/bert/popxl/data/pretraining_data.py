@@ -13,13 +13,15 @@
 # limitations under the License.
 
 import glob
+import json
 import multiprocessing
+import os
 
 import numpy as np
 import popdist
 import torch
 from tfrecord.reader import tfrecord_loader
-from torch.utils.data import IterableDataset
+from torch.utils.data import Dataset, IterableDataset
 from transformers import BertTokenizerFast
 
 TFRECORD_KEYS = (  # Torch Model Keys
@@ -156,6 +158,55 @@ class TFRecordPretrainingDataset(IterableDataset):
         return data
 
 
+class ColumnarPretrainingDataset(Dataset):
+    """
+    Preprocessed BERT pretraining dataset in the columnar format written by
+    data/convert_to_columnar.py.
+
+    Each feature is a memory-mapped [num_samples, width] array stored in a
+    narrow dtype (uint16 token ids, uint8 masks). Indexing the dataset with a
+    list of indices returns a whole batch, gathered from each column at once,
+    so it is meant to be used with a `BatchSampler` and `batch_size=None`.
+
+    Parameters
+    ----------
+    input_path: Folder of the columnar dataset
+    """
+
+    def __init__(self, input_path):
+        self.path = input_path
+        with open(os.path.join(self.path, "columns.json")) as f:
+            metadata = json.load(f)
+        self.num_samples = metadata["num_samples"]
+        self.columns = metadata["columns"]
+        self._memmaps = None
+
+    def __getstate__(self):
+        # Memory maps are re-opened in each worker
+        state = self.__dict__.copy()
+        state["_memmaps"] = None
+        return state
+
+    @property
+    def memmaps(self):
+        if self._memmaps is None:
+            self._memmaps = {key: np.memmap(os.path.join(self.path, f"{key}.bin"),
+                                            dtype=self.columns[key]["dtype"],
+                                            mode="r",
+                                            shape=(self.num_samples, self.columns[key]["width"]))
+                             for key in TFRECORD_KEYS}
+        return self._memmaps
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, indices):
+        # Sorting the indices of the batch makes the reads sequential
+        indices = np.sort(indices)
+        return {key: column[indices].astype(self.columns[key]["feature_dtype"])
+                for key, column in self.memmaps.items()}
+
+
 class WorkerInit:
     def __init__(self, seed):
         self.seed = seed
@@ -165,6 +216,8 @@ class WorkerInit:
 
 
 def load_dataset(input_files):
+    if len(input_files) == 1 and os.path.isfile(os.path.join(input_files[0], "columns.json")):
+        return ColumnarPretrainingDataset(input_files[0])
     return TFRecordPretrainingDataset(input_files, shuffle=True, file_buffer_size=10)
 
 
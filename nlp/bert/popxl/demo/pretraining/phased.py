@@ -4,8 +4,10 @@ import os
 import time
 import logging
 
+import popdist
 import wandb
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import BatchSampler, DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
 import numpy as np
 
 import popxl
@@ -15,19 +17,39 @@ from utils.setup import wandb_init, bert_pretraining_setup
 from execution.pretraining import pretraining_phased
 from popxl_addons import TaskSession
 from execution.utils import linear_schedule
-from data.pretraining_data import load_dataset, WorkerInit
+from data.pretraining_data import load_dataset, ColumnarPretrainingDataset, WorkerInit
 
 
 def training(config: BertConfig, session: TaskSession, dataset: Dataset):
     samples_per_step = config.execution.device_iterations * config.training.global_batch_size
 
-    train_dl = DataLoader(
-        dataset,
-        batch_size=samples_per_step,
-        drop_last=True,
-        num_workers=64,
-        worker_init_fn=WorkerInit(config.model.seed),
-        persistent_workers=True)
+    if isinstance(dataset, ColumnarPretrainingDataset):
+        # The dataset reads a whole batch at a time. As with the TFRecord
+        # shards, each instance reads its own part of the dataset
+        sampler = DistributedSampler(
+            dataset,
+            num_replicas=popdist.getNumInstances() if popdist.isPopdistEnvSet() else 1,
+            rank=popdist.getInstanceIndex() if popdist.isPopdistEnvSet() else 0,
+            shuffle=True,
+            seed=config.model.seed,
+            drop_last=True)
+        batch_sampler = BatchSampler(sampler, samples_per_step, drop_last=True)
+        train_dl = DataLoader(
+            dataset,
+            batch_size=None,
+            sampler=batch_sampler,
+            num_workers=64,
+            worker_init_fn=WorkerInit(config.model.seed),
+            persistent_workers=True)
+    else:
+        sampler = None
+        train_dl = DataLoader(
+            dataset,
+            batch_size=samples_per_step,
+            drop_last=True,
+            num_workers=64,
+            worker_init_fn=WorkerInit(config.model.seed),
+            persistent_workers=True)
 
     step = 0
 
@@ -40,7 +62,11 @@ def training(config: BertConfig, session: TaskSession, dataset: Dataset):
     # Attach to device
     with session:
         start = time.perf_counter()
+        epoch = 0
         while True:
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+            epoch += 1
             # Training loop
             for data in train_dl:
                 data_map = {}
@@ -141,6 +141,14 @@ def parse_bert_args(args=None, config_file="configs_pretraining.yml"):
     parser.add_argument("--packing-factor", type=dict_arg, help="Packing factor")
     parser.add_argument("--max-sequences-per-pack", type=int, choices=[2, 3], default=3,
                         help="The maximum number of sequences per packed example.")
+    parser.add_argument("--random-access-data", type=str_to_bool, nargs="?", const=True, default=False,
+                        help="Read the TFRecord files by index, with global shuffling and exact resume")
+    parser.add_argument("--columnar-data", type=str_to_bool, nargs="?", const=True, default=False,
+                        help="Read a columnar dataset written by data/convert_to_columnar.py, with global shuffling and exact resume")
+    parser.add_argument("--online-packing", type=str_to_bool, nargs="?", const=True, default=False,
+                        help="Pack un-packed input files on the fly (requires --packed-data)")
+    parser.add_argument("--packing-lookahead", type=int, default=1000,
+                        help="The number of sequences packed together when using --online-packing")
 
     # Misc
     parser.add_argument("--dataloader-workers", type=int, help="The number of dataloader workers")
@@ -225,6 +233,13 @@ def parse_bert_args(args=None, config_file="configs_pretraining.yml"):
     if args.checkpoint_steps is not None and args.checkpoint_steps < 1:
         parser.error("checkpoint-steps must be >=1")
 
+    if args.online_packing and not args.packed_data:
+        parser.error("--online-packing requires --packed-data")
+    if args.online_packing and args.random_access_data:
+        parser.error("--online-packing is not compatible with --random-access-data")
+    if args.online_packing and args.columnar_data:
+        parser.error("--online-packing is not compatible with --columnar-data")
+
     # Handle packing_factor
     if args.packed_data:
         args.packing_factor = args.packing_factor[args.sequence_length]
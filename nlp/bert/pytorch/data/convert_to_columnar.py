@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Converts BERT pretraining TFRecord files into a columnar dataset.
+
+Every feature of the examples is written to its own `<key>.bin` file as a
+[num_samples, width] array in the narrowest dtype which holds its values
+(uint16 token ids and positions, uint8 masks and labels). A `columns.json`
+file describes the dtype and width of each column, so the dataset can be
+memory-mapped and batches sliced from it without any decoding. It also
+records the number of examples of each input file, whose examples are
+written in order.
+"""
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+from tfrecord.reader import tfrecord_loader
+
+COLUMNS_FILENAME = "columns.json"
+
+# Storage dtype of the known features, any other feature is stored as int32 or float32
+COLUMN_DTYPES = {
+    'input_ids': 'uint16',
+    'input_mask': 'uint8',
+    'segment_ids': 'uint8',
+    'masked_lm_positions': 'uint16',
+    'masked_lm_ids': 'uint16',
+    'masked_lm_weights': 'uint8',
+    'next_sentence_labels': 'uint8',
+    'packed_input_ids': 'uint16',
+    'packed_input_mask': 'uint8',
+    'packed_segment_ids': 'uint8',
+    'packed_position_ids': 'uint16',
+    'packed_masked_lm_positions': 'uint16',
+    'packed_masked_lm_ids': 'uint16',
+    'packed_masked_lm_mask': 'uint8',
+    'packed_next_sentence_labels': 'uint8',
+    'packed_next_sentence_mask': 'uint8',
+}
+
+
+def column_dtype(key, value):
+    if key in COLUMN_DTYPES:
+        return COLUMN_DTYPES[key]
+    return 'float32' if np.issubdtype(value.dtype, np.floating) else 'int32'
+
+
+def to_column(key, rows, dtype):
+    """Stack the rows of a feature and cast them to the storage dtype, checking no value is lost."""
+    rows = np.stack(rows)
+    column = rows.astype(dtype)
+    if not np.array_equal(column, rows):
+        raise ValueError(f"Feature '{key}' has values which can not be stored as {dtype}")
+    return column
+
+
+def convert_to_columnar(input_files, output_dir, chunk_size=10000):
+    """
+    Write the examples of `input_files` to `output_dir` in the columnar format.
+
+    Returns
+    -------
+    metadata:dict
+        The content of `columns.json`: the number of samples, the number of samples
+        of each input file and for each column its storage dtype, the width of a
+        row and the original dtype of the feature.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    columns = None
+    outputs = {}
+    num_samples = 0
+    file_num_samples = []
+
+    def flush(chunk):
+        for key, rows in chunk.items():
+            to_column(key, rows, columns[key]["dtype"]).tofile(outputs[key])
+            rows.clear()
+
+    try:
+        for filename in tqdm(input_files):
+            file_start = num_samples
+            for datum in tfrecord_loader(filename, None):
+                if columns is None:
+                    columns = {key: {"dtype": column_dtype(key, value),
+                                     "width": len(value),
+                                     "feature_dtype": value.dtype.name}
+                               for key, value in datum.items()}
+                    outputs = {key: open(os.path.join(output_dir, f"{key}.bin"), "wb") for key in columns}
+                    chunk = {key: [] for key in columns}
+                if datum.keys() != columns.keys():
+                    raise ValueError(f"Example {num_samples} of {filename} does not have the features {list(columns)}")
+                for key, value in datum.items():
+                    if len(value) != columns[key]["width"]:
+                        raise ValueError(f"Feature '{key}' of example {num_samples} in {filename} has length "
+                                         f"{len(value)}, expected {columns[key]['width']}")
+                    chunk[key].append(value)
+                num_samples += 1
+                if num_samples % chunk_size == 0:
+                    flush(chunk)
+            file_num_samples.append(num_samples - file_start)
+        if columns is None:
+            raise ValueError(f"No examples found in {input_files}")
+        flush(chunk)
+    finally:
+        for f in outputs.values():
+            f.close()
+
+    metadata = {"num_samples": num_samples, "file_num_samples": file_num_samples, "columns": columns}
+    with open(os.path.join(output_dir, COLUMNS_FILENAME), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input-files", help="A glob expression for the TFRecord files to convert", required=True, type=str)
+    parser.add_argument("--output-dir", help="The destination folder of the columnar dataset", required=True, type=str)
+    parser.add_argument("--chunk-size", help="The number of examples written at a time", default=10000, type=int)
+    args = parser.parse_args()
+
+    input_files = sorted(glob.glob(args.input_files))
+    if len(input_files) == 0:
+        raise FileNotFoundError(f"Could not find file: {args.input_files}")
+    metadata = convert_to_columnar(input_files, args.output_dir, args.chunk_size)
+
+    input_bytes = sum(os.path.getsize(f) for f in input_files)
+    output_bytes = sum(os.path.getsize(os.path.join(args.output_dir, f"{key}.bin")) for key in metadata["columns"])
+    print(f"Converted {metadata['num_samples']} examples from {len(input_files)} files: "
+          f"{input_bytes / 2**20:.1f} MB -> {output_bytes / 2**20:.1f} MB")
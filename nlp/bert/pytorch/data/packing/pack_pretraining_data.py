@@ -14,6 +14,7 @@
 
 import collections
 import os
+import shutil
 import time
 import glob
 import random
@@ -31,7 +32,8 @@ try:
 except ImportError:
     raise ImportError("TensorFlow is required to generate data for this application. "
                       "Please install with: 'pip install tensorflow'")
-from pretraining_data import TFRecordPretrainingDataset, _WorkerInit
+from pretraining_data import TFRecordPretrainingDataset, _WorkerInit, pack_sequences
+from tfrecord.reader import tfrecord_loader
 from poptorch import DataLoader
 from poptorch.enums import DataLoaderMode
 from transformers import BertConfig
@@ -271,14 +273,126 @@ def get_packing_recipe(args, sequence_lengths, drop_unused_strategies=False):
     return strategy_set, mixture, padding
 
 
+class ExampleBins:
+    """Bins of examples (or None for padding sequences) indexed by sequence length.
+
+    If "memory_limit" is set, the bins are kept under that many bytes by spilling the
+    largest bins to files in "spill_dir". Spilled examples are read back when taken,
+    and shuffled with the examples of their bin which were never spilled.
+    The examples taken from the bins and still waiting to be packed are counted in
+    the limit through "extra_nbytes".
+
+    Parameters
+    ----------
+    memory_limit:int
+        The maximum number of bytes of examples to hold in memory, None for no limit.
+    spill_dir:str
+        The folder where bins are spilled when the memory limit is exceeded.
+    """
+    def __init__(self, memory_limit=None, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.bins = defaultdict(list)
+        self.spilled = defaultdict(list)
+        self.nbytes = 0
+        self.num_spills = 0
+
+    @staticmethod
+    def example_nbytes(example):
+        return 0 if example is None else sum(d.nbytes for d in example)
+
+    def add(self, length, example):
+        self.bins[length].append(example)
+        self.nbytes += self.example_nbytes(example)
+
+    def add_padding(self, length, count):
+        self.bins[length].extend([None] * count)
+
+    def count(self, length):
+        return len(self.bins[length]) + sum(count for _, count in self.spilled[length])
+
+    def shuffle(self):
+        for examples in self.bins.values():
+            random.shuffle(examples)
+
+    def take(self, length, count):
+        """Remove and return "count" examples of the given length."""
+        examples = self.bins[length]
+        while len(examples) < count and self.spilled[length]:
+            self._unspill(length)
+        taken = examples[len(examples) - count:]
+        del examples[len(examples) - count:]
+        self.nbytes -= sum(self.example_nbytes(example) for example in taken)
+        return taken
+
+    def over_limit(self, extra_nbytes=0):
+        return self.memory_limit is not None and self.nbytes + extra_nbytes > self.memory_limit
+
+    def spill(self, extra_nbytes=0):
+        """Write the largest bins to disk until at most half of the memory limit is used."""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        while self.nbytes + extra_nbytes > self.memory_limit // 2:
+            length = max(self.bins, key=lambda k: sum(e is not None for e in self.bins[k]))
+            examples = [e for e in self.bins[length] if e is not None]
+            if not examples:
+                break
+            filename = os.path.join(self.spill_dir, f"bin_{length}_{self.num_spills}.npz")
+            np.savez(filename, *[np.stack(column) for column in zip(*examples)])
+            self.num_spills += 1
+            self.spilled[length].append((filename, len(examples)))
+            self.bins[length] = [None] * (len(self.bins[length]) - len(examples))
+            self.nbytes -= sum(self.example_nbytes(example) for example in examples)
+
+    def _unspill(self, length):
+        filename, count = self.spilled[length].pop()
+        with np.load(filename) as data:
+            columns = [data[f"arr_{i}"] for i in range(len(data.files))]
+        os.remove(filename)
+        examples = [list(example) for example in zip(*columns)]
+        # Shuffle the whole bin, so the examples which stayed in memory are
+        # not all left to the end
+        self.bins[length].extend(examples)
+        random.shuffle(self.bins[length])
+        self.nbytes += sum(self.example_nbytes(example) for example in examples)
+
+
+def example_slices_nbytes(example_slices):
+    """The number of bytes of the examples of a list of multi sequences."""
+    return sum(ExampleBins.example_nbytes(example) for multi_sequence in example_slices for example in multi_sequence)
+
+
+class LengthSampler:
+    """Random selection of the sequences of each length used by the packing mixture.
+
+    The sequences of each length are kept with the probability of the number still to
+    be kept over the number still to be read, so exactly budget[k] of them are kept,
+    drawn uniformly from the whole dataset rather than the first ones read.
+
+    Parameters
+    ----------
+    budget:np.array of shape [sequence_length + 1]
+        budget[k] is the number of sequences of length k to be packed.
+    sequence_lengths:np.array
+        The sequence length of every example of the dataset.
+    """
+    def __init__(self, budget, sequence_lengths):
+        self.budget = budget.copy()
+        self.remaining = np.bincount(sequence_lengths, minlength=len(budget))
+
+    def keep(self, length):
+        keep = random.random() * self.remaining[length] < self.budget[length]
+        self.remaining[length] -= 1
+        self.budget[length] -= keep
+        return keep
+
+
 def slice_examples(examples_by_length, strategy_set, mixture):
     """Divide the examples between strategies in order to (partially) fulfill the mixture
 
     Parameters
     ----------
-    examples_by_length:dict
-        A dictionary mapping from sequence_length to the bin of examples of that
-        sequence length.
+    examples_by_length:ExampleBins
+        The bins of examples of each sequence length.
     strategy_set:list[list[int]]
         The list of unique packing strategies with which the packing problem
         was solved.
@@ -308,7 +422,7 @@ def slice_examples(examples_by_length, strategy_set, mixture):
         # examples by length
         feasible_repeat_count = target_repeat_count
         for k in set(strategy):
-            feasible_repeat_count = min(feasible_repeat_count, len(examples_by_length[k])//strategy.count(k))
+            feasible_repeat_count = min(feasible_repeat_count, examples_by_length.count(k)//strategy.count(k))
 
         # IF nothing to do
         if feasible_repeat_count == 0:
@@ -316,8 +430,7 @@ def slice_examples(examples_by_length, strategy_set, mixture):
 
         examples = []
         for k, seq_len in enumerate(strategy):
-            examples.append(examples_by_length[seq_len][-feasible_repeat_count:])
-            del examples_by_length[seq_len][-feasible_repeat_count:]
+            examples.append(examples_by_length.take(seq_len, feasible_repeat_count))
         example_slices.append(examples)
         strategies.append(strategy)
         total_packs_to_be_written += feasible_repeat_count
@@ -406,75 +519,14 @@ def create_multi_sequence_example(multi_sequence, mask_tokens, sequence_length,
     line:binary str
         The binary representation of the packed sequences, ready to be written to a file.
     """
-    # SEQ
-    packed_input_ids = np.zeros(sequence_length, dtype=np.int32)
-    packed_input_mask = np.zeros(sequence_length, dtype=np.int32)
-    packed_segment_ids = np.zeros(sequence_length, dtype=np.int32)
-    packed_position_ids = np.zeros(sequence_length, dtype=np.int32)
-
-    # MLM
-    # It is assumed that each sequence in a pack has a (roughly) fixed percentage of MLM tokens.
-    # To account for the cases where this percentage is rounded up, additional mlm tokens are added
-    # e.g in a pack of sequence lengths [ 17  37 458], 15% represents [2.55 5.55 68.7] which is
-    # then rounded to  [3 6 69] or 78 tokens in total. This is equivalent to
-    # (mask_tokens + max_sequences_per_pack - 1 = 76 + 3 - 1).
-    packed_masked_lm_positions = np.zeros(mask_tokens + max_sequences_per_pack - 1, dtype=np.int32)
-    packed_masked_lm_ids = np.zeros(mask_tokens + max_sequences_per_pack - 1, dtype=np.int32)
-    packed_masked_lm_mask = np.zeros(mask_tokens + max_sequences_per_pack - 1, dtype=np.float32)
-
-    # NSP
-    packed_next_sentence_labels = np.zeros(max_sequences_per_pack, dtype=np.int32)
-    packed_next_sentence_mask = np.zeros(max_sequences_per_pack, dtype=np.float32)
-
-    # An offset of where to start writing the tokens
-    seq_offset = 0
-
-    # Where to write the next MLM token
-    mlm_offset = 0
-    sequence_index = 1  # used in the input mask
-    for sequence in multi_sequence:
-        # Padding sequences are denoted with None
-        if sequence is not None:
-            input_ids, input_mask, segment_ids, *sequence = sequence
-            masked_lm_positions, masked_lm_ids, next_sentence_labels = sequence
-            # Use input_mask because input_ids could contain false "0"s
-            seq_len = input_mask.sum()
-            mask_tokens_mask_idx = (masked_lm_positions != 0).sum()
-
-            # SEQ
-            # This writes all the normal sequence tokens excluding the [CLS] tokens
-            max_seq = seq_offset + seq_len - 1
-            packed_input_ids[seq_offset:max_seq] = input_ids[1:seq_len]
-            packed_input_mask[seq_offset:max_seq] = sequence_index
-            packed_segment_ids[seq_offset:max_seq] = segment_ids[1:seq_len]
-            packed_position_ids[seq_offset:max_seq] = np.arange(1, seq_len)
-
-            # MLM
-            max_mlm = mlm_offset + mask_tokens_mask_idx
-
-            # Very rarely, (1/10M) it can occur that a multi-sequence has more than the allowed
-            # number of cumulative mask_tokens, such multi-sequences are thrown away
-            try:
-                packed_masked_lm_positions[mlm_offset:max_mlm] = masked_lm_positions[:mask_tokens_mask_idx] - 1 + seq_offset
-            except ValueError:
-                return b"", False
-
-            packed_masked_lm_ids[mlm_offset:max_mlm] = masked_lm_ids[:mask_tokens_mask_idx]
-            packed_masked_lm_mask[mlm_offset:max_mlm] = sequence_index
-
-            # NSP
-            # The NSP tokens are packed at the end of the sequence to enable slicing
-            packed_input_ids[-sequence_index] = input_ids[0]
-            packed_input_mask[-sequence_index] = sequence_index
-            packed_segment_ids[-sequence_index] = segment_ids[0]
-            packed_position_ids[-sequence_index] = 0
-            packed_next_sentence_labels[-sequence_index] = next_sentence_labels
-            packed_next_sentence_mask[-sequence_index] = 1
-
-            # Update offsets
-            sequence_index += 1
-            seq_offset = max_seq
-            mlm_offset = max_mlm
+    packed = pack_sequences(multi_sequence, mask_tokens, sequence_length, max_sequences_per_pack)
+    # Very rarely, (1/10M) it can occur that a multi-sequence has more than the allowed
+    # number of cumulative mask_tokens, such multi-sequences are thrown away
+    if packed is None:
+        return b"", False
+    (packed_input_ids, packed_input_mask, packed_segment_ids, packed_position_ids,
+     packed_masked_lm_positions, packed_masked_lm_ids, packed_masked_lm_mask,
+     packed_next_sentence_labels, packed_next_sentence_mask) = packed
 
     # Pack into binary format and write it
     features = collections.OrderedDict()
@@ -501,6 +553,34 @@ def create_int_feature(values):
     return feature
 
 
+def read_sequence_lengths(filename):
+    """Return the sequence length of each example of a TFRecord file, decoding only the input mask."""
+    index_filename = filename.replace(".tfrecord", ".index")
+    if not os.path.exists(index_filename):
+        index_filename = None
+    return np.array([np.count_nonzero(datum["input_mask"])
+                     for datum in tfrecord_loader(filename, index_filename, ["input_mask"])], dtype=np.int32)
+
+
+def get_sequence_lengths(input_files, num_workers):
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return np.concatenate(list(executor.map(read_sequence_lengths, input_files)))
+
+
+def get_length_budget(strategy_set, mixture, padding, sequence_length):
+    """Number of real (not padding) sequences of each length used by the packing mixture.
+
+    Returns
+    -------
+    budget:np.array of shape [sequence_length + 1]
+        budget[k] is the number of sequences of length k to be packed.
+    """
+    A = get_packing_matrix(strategy_set, sequence_length)
+    budget = np.zeros(sequence_length + 1, dtype=np.int64)
+    budget[1:] = A @ mixture - padding
+    return budget
+
+
 def get_dataloader(config, opts):
     dataset = TFRecordPretrainingDataset(config.input_files)
     loader = DataLoader(opts,
@@ -529,6 +609,11 @@ if __name__ == "__main__":
                         " dropping any sequences when loading the dataset (for eval)", default=1, type=int)
     parser.add_argument("--num-packing-workers", help="Max number of worker subprocesses to be used for packing sequences", default=16, type=int)
     parser.add_argument("--chunks-per-packing-worker", help="Approximate number of chunks to be packed by each packing subprocess", default=8, type=int)
+    parser.add_argument("--streaming", help="Collect the sequence lengths by decoding only the input mask of each example, and do not "
+                        "hold examples that the packing mixture will not use, randomly selected", action="store_true")
+    parser.add_argument("--max-memory-gb", help="Maximum size of the examples waiting to be packed, larger bins of examples "
+                        "are spilled to disk and packing is started early when exceeded. No limit by default", default=None, type=float)
+    parser.add_argument("--spill-dir", help="The folder for spilled examples, defaults to <output-dir>/spill", default=None, type=str)
     args = parser.parse_args()
     random.seed(args.random_seed)
 
@@ -553,10 +638,13 @@ if __name__ == "__main__":
     sequence_lengths = []
     print("Looping through dataset to collect sequence length information...")
     start = time.time()
-    for data in tqdm(dataset):
-        # Use data[1] because data[0] could contain false "0"s
-        real_tokens = (data[1] != 0).sum(1).tolist()
-        sequence_lengths.extend(real_tokens)
+    if args.streaming:
+        sequence_lengths = get_sequence_lengths(input_files, args.num_packing_workers)
+    else:
+        for data in tqdm(dataset):
+            # Use data[1] because data[0] could contain false "0"s
+            real_tokens = (data[1] != 0).sum(1).tolist()
+            sequence_lengths.extend(real_tokens)
 
     print(f"Done looping through dataset. Took {time.time() - start:3.3f} seconds to read {len(sequence_lengths)} sequences")
 
@@ -575,10 +663,18 @@ if __name__ == "__main__":
     # Run the packing algorithm on these sequence lengths
     strategy_set, mixture, padding = get_packing_recipe(args, sequence_lengths, drop_unused_strategies=True)
     target_num_sequences = int(mixture.sum())
-    examples_by_length = defaultdict(list)
+    memory_limit = None if args.max_memory_gb is None else int(args.max_memory_gb * 1024**3)
+    spill_dir = args.spill_dir or os.path.join(args.output_dir, "spill")
+    examples_by_length = ExampleBins(memory_limit, spill_dir)
     print("Adding padding sequence to pack the remainder of sequences.")
     for i in range(1, args.sequence_length + 1):
-        examples_by_length[i].extend([None] * int(padding[i - 1]))
+        examples_by_length.add_padding(i, int(padding[i - 1]))
+    # In streaming mode, only the number of sequences of each length used by the mixture
+    # are kept, a random selection, and the other examples are dropped as soon as they are read.
+    length_sampler = None
+    if args.streaming:
+        length_sampler = LengthSampler(get_length_budget(strategy_set, mixture, padding, args.sequence_length),
+                                       sequence_lengths)
 
     # Set the maximum number of sequences to write per output file.
     SEQUENCES_PER_FILE = 1000000
@@ -589,6 +685,7 @@ if __name__ == "__main__":
     count_at_last_slice = 0
     write_count = 0
     example_slices_buffer = []
+    example_slices_buffer_nbytes = 0
     packs_buffer = []
     packs_futures = []
     packing_executor = ProcessPoolExecutor(max_workers=args.num_packing_workers)
@@ -600,26 +697,35 @@ if __name__ == "__main__":
         real_tokens = np.sum(data_as_arrays[1] != 0, axis=1).tolist()
         # Individual examples must be copied to ensure no references are held to the original (even if cloned) tensors in `data`.
         for i, length in enumerate(real_tokens):
-            examples_by_length[length].append([np.array(d[i]) for d in data_as_arrays])
+            if length_sampler is not None and not length_sampler.keep(length):
+                continue
+            examples_by_length.add(length, [np.array(d[i]) for d in data_as_arrays])
         del data_as_arrays
         count += len(real_tokens)
 
         seen_all_examples = force_pack = force_write = count == len(sequence_lengths)
-        if count - count_at_last_slice >= SEQUENCES_PER_FILE or seen_all_examples:
+        if count - count_at_last_slice >= SEQUENCES_PER_FILE or seen_all_examples or \
+                examples_by_length.over_limit(example_slices_buffer_nbytes):
             count_at_last_slice = count
             # Shuffle the data
-            for key in examples_by_length:
-                random.shuffle(examples_by_length[key])
+            examples_by_length.shuffle()
             example_slices, strategies, mixture, total_packs_to_be_written = slice_examples(examples_by_length, strategy_set, mixture)
             for example_slice in example_slices:
                 example_slices_buffer.extend(zip(*example_slice))
-
-        while len(example_slices_buffer) >= PACKS_PER_FILE or force_pack:
+                example_slices_buffer_nbytes += example_slices_nbytes(zip(*example_slice))
+            if examples_by_length.over_limit(example_slices_buffer_nbytes):
+                examples_by_length.spill(example_slices_buffer_nbytes)
+
+        # The examples waiting to be packed count towards the memory limit, if spilling
+        # the bins was not enough they are packed before the buffer is full
+        while len(example_slices_buffer) >= PACKS_PER_FILE or force_pack or \
+                examples_by_length.over_limit(example_slices_buffer_nbytes):
             if len(packs_futures) > 0:
                 packs_buffer.extend(realise_futures(packs_futures))
                 packs_futures = []
 
             example_slices_to_pack, example_slices_buffer = example_slices_buffer[:PACKS_PER_FILE], example_slices_buffer[PACKS_PER_FILE:]
+            example_slices_buffer_nbytes -= example_slices_nbytes(example_slices_to_pack)
             force_pack = force_pack and len(example_slices_buffer) > 0
             packs_futures = submit_example_slices_for_packing(args, packing_executor, example_slices_to_pack)
             del example_slices_to_pack
@@ -649,6 +755,8 @@ if __name__ == "__main__":
 
     assert len(packs_futures) == 0
     packing_executor.shutdown(wait=True)
+    if os.path.exists(spill_dir):
+        shutil.rmtree(spill_dir)
 
     print(f"\n-----------------------------------------------------------")
     print(f"Packing took: {time.time() - start:3.2f} seconds.",
@@ -13,17 +13,21 @@
 # limitations under the License.
 
 import glob
+import json
+import mmap
 import multiprocessing
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import numpy as np
 import torch
-from torch.utils.data import IterableDataset, Dataset
+from torch.utils.data import IterableDataset, Dataset, Sampler
 from poptorch import DataLoader
 from poptorch.enums import DataLoaderMode
 import popdist
 from transformers import BertTokenizerFast
+from tfrecord import example_pb2
 from tfrecord.reader import tfrecord_loader
+from utils import logger
 
 
 TFRECORD_KEYS = (           # Torch Model Keys
@@ -147,6 +151,384 @@ class TFRecordPretrainingDataset(IterableDataset):
         return datum
 
 
+def decode_example(record, keys):
+    """Decode the features `keys` of a serialized tf.train.Example into numpy arrays."""
+    example = example_pb2.Example()
+    example.ParseFromString(record)
+    features = example.features.feature
+    datum = []
+    for key in keys:
+        feature = features[key]
+        kind = feature.WhichOneof("kind")
+        if kind == "int64_list":
+            datum.append(np.array(feature.int64_list.value, dtype=np.int64))
+        elif kind == "float_list":
+            datum.append(np.array(feature.float_list.value, dtype=np.float32))
+        else:
+            datum.append(np.frombuffer(feature.bytes_list.value[0], dtype=np.uint8))
+    return datum
+
+
+class IndexedTFRecordPretrainingDataset(Dataset):
+    """
+    Preprocessed BERT pretraining dataset with random access to TFRecord files.
+
+    The `.index` files of all the TFRecord files are loaded once into a single
+    array of (offset, length), so any example can be decoded directly from the
+    memory-mapped TFRecord file. This allows global shuffling with a sampler
+    and resuming mid-epoch without reading the skipped examples.
+
+    Parameters
+    ----------
+    files: List of TFRecord files containing the preprocessed pretraining data
+    packed_data: Use packed data?
+    """
+    def __init__(self, input_files, packed_data=False):
+        self.files = sorted(expand_glob_files(input_files))
+        if packed_data:
+            self.tfrecord_keys = TFRECORD_KEYS_PACKED
+        else:
+            self.tfrecord_keys = TFRECORD_KEYS
+        index = [np.fromfile(f.replace(".tfrecord", ".index"), dtype=np.int64, sep=" ").reshape(-1, 2)
+                 for f in self.files]
+        self.file_ids = np.repeat(np.arange(len(self.files), dtype=np.int32), [len(i) for i in index])
+        self.index = np.concatenate(index)
+        self._mmaps = {}
+
+    def __getstate__(self):
+        # Memory maps are re-opened in each worker
+        state = self.__dict__.copy()
+        state["_mmaps"] = {}
+        return state
+
+    def _mmap(self, file_id):
+        if file_id not in self._mmaps:
+            with open(self.files[file_id], "rb") as f:
+                self._mmaps[file_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmaps[file_id]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        offset, length = self.index[idx]
+        data = self._mmap(self.file_ids[idx])
+        # A record is stored as length (8 bytes), length crc (4), data, data crc (4)
+        return decode_example(data[offset + 12:offset + length - 4], self.tfrecord_keys)
+
+
+class ColumnarPretrainingDataset(Dataset):
+    """
+    Preprocessed BERT pretraining dataset in the columnar format written by
+    `data/convert_to_columnar.py`.
+
+    Each feature is a memory-mapped [num_samples, width] array stored in a
+    narrow dtype (uint16 token ids, uint8 masks), so reading examples is a
+    slice of the column files, widened to the dtype of the original feature.
+
+    Parameters
+    ----------
+    input_files: List with the folder of the columnar dataset
+    packed_data: Use packed data?
+    """
+    def __init__(self, input_files, packed_data=False):
+        input_dirs = expand_glob_files(input_files)
+        if len(input_dirs) != 1:
+            raise ValueError(f"Expected a single columnar dataset folder, got {input_dirs}")
+        self.path = input_dirs[0]
+        with open(os.path.join(self.path, "columns.json")) as f:
+            metadata = json.load(f)
+        self.num_samples = metadata["num_samples"]
+        self.columns = metadata["columns"]
+        self.tfrecord_keys = TFRECORD_KEYS_PACKED if packed_data else TFRECORD_KEYS
+        missing = [key for key in self.tfrecord_keys if key not in self.columns]
+        if missing:
+            raise ValueError(f"Columnar dataset {self.path} does not contain the features {missing}")
+        self._memmaps = None
+
+    def __getstate__(self):
+        # Memory maps are re-opened in each worker
+        state = self.__dict__.copy()
+        state["_memmaps"] = None
+        return state
+
+    @property
+    def memmaps(self):
+        if self._memmaps is None:
+            self._memmaps = [np.memmap(os.path.join(self.path, f"{key}.bin"),
+                                       dtype=self.columns[key]["dtype"],
+                                       mode="r",
+                                       shape=(self.num_samples, self.columns[key]["width"]))
+                             for key in self.tfrecord_keys]
+        return self._memmaps
+
+    def __len__(self):
+        return self.num_samples
+
+    def get_batch(self, indices):
+        """
+        Read the examples `indices` (a slice or an array of indices) as a list of
+        [batch_size, width] arrays, one for each feature.
+        """
+        return [column[indices].astype(self.columns[key]["feature_dtype"])
+                for key, column in zip(self.tfrecord_keys, self.memmaps)]
+
+    def __getitem__(self, idx):
+        return self.get_batch(idx)
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Samples a global permutation of the dataset, different for each epoch, and
+    shared by all instances which each take a strided part of it.
+
+    Setting `start_index` (the number of samples already seen by this instance)
+    before iterating resumes exactly where a previous run stopped. Each epoch
+    only consumes whole steps, the samples left over at the end of an epoch are
+    dropped by the data loader.
+
+    Parameters
+    ----------
+    data_source: Map-style dataset
+    seed: Random seed of the permutations
+    shuffle: Shuffle the data?
+    num_instances: Number of instances sharing the dataset
+    instance_index: Index of this instance
+    samples_per_step: Number of samples of this instance consumed by each step
+    """
+    def __init__(self, data_source, seed, shuffle=True, num_instances=1, instance_index=0, samples_per_step=1):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.shuffle = shuffle
+        self.num_instances = num_instances
+        self.instance_index = instance_index
+        self.samples_per_step = samples_per_step
+        self.start_index = 0
+
+    def __len__(self):
+        return self.num_samples // self.num_instances
+
+    def samples_per_epoch(self):
+        return len(self) // self.samples_per_step * self.samples_per_step
+
+    def __iter__(self):
+        epoch, start = divmod(self.start_index, self.samples_per_epoch())
+        if self.shuffle:
+            order = np.random.default_rng((self.seed, epoch)).permutation(self.num_samples)
+        else:
+            order = np.arange(self.num_samples)
+        order = order[self.instance_index::self.num_instances][:len(self)]
+        # The next iteration starts with the next epoch
+        self.start_index = (epoch + 1) * self.samples_per_epoch()
+        return iter(order[start:].tolist())
+
+
+def pack_sequences(multi_sequence, mask_tokens, sequence_length, max_sequences_per_pack):
+    """Combines a list of sequences into a single pack
+
+    Parameters
+    ----------
+    multi_sequence:list of sequences, each sequence is a tuple of numpy arrays
+        The un-packed sequences in the TFRECORD_KEYS format. Entries which are
+        "None" represent padding sequences.
+    mask_tokens:int
+        The maximum number of masked lm predictions in each unpacked sequence.
+    sequence_length:int
+        The sequence length to which sequence in the multi_sequence will be packed.
+    max_sequence_per_pack:int
+        This value must be the same for all packs in the dataset as it determines the
+        data format. Represents the maximum number of sequences that a pack may contain.
+
+    Returns
+    -------
+    packed:tuple of numpy arrays in the TFRECORD_KEYS_PACKED format, or None if the
+        sequences have more masked tokens in total than the pack can hold.
+    """
+    # SEQ
+    packed_input_ids = np.zeros(sequence_length, dtype=np.int32)
+    packed_input_mask = np.zeros(sequence_length, dtype=np.int32)
+    packed_segment_ids = np.zeros(sequence_length, dtype=np.int32)
+    packed_position_ids = np.zeros(sequence_length, dtype=np.int32)
+
+    # MLM
+    # It is assumed that each sequence in a pack has a (roughly) fixed percentage of MLM tokens.
+    # To account for the cases where this percentage is rounded up, additional mlm tokens are added
+    # e.g in a pack of sequence lengths [ 17  37 458], 15% represents [2.55 5.55 68.7] which is
+    # then rounded to  [3 6 69] or 78 tokens in total. This is equivalent to
+    # (mask_tokens + max_sequences_per_pack - 1 = 76 + 3 - 1).
+    packed_masked_lm_positions = np.zeros(mask_tokens + max_sequences_per_pack - 1, dtype=np.int32)
+    packed_masked_lm_ids = np.zeros(mask_tokens + max_sequences_per_pack - 1, dtype=np.int32)
+    packed_masked_lm_mask = np.zeros(mask_tokens + max_sequences_per_pack - 1, dtype=np.float32)
+
+    # NSP
+    packed_next_sentence_labels = np.zeros(max_sequences_per_pack, dtype=np.int32)
+    packed_next_sentence_mask = np.zeros(max_sequences_per_pack, dtype=np.float32)
+
+    # An offset of where to start writing the tokens
+    seq_offset = 0
+
+    # Where to write the next MLM token
+    mlm_offset = 0
+    sequence_index = 1  # used in the input mask
+    for sequence in multi_sequence:
+        # Padding sequences are denoted with None
+        if sequence is not None:
+            input_ids, input_mask, segment_ids, *sequence = sequence
+            masked_lm_positions, masked_lm_ids, next_sentence_labels = sequence
+            # Use input_mask because input_ids could contain false "0"s
+            seq_len = input_mask.sum()
+            mask_tokens_mask_idx = (masked_lm_positions != 0).sum()
+
+            # SEQ
+            # This writes all the normal sequence tokens excluding the [CLS] tokens
+            max_seq = seq_offset + seq_len - 1
+            packed_input_ids[seq_offset:max_seq] = input_ids[1:seq_len]
+            packed_input_mask[seq_offset:max_seq] = sequence_index
+            packed_segment_ids[seq_offset:max_seq] = segment_ids[1:seq_len]
+            packed_position_ids[seq_offset:max_seq] = np.arange(1, seq_len)
+
+            # MLM
+            max_mlm = mlm_offset + mask_tokens_mask_idx
+
+            # Very rarely, (1/10M) it can occur that a multi-sequence has more than the allowed
+            # number of cumulative mask_tokens, such multi-sequences are thrown away
+            try:
+                packed_masked_lm_positions[mlm_offset:max_mlm] = masked_lm_positions[:mask_tokens_mask_idx] - 1 + seq_offset
+            except ValueError:
+                return None
+
+            packed_masked_lm_ids[mlm_offset:max_mlm] = masked_lm_ids[:mask_tokens_mask_idx]
+            packed_masked_lm_mask[mlm_offset:max_mlm] = sequence_index
+
+            # NSP
+            # The NSP tokens are packed at the end of the sequence to enable slicing
+            packed_input_ids[-sequence_index] = input_ids[0]
+            packed_input_mask[-sequence_index] = sequence_index
+            packed_segment_ids[-sequence_index] = segment_ids[0]
+            packed_position_ids[-sequence_index] = 0
+            packed_next_sentence_labels[-sequence_index] = np.squeeze(next_sentence_labels)
+            packed_next_sentence_mask[-sequence_index] = 1
+
+            # Update offsets
+            sequence_index += 1
+            seq_offset = max_seq
+            mlm_offset = max_mlm
+
+    return (packed_input_ids, packed_input_mask, packed_segment_ids, packed_position_ids,
+            packed_masked_lm_positions, packed_masked_lm_ids, packed_masked_lm_mask,
+            packed_next_sentence_labels, packed_next_sentence_mask)
+
+
+def best_fit_decreasing(lengths, mlm_counts, sequence_length, max_sequences_per_pack, max_mlm_tokens):
+    """Pack sequences with the best-fit-decreasing heuristic.
+
+    The sequences are taken from longest to shortest and each one goes into the
+    open pack with the least remaining space it fits in (considering also the
+    number of sequences and of masked tokens per pack), or into a new pack.
+
+    Returns
+    -------
+    packs:list[list[int]]
+        The indices of the sequences in each pack.
+    """
+    packs = []
+    # Open packs indexed by their remaining number of tokens
+    packs_by_space = [[] for _ in range(sequence_length + 1)]
+    for i in np.argsort(-np.asarray(lengths), kind="stable"):
+        length, mlm_count = lengths[i], mlm_counts[i]
+        best = None
+        for space in range(length, sequence_length + 1):
+            for candidate in packs_by_space[space]:
+                if mlm_count <= max_mlm_tokens - candidate[1]:
+                    best = space, candidate
+                    break
+            if best is not None:
+                break
+        if best is None:
+            candidate = [len(packs), 0, []]
+            packs.append(candidate[2])
+            space = sequence_length
+        else:
+            space, candidate = best
+            packs_by_space[space].remove(candidate)
+        candidate[1] += mlm_count
+        candidate[2].append(i)
+        if len(candidate[2]) < max_sequences_per_pack and space > length:
+            packs_by_space[space - length].append(candidate)
+    return packs
+
+
+class OnlinePackedPretrainingDataset(IterableDataset):
+    """
+    Packs the sequences of an un-packed pretraining dataset on the fly.
+
+    A lookahead buffer of sequences is packed with best-fit-decreasing and the
+    resulting packs are yielded in the TFRECORD_KEYS_PACKED layout, as if read
+    from a dataset packed offline by data/packing/pack_pretraining_data.py.
+
+    Parameters
+    ----------
+    dataset: Un-packed dataset, e.g. TFRecordPretrainingDataset
+    sequence_length: Sequence length of the packs
+    mask_tokens: The maximum number of masked tokens in an un-packed sequence
+    max_sequences_per_pack: The maximum number of sequences in a pack
+    lookahead: The number of sequences packed together
+    packing_factor: Expected number of sequences per pack, used to estimate the length
+    """
+    def __init__(self,
+                 dataset,
+                 sequence_length,
+                 mask_tokens,
+                 max_sequences_per_pack=3,
+                 lookahead=1000,
+                 packing_factor=1.0):
+        self.dataset = dataset
+        self.sequence_length = sequence_length
+        self.mask_tokens = mask_tokens
+        self.max_sequences_per_pack = max_sequences_per_pack
+        self.lookahead = lookahead
+        self.packing_factor = packing_factor
+        self.real_tokens = 0
+        self.num_packs = 0
+
+    def __len__(self):
+        return int(len(self.dataset) / self.packing_factor)
+
+    @property
+    def packing_efficiency(self):
+        """Fraction of the tokens of the yielded packs which are not padding."""
+        return self.real_tokens / max(1, self.num_packs * self.sequence_length)
+
+    def pack(self, buffer):
+        lengths = [int(np.count_nonzero(datum[1])) for datum in buffer]
+        mlm_counts = [int(np.count_nonzero(datum[3])) for datum in buffer]
+        packs = best_fit_decreasing(lengths, mlm_counts, self.sequence_length, self.max_sequences_per_pack,
+                                    self.mask_tokens + self.max_sequences_per_pack - 1)
+        np.random.shuffle(packs)
+        for pack in packs:
+            packed = pack_sequences([buffer[i] for i in pack], self.mask_tokens,
+                                    self.sequence_length, self.max_sequences_per_pack)
+            if packed is None:
+                continue
+            self.real_tokens += sum(lengths[i] for i in pack)
+            self.num_packs += 1
+            # Same dtypes as the packed data read from TFRecord files
+            yield [a.astype(np.float32 if a.dtype == np.float32 else np.int64) for a in packed]
+
+    def __iter__(self):
+        self.real_tokens = 0
+        self.num_packs = 0
+        buffer = []
+        for datum in self.dataset:
+            buffer.append(datum)
+            if len(buffer) >= self.lookahead:
+                yield from self.pack(buffer)
+                buffer = []
+        yield from self.pack(buffer)
+        logger(f"Online packing: {self.num_packs} packs, "
+               f"packing efficiency (fraction of real tokens): {self.packing_efficiency:3.4f}")
+
+
 class GeneratedPretrainingDataset(Dataset):
     """
     Dataset that randomly generates mock BERT pretraining data.
@@ -220,6 +602,30 @@ def get_generated_datum(config):
     return result
 
 
+class _SampleIndices(Dataset):
+    """
+    Map-style view of a dataset returning the indices it is indexed with, so
+    that _BatchedReadCollate reads each batch with a single `get_batch`.
+    """
+    def __init__(self, dataset):
+        self.num_samples = len(dataset)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        return idx
+
+
+class _BatchedReadCollate:
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __call__(self, indices):
+        # Sorting the indices of the batch makes the reads sequential
+        return [torch.from_numpy(column) for column in self.dataset.get_batch(np.sort(indices))]
+
+
 class _WorkerInit:
     def __init__(self, seed):
         self.seed = seed
@@ -236,6 +642,37 @@ def get_dataloader(config, opts):
                                               config.samples_per_step,
                                               config.random_seed,
                                               packed_data=config.packed_data)
+    elif config.dataset == 'pretraining' and config.online_packing:
+        # config.mask_tokens already includes the extra MLM tokens of the packed format
+        dataset = OnlinePackedPretrainingDataset(TFRecordPretrainingDataset(config.input_files),
+                                                 config.sequence_length,
+                                                 config.mask_tokens - config.max_sequences_per_pack + 1,
+                                                 config.max_sequences_per_pack,
+                                                 config.packing_lookahead,
+                                                 config.packing_factor)
+    elif config.dataset == 'pretraining' and (config.random_access_data or config.columnar_data):
+        if config.columnar_data:
+            dataset = ColumnarPretrainingDataset(config.input_files, packed_data=config.packed_data)
+        else:
+            dataset = IndexedTFRecordPretrainingDataset(config.input_files, packed_data=config.packed_data)
+        sampler = ResumableRandomSampler(dataset, config.random_seed,
+                                         num_instances=config.popdist_size if config.use_popdist else 1,
+                                         instance_index=config.popdist_rank if config.use_popdist else 0,
+                                         samples_per_step=config.samples_per_step)
+        batch_args = {}
+        if config.columnar_data:
+            # Each batch is gathered from the columns at once instead of one example at a time
+            batch_args = dict(collate_fn=_BatchedReadCollate(dataset))
+            dataset = _SampleIndices(dataset)
+        return DataLoader(opts,
+                          dataset,
+                          batch_size=config.micro_batch_size,
+                          num_workers=config.dataloader_workers,
+                          worker_init_fn=_WorkerInit(config.random_seed),
+                          sampler=sampler,
+                          auto_distributed_partitioning=False,
+                          mode=DataLoaderMode.AsyncRebatched if config.async_dataloader else DataLoaderMode.Sync,
+                          **batch_args)
     elif config.dataset == 'pretraining':
         dataset = TFRecordPretrainingDataset(config.input_files, packed_data=config.packed_data)
     else:
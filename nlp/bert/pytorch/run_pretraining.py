@@ -23,7 +23,7 @@ import logging
 import torch
 import transformers
 from poptorch import trainingModel
-from pretraining_data import get_dataloader, get_generated_datum
+from pretraining_data import get_dataloader, get_generated_datum, ResumableRandomSampler
 from modeling import PipelinedBertForPretraining, PipelinedPackedBertForPretraining
 from ipu_options import get_options
 from optimization import get_lr_scheduler, get_optimizer
@@ -76,6 +76,7 @@ if __name__ == "__main__":
     start_loading = time.perf_counter()
     loader = get_dataloader(config, opts)
     steps_per_epoch = len(loader)
+    sampler = loader.sampler
     loader = cycle(loader)
     if steps_per_epoch < 1:
         raise RuntimeError("Not enough data in input_files for current configuration, "
@@ -103,8 +104,12 @@ if __name__ == "__main__":
             checkpoint_metrics = training_state["metrics"]
             logger(f"---- Forwarding Data Loader until Checkpoint Step {steps_finished} ----")
             start_data_forward = time.perf_counter()
-            for step in range(steps_finished + 1):
-                next(loader)
+            if isinstance(sampler, ResumableRandomSampler):
+                # Skip the samples already seen without reading them
+                sampler.start_index = (steps_finished + 1) * config.samples_per_step
+            else:
+                for step in range(steps_finished + 1):
+                    next(loader)
             duration_data_forward = time.perf_counter() - start_data_forward
             logger(f"Data loader forwarded in {duration_data_forward} secs")
             logger("-----------------------------------------------------------")
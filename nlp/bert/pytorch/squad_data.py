@@ -146,15 +146,41 @@ def prepare_validation_features(examples):
     return tokenized_examples
 
 
-# `postprocess_qa_predictions` comes unmodified from
+def best_indexes(logits, n_best_size):
+    """
+    Indexes of the `n_best_size` greater logits of each row of `logits`, in decreasing
+    order of the logits, found with a partial sort.
+    """
+    n_best_size = min(n_best_size, logits.shape[1])
+    indexes = np.argpartition(-logits, n_best_size - 1, axis=1)[:, :n_best_size]
+    order = np.argsort(-np.take_along_axis(logits, indexes, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(indexes, order, axis=1)
+
+
+def context_offsets(offset_mappings, indexes, side):
+    """
+    Character offsets of the start (side=0) or end (side=1) of the tokens at `indexes`
+    of each feature, or -1 for the tokens out of the context.
+    """
+    offsets = []
+    for offset_mapping, feature_indexes in zip(offset_mappings, indexes.tolist()):
+        offsets.append([offset_mapping[index][side] if index < len(offset_mapping) and offset_mapping[index] else -1
+                        for index in feature_indexes])
+    return np.array(offsets, dtype=np.int64).reshape(indexes.shape)
+
+
+# `postprocess_qa_predictions` is adapted from
 # https://github.com/huggingface/notebooks/blob/master/examples/question_answering.ipynb
+# to score the spans of the n-best start and end logits of all the features at once
+# and only extract the text of the best answer of each example.
 def postprocess_qa_predictions(examples, features, raw_predictions, n_best_size=20, max_answer_length=30, squad_v2=False):
-    all_start_logits, all_end_logits = raw_predictions
+    num_features = len(features)
+    all_start_logits, all_end_logits = (np.asarray(logits)[:num_features] for logits in raw_predictions)
     # Build a map example to its corresponding features.
     example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
     features_per_example = collections.defaultdict(list)
-    for i, feature in enumerate(features):
-        features_per_example[example_id_to_index[feature["example_id"]]].append(i)
+    for i, example_id in enumerate(features["example_id"]):
+        features_per_example[example_id_to_index[example_id]].append(i)
 
     # The dictionaries we have to fill.
     predictions = collections.OrderedDict()
@@ -162,70 +188,53 @@ def postprocess_qa_predictions(examples, features, raw_predictions, n_best_size=
     # Logging.
     print(f"Post-processing {len(examples)} example predictions split into {len(features)} features.")
 
+    # Go through all possibilities for the `n_best_size` greater start and end logits.
+    start_indexes = best_indexes(all_start_logits, n_best_size)
+    end_indexes = best_indexes(all_end_logits, n_best_size)
+    # This is what will allow us to map the positions in our logits to span of texts in the original context.
+    offset_mappings = features["offset_mapping"]
+    start_chars = context_offsets(offset_mappings, start_indexes, 0)
+    end_chars = context_offsets(offset_mappings, end_indexes, 1)
+
+    # Score all the [start, end] pairs, with -inf for the answers out of the context
+    # or with a length that is either < 0 or > max_answer_length.
+    scores = (np.take_along_axis(all_start_logits, start_indexes, axis=1)[:, :, np.newaxis] +
+              np.take_along_axis(all_end_logits, end_indexes, axis=1)[:, np.newaxis, :])
+    lengths = end_indexes[:, np.newaxis, :] - start_indexes[:, :, np.newaxis] + 1
+    valid = ((start_chars >= 0)[:, :, np.newaxis] & (end_chars >= 0)[:, np.newaxis, :] &
+             (lengths > 0) & (lengths <= max_answer_length))
+    scores = np.where(valid, scores, -np.inf).reshape(num_features, -1)
+    best_spans = np.argmax(scores, axis=1)
+    best_scores = scores[np.arange(num_features), best_spans]
+    best_start_ranks, best_end_ranks = np.divmod(best_spans, end_indexes.shape[1])
+
+    # Null prediction score of each feature.
+    cls_indexes = np.argmax(np.array(features["input_ids"]) == tokenizer.cls_token_id, axis=1)
+    null_scores = (np.take_along_axis(all_start_logits, cls_indexes[:, np.newaxis], axis=1) +
+                   np.take_along_axis(all_end_logits, cls_indexes[:, np.newaxis], axis=1))[:, 0]
+
     # Let's loop over all the examples!
-    for example_index, example in enumerate(tqdm(examples)):
+    for example_index, (example_id, context) in enumerate(tqdm(zip(examples["id"], examples["context"]), total=len(examples))):
         # Those are the indices of the features associated to the current example.
         feature_indices = features_per_example[example_index]
 
-        min_null_score = None  # Only used if squad_v2 is True.
-        valid_answers = []
-
-        context = example["context"]
-        # Looping through all the features associated to the current example.
-        for feature_index in feature_indices:
-            # We grab the predictions of the model for this feature.
-            start_logits = all_start_logits[feature_index]
-            end_logits = all_end_logits[feature_index]
-            # This is what will allow us to map some the positions in our logits to span of texts in the original
-            # context.
-            offset_mapping = features[feature_index]["offset_mapping"]
-
-            # Update minimum null prediction.
-            cls_index = features[feature_index]["input_ids"].index(tokenizer.cls_token_id)
-            feature_null_score = start_logits[cls_index] + end_logits[cls_index]
-            if min_null_score is None or min_null_score < feature_null_score:
-                min_null_score = feature_null_score
-
-            # Go through all possibilities for the `n_best_size` greater start and end logits.
-            start_indexes = np.argsort(start_logits)[-1: -n_best_size - 1: -1].tolist()
-            end_indexes = np.argsort(end_logits)[-1: -n_best_size - 1: -1].tolist()
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # Don't consider out-of-scope answers, either because the indices are out of bounds or correspond
-                    # to part of the input_ids that are not in the context.
-                    if start_index >= len(offset_mapping) \
-                       or end_index >= len(offset_mapping) \
-                       or offset_mapping[start_index] is None \
-                       or offset_mapping[end_index] is None \
-                       or offset_mapping[start_index] == [] \
-                       or offset_mapping[end_index] == []:
-                        continue
-                    # Don't consider answers with a length that is either < 0 or > max_answer_length.
-                    if end_index < start_index or end_index - start_index + 1 > max_answer_length:
-                        continue
-
-                    start_char = offset_mapping[start_index][0]
-                    end_char = offset_mapping[end_index][1]
-                    valid_answers.append(
-                        {
-                            "score": start_logits[start_index] + end_logits[end_index],
-                            "text": context[start_char: end_char]
-                        }
-                    )
-
-        if len(valid_answers) > 0:
-            best_answer = sorted(valid_answers, key=lambda x: x["score"], reverse=True)[0]
-        else:
-            # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
-            # failure.
-            best_answer = {"text": "", "score": 0.0}
+        # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
+        # failure.
+        best_answer = {"text": "", "score": 0.0}
+        if feature_indices:
+            feature_index = feature_indices[np.argmax(best_scores[feature_indices])]
+            if best_scores[feature_index] > -np.inf:
+                start_char = start_chars[feature_index, best_start_ranks[feature_index]]
+                end_char = end_chars[feature_index, best_end_ranks[feature_index]]
+                best_answer = {"text": context[start_char: end_char], "score": best_scores[feature_index]}
 
         # Let's pick our final answer: the best one or the null answer (only for squad_v2)
         if not squad_v2:
-            predictions[example["id"]] = best_answer["text"]
+            predictions[example_id] = best_answer["text"]
         else:
+            min_null_score = np.max(null_scores[feature_indices])
             answer = best_answer["text"] if best_answer["score"] > min_null_score else ""
-            predictions[example["id"]] = answer
+            predictions[example_id] = answer
 
     return predictions
 
@@ -57,3 +57,91 @@ def test_packing_script():
             break
     assert (time > 0)
     assert (packs_left == 0.0)
+
+
+def test_example_bins_spill(tmp_path):
+    from data.packing.pack_pretraining_data import ExampleBins
+    import numpy as np
+    import random
+
+    bins = ExampleBins(memory_limit=10 * 2 * 128 * 4, spill_dir=str(tmp_path))
+    bins.add_padding(3, 2)
+    for i in range(40):
+        example = [np.full(128, i, dtype=np.int32), np.ones(128, dtype=np.int32)]
+        bins.add(5 + i % 2, example)
+        if bins.over_limit():
+            bins.spill()
+    assert not bins.over_limit()
+    assert len(list(tmp_path.iterdir())) > 0
+    assert bins.count(3) == 2 and bins.count(5) == 20 and bins.count(6) == 20
+
+    taken = bins.take(5, 20) + bins.take(6, 20)
+    assert sorted(int(example[0][0]) for example in taken) == list(range(40))
+    assert bins.count(5) == 0 and bins.count(6) == 0 and bins.nbytes == 0
+    assert bins.take(3, 2) == [None, None]
+    assert len(list(tmp_path.iterdir())) == 0
+
+    # The examples waiting to be packed count towards the limit
+    for i in range(8):
+        bins.add(5, [np.full(128, i, dtype=np.int32), np.ones(128, dtype=np.int32)])
+    assert not bins.over_limit() and bins.over_limit(extra_nbytes=4 * 2 * 128 * 4)
+    bins.spill(extra_nbytes=4 * 2 * 128 * 4)
+    assert bins.nbytes == 0 and bins.count(5) == 8
+
+    # Unspilled examples are mixed with the examples which stayed in memory
+    random.seed(0)
+    bins.add(5, [np.full(128, 8, dtype=np.int32), np.ones(128, dtype=np.int32)])
+    taken = [int(example[0][0]) for example in bins.take(5, 9)]
+    assert sorted(taken) == list(range(9)) and taken != list(range(8)) + [8]
+
+
+def test_length_sampler():
+    from data.packing.pack_pretraining_data import LengthSampler
+    import numpy as np
+    import random
+
+    random.seed(0)
+    sequence_lengths = np.array([3, 5] * 500)
+    budget = np.array([0, 0, 0, 100, 0, 500])
+    sampler = LengthSampler(budget, sequence_lengths)
+    kept = [i for i, length in enumerate(sequence_lengths) if sampler.keep(length)]
+
+    kept_lengths = sequence_lengths[kept]
+    assert (kept_lengths == 3).sum() == 100 and (kept_lengths == 5).sum() == 500
+    # The kept sequences are spread over the whole dataset, not the first ones read
+    kept_3 = [i for i in kept if sequence_lengths[i] == 3]
+    assert kept_3[-1] > len(sequence_lengths) // 2
+
+
+def test_online_packing():
+    from pretraining_data import OnlinePackedPretrainingDataset
+    import numpy as np
+
+    sequence_length, mask_tokens, max_sequences_per_pack = 64, 10, 3
+    rng = np.random.default_rng(0)
+    dataset = []
+    for _ in range(200):
+        length = int(rng.integers(5, sequence_length + 1))
+        num_masked = int(rng.integers(1, min(mask_tokens, length - 1) + 1))
+        input_ids = np.zeros(sequence_length, dtype=np.int64)
+        input_ids[:length] = rng.integers(1, 1000, length)
+        input_mask = (np.arange(sequence_length) < length).astype(np.int64)
+        masked_lm_positions = np.zeros(mask_tokens, dtype=np.int64)
+        masked_lm_positions[:num_masked] = np.sort(rng.choice(np.arange(1, length), num_masked, replace=False))
+        masked_lm_ids = np.zeros(mask_tokens, dtype=np.int64)
+        masked_lm_ids[:num_masked] = input_ids[masked_lm_positions[:num_masked]]
+        dataset.append([input_ids, input_mask, np.zeros_like(input_ids), masked_lm_positions,
+                        masked_lm_ids, np.array([1])])
+
+    packed_dataset = OnlinePackedPretrainingDataset(dataset, sequence_length, mask_tokens,
+                                                    max_sequences_per_pack, lookahead=64)
+    packs = list(packed_dataset)
+    assert len(packs) < len(dataset)
+    assert packed_dataset.real_tokens == sum(int(d[1].sum()) for d in dataset)
+    assert 0.5 < packed_dataset.packing_efficiency <= 1.0
+    for pack in packs:
+        input_ids, input_mask, _, _, mlm_positions, mlm_ids, mlm_mask, _, nsp_mask = pack
+        assert len(input_ids) == sequence_length
+        assert len(mlm_positions) == mask_tokens + max_sequences_per_pack - 1
+        assert input_mask.max() == nsp_mask.sum() <= max_sequences_per_pack
+        np.testing.assert_array_equal(input_ids[mlm_positions[mlm_mask > 0]], mlm_ids[mlm_mask > 0])
@@ -0,0 +1,135 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import time
+import numpy as np
+import pytest
+from squad_data import tokenizer, prepare_validation_features, postprocess_qa_predictions
+
+
+def reference_postprocess_qa_predictions(examples, features, raw_predictions, n_best_size=20, max_answer_length=30, squad_v2=False):
+    # The loop over the n-best start and end logits of each feature of
+    # https://github.com/huggingface/notebooks/blob/master/examples/question_answering.ipynb
+    all_start_logits, all_end_logits = raw_predictions
+    example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
+    features_per_example = collections.defaultdict(list)
+    for i, feature in enumerate(features):
+        features_per_example[example_id_to_index[feature["example_id"]]].append(i)
+
+    predictions = collections.OrderedDict()
+    for example_index, example in enumerate(examples):
+        min_null_score = None
+        valid_answers = []
+        for feature_index in features_per_example[example_index]:
+            start_logits = all_start_logits[feature_index]
+            end_logits = all_end_logits[feature_index]
+            offset_mapping = features[feature_index]["offset_mapping"]
+            cls_index = features[feature_index]["input_ids"].index(tokenizer.cls_token_id)
+            feature_null_score = start_logits[cls_index] + end_logits[cls_index]
+            if min_null_score is None or min_null_score < feature_null_score:
+                min_null_score = feature_null_score
+            start_indexes = np.argsort(start_logits)[-1: -n_best_size - 1: -1].tolist()
+            end_indexes = np.argsort(end_logits)[-1: -n_best_size - 1: -1].tolist()
+            for start_index in start_indexes:
+                for end_index in end_indexes:
+                    if start_index >= len(offset_mapping) \
+                       or end_index >= len(offset_mapping) \
+                       or not offset_mapping[start_index] \
+                       or not offset_mapping[end_index]:
+                        continue
+                    if end_index < start_index or end_index - start_index + 1 > max_answer_length:
+                        continue
+                    valid_answers.append({
+                        "score": start_logits[start_index] + end_logits[end_index],
+                        "text": example["context"][offset_mapping[start_index][0]: offset_mapping[end_index][1]]
+                    })
+        if valid_answers:
+            best_answer = sorted(valid_answers, key=lambda x: x["score"], reverse=True)[0]
+        else:
+            best_answer = {"text": "", "score": 0.0}
+        if squad_v2 and best_answer["score"] <= min_null_score:
+            predictions[example["id"]] = ""
+        else:
+            predictions[example["id"]] = best_answer["text"]
+    return predictions
+
+
+class Table(object):
+    # The columns and rows access of a `datasets.Dataset`
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return [row[key] for row in self.rows]
+        return self.rows[key]
+
+
+def random_features(num_examples, sequence_length, rng):
+    examples = []
+    features = []
+    for e in range(num_examples):
+        context = "".join(rng.choice(list("abcdef "), size=1000))
+        examples.append({"id": str(e), "context": context})
+        for _ in range(rng.integers(1, 3)):
+            question_length = rng.integers(5, 30)
+            context_length = rng.integers(10, sequence_length - question_length - 3)
+            padding_length = sequence_length - question_length - context_length - 3
+            start = rng.integers(0, 500)
+            features.append({
+                "example_id": str(e),
+                "input_ids": [tokenizer.cls_token_id] + [1] * (question_length + context_length + 2) + [0] * padding_length,
+                "offset_mapping": ([None] * (question_length + 2) +
+                                   [(start + 2 * i, start + 2 * i + 1) for i in range(context_length)] +
+                                   [None] * (padding_length + 1))})
+    return Table(examples), Table(features)
+
+
+@pytest.mark.parametrize("squad_v2", [False, True])
+def test_postprocess_qa_predictions(squad_v2):
+    rng = np.random.default_rng(0)
+    sequence_length = 128
+    examples, features = random_features(200, sequence_length, rng)
+    # The raw predictions can be padded to a whole number of batches
+    raw_predictions = list(rng.normal(size=(2, len(features) + 5, sequence_length)).astype(np.float32))
+
+    predictions = postprocess_qa_predictions(examples, features, raw_predictions, squad_v2=squad_v2)
+    assert predictions == reference_postprocess_qa_predictions(examples, features, raw_predictions, squad_v2=squad_v2)
+
+
+@pytest.mark.skip_longtest_needs_dataset
+def test_postprocess_qa_predictions_squad_dev():
+    from datasets import load_dataset
+    examples = load_dataset("squad")["validation"]
+    features = examples.map(prepare_validation_features,
+                            batched=True,
+                            remove_columns=examples.column_names)
+    rng = np.random.default_rng(0)
+    raw_predictions = list(rng.normal(size=(2, len(features), len(features[0]["input_ids"]))).astype(np.float32))
+
+    start = time.perf_counter()
+    predictions = postprocess_qa_predictions(examples, features, raw_predictions)
+    duration = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = reference_postprocess_qa_predictions(examples, features, raw_predictions)
+    reference_duration = time.perf_counter() - start
+    print(f"Post-processing of the SQuAD dev set: {duration:.1f}s, reference: {reference_duration:.1f}s")
+    assert predictions == reference
@@ -253,3 +253,95 @@ def test_wikipedia_dataset():
     assert (0.09 < replacement_counts["same"] < 0.11)
     assert (0.09 < replacement_counts["random"] < 0.11)
     assert (0.14 < total / num_tokens < 0.16)  # should be ~0.15
+
+
+def test_indexed_dataset_matches_tfrecord_loader():
+    """
+    Random access reads of the indexed dataset give the same examples as
+    reading the TFRecord file sequentially.
+    """
+    from pathlib import Path
+    from tfrecord.reader import tfrecord_loader
+    from pretraining_data import IndexedTFRecordPretrainingDataset, ResumableRandomSampler, TFRECORD_KEYS
+
+    filename = str(Path(__file__).parent.parent / "data" / "sample_text.tfrecord")
+    expected = list(tfrecord_loader(filename, None, list(TFRECORD_KEYS)))
+    dataset = IndexedTFRecordPretrainingDataset([filename])
+    assert len(dataset) == len(expected)
+    for i in reversed(range(len(dataset))):
+        for value, key in zip(dataset[i], TFRECORD_KEYS):
+            np.testing.assert_array_equal(value, expected[i][key])
+            assert value.dtype == expected[i][key].dtype
+
+    # Resuming mid-epoch continues the same global permutation
+    sampler = ResumableRandomSampler(dataset, seed=42)
+    first_epochs = list(sampler) + list(sampler)
+    resumed = ResumableRandomSampler(dataset, seed=42)
+    resumed.start_index = 10
+    assert list(resumed) + list(resumed) == first_epochs[10:]
+    assert sorted(first_epochs[:len(dataset)]) == list(range(len(dataset)))
+
+
+def test_sampler_resumes_after_first_epoch():
+    """
+    Resuming after the first epoch skips the samples dropped at the end of
+    each epoch.
+    """
+    from pretraining_data import ResumableRandomSampler
+
+    def consumed_samples(sampler, num_epochs):
+        # Like the data loader, only whole steps are consumed in each epoch
+        samples = []
+        for _ in range(num_epochs):
+            epoch = list(sampler)
+            samples += epoch[:len(epoch) // sampler.samples_per_step * sampler.samples_per_step]
+        return samples
+
+    samples_per_step = 4
+    dataset = list(range(30))
+    expected = consumed_samples(ResumableRandomSampler(dataset, seed=42, samples_per_step=samples_per_step), 4)
+    assert len(expected) == 4 * 28
+    for steps_finished in [3, 7, 10, 15]:
+        resumed = ResumableRandomSampler(dataset, seed=42, samples_per_step=samples_per_step)
+        resumed.start_index = steps_finished * samples_per_step
+        assert consumed_samples(resumed, 3)[:4 * samples_per_step] == \
+            expected[steps_finished * samples_per_step:(steps_finished + 4) * samples_per_step]
+
+
+def test_columnar_dataset_matches_tfrecord_loader(tmp_path):
+    """
+    The columnar dataset stores the features in narrow types and reads back
+    the same examples as the TFRecord file.
+    """
+    from pathlib import Path
+    from tfrecord.reader import tfrecord_loader
+    from data.convert_to_columnar import convert_to_columnar
+    from pretraining_data import ColumnarPretrainingDataset, TFRECORD_KEYS
+
+    filename = str(Path(__file__).parent.parent / "data" / "sample_text.tfrecord")
+    expected = list(tfrecord_loader(filename, None, list(TFRECORD_KEYS)))
+    metadata = convert_to_columnar([filename], str(tmp_path))
+    assert metadata["num_samples"] == len(expected)
+    assert metadata["file_num_samples"] == [len(expected)]
+    assert metadata["columns"]["input_ids"]["dtype"] == "uint16"
+    assert metadata["columns"]["input_mask"]["dtype"] == "uint8"
+
+    dataset = ColumnarPretrainingDataset([str(tmp_path)])
+    assert len(dataset) == len(expected)
+    for i in range(len(dataset)):
+        for value, key in zip(dataset[i], TFRECORD_KEYS):
+            np.testing.assert_array_equal(value, expected[i][key])
+            assert value.dtype == expected[i][key].dtype
+
+    indices = np.array([3, 1, 4])
+    for column, key in zip(dataset.get_batch(indices), TFRECORD_KEYS):
+        np.testing.assert_array_equal(column, np.stack([expected[i][key] for i in indices]))
+
+    # The batched reads of the data loader return the same batches as reading one example at a time
+    import torch
+    from torch.utils.data import DataLoader
+    from pretraining_data import _BatchedReadCollate, _SampleIndices
+    batched = DataLoader(_SampleIndices(dataset), batch_size=3, collate_fn=_BatchedReadCollate(dataset))
+    for batch, expected_batch in zip(batched, DataLoader(dataset, batch_size=3)):
+        for column, expected_column in zip(batch, expected_batch):
+            assert torch.equal(column, expected_column)
@@ -18,6 +18,7 @@ import json
 import math
 from collections import OrderedDict, defaultdict, namedtuple
 
+import numpy as np
 import six
 import tensorflow.compat.v1 as tf
 from log import logger
@@ -138,6 +139,61 @@ def _get_best_indexes(logits, n_best_size):
     return best_indexes
 
 
+def _get_best_indexes_batch(logits, n_best_size):
+    """
+    Get the n-best logits of each row of a 2D array, in the same order as
+    `_get_best_indexes`: by decreasing logit, then by increasing index.
+    """
+    n_best_size = min(n_best_size, logits.shape[1])
+    # The n-th largest logit of each row
+    nth = -np.partition(-logits, n_best_size - 1, axis=1)[:, n_best_size - 1:n_best_size]
+    above = logits > nth
+    tied = logits == nth
+    # Complete the n-best with the first of the logits equal to the n-th largest
+    num_tied = n_best_size - np.sum(above, axis=1, keepdims=True)
+    selected = above | (tied & (np.cumsum(tied, axis=1) <= num_tied))
+    indexes = np.nonzero(selected)[1].reshape(len(logits), n_best_size)
+    order = np.argsort(-np.take_along_axis(logits, indexes, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(indexes, order, axis=1)
+
+
+def _get_valid_spans(features, all_start_logits, all_end_logits, n_best_size, max_answer_length):
+    """
+    Get the valid answer spans among the n-best start and end indexes of all the
+    features at once.
+
+    Returns the row of the feature, the start and end indexes and logits of each
+    valid span, ordered by row and by rank of the start and end indexes.
+    """
+    if not features:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(0), np.zeros(0)
+
+    start_indexes = _get_best_indexes_batch(all_start_logits, n_best_size)
+    end_indexes = _get_best_indexes_batch(all_end_logits, n_best_size)
+
+    # We could hypothetically create invalid predictions, e.g., predict
+    # that the start of the span is in the question. We throw out all
+    # invalid predictions.
+    valid_starts = np.array([[index < len(feature.tokens) and
+                              index in feature.token_to_orig_map and
+                              feature.token_is_max_context.get(index, False)
+                              for index in indexes]
+                             for feature, indexes in zip(features, start_indexes.tolist())], dtype=bool)
+    valid_ends = np.array([[index < len(feature.tokens) and index in feature.token_to_orig_map
+                            for index in indexes]
+                           for feature, indexes in zip(features, end_indexes.tolist())], dtype=bool)
+    lengths = end_indexes[:, np.newaxis, :] - start_indexes[:, :, np.newaxis] + 1
+    valid = (valid_starts[:, :, np.newaxis] & valid_ends[:, np.newaxis, :] &
+             (lengths > 0) & (lengths <= max_answer_length))
+
+    rows, start_ranks, end_ranks = np.nonzero(valid)
+    span_start_indexes = start_indexes[rows, start_ranks]
+    span_end_indexes = end_indexes[rows, end_ranks]
+    return (rows, span_start_indexes, span_end_indexes,
+            all_start_logits[rows, span_start_indexes], all_end_logits[rows, span_end_indexes])
+
+
 def _compute_softmax(scores):
     """Compute softmax probability over raw logits."""
     if not scores:
@@ -181,6 +237,30 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
     _PrelimPrediction = namedtuple(
         "PrelimPrediction",
         ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
+    _NbestPrediction = namedtuple(
+        "NbestPrediction", ["text", "start_logit", "end_logit"])
+
+    # Gather the features with a result in order of example, to score all of them at once.
+    example_rows = []
+    row_features = []
+    row_results = []
+    row_feature_indexes = []
+    for (example_index, example) in enumerate(all_examples):
+        row_start = len(row_features)
+        for (feature_index, feature) in enumerate(example_index_to_features[example_index]):
+            if feature.unique_id not in unique_id_to_result.keys():
+                print(f"Can't find feature {feature.unique_id}")
+                continue
+            row_features.append(feature)
+            row_results.append(unique_id_to_result[feature.unique_id])
+            row_feature_indexes.append(feature_index)
+        example_rows.append((row_start, len(row_features)))
+
+    all_start_logits = np.array([result.start_logits for result in row_results])
+    all_end_logits = np.array([result.end_logits for result in row_results])
+    (span_rows, span_start_indexes, span_end_indexes,
+     span_start_logits, span_end_logits) = _get_valid_spans(row_features, all_start_logits, all_end_logits,
+                                                            n_best_size, max_answer_length)
 
     all_predictions = OrderedDict()
     all_nbest_json = OrderedDict()
@@ -188,73 +268,49 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
 
     for (example_index, example) in enumerate(all_examples):
         features = example_index_to_features[example_index]
+        row_start, row_end = example_rows[example_index]
 
-        prelim_predictions = []
         # keep track of the minimum score of null start+end of position 0
         score_null = 1000000  # large and positive
         min_null_feature_index = 0  # the paragraph slice with min mull score
         null_start_logit = 0  # the start logit at the slice with min null score
         null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            if feature.unique_id not in unique_id_to_result.keys():
-                print(f"Can't find feature {feature.unique_id}")
-                continue
-
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # If we could have irrelevant answers, get the min score of irrelevant.
-            if is_version_2_with_negative:
-                feature_null_score = result.start_logits[0] + \
-                    result.end_logits[0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index]))
-
+        # If we could have irrelevant answers, get the min score of irrelevant.
+        if is_version_2_with_negative and row_end > row_start:
+            feature_null_scores = all_start_logits[row_start:row_end, 0] + all_end_logits[row_start:row_end, 0]
+            row = row_start + int(np.argmin(feature_null_scores))
+            if feature_null_scores[row - row_start] < score_null:
+                score_null = row_results[row].start_logits[0] + row_results[row].end_logits[0]
+                min_null_feature_index = row_feature_indexes[row]
+                null_start_logit = row_results[row].start_logits[0]
+                null_end_logit = row_results[row].end_logits[0]
+
+        # The valid spans of the features of this example, in the order of the features
+        # and of the n-best start and end indexes.
+        first, last = np.searchsorted(span_rows, [row_start, row_end])
+        feature_indexes = [row_feature_indexes[row] for row in span_rows[first:last]]
+        start_indexes = span_start_indexes[first:last].tolist()
+        end_indexes = span_end_indexes[first:last].tolist()
+        start_logits = span_start_logits[first:last].tolist()
+        end_logits = span_end_logits[first:last].tolist()
         if is_version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit))
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True)
-
-        _NbestPrediction = namedtuple(
-            "NbestPrediction", ["text", "start_logit", "end_logit"])
+            feature_indexes.append(min_null_feature_index)
+            start_indexes.append(0)
+            end_indexes.append(0)
+            start_logits.append(null_start_logit)
+            end_logits.append(null_end_logit)
+        # A stable sort keeps the spans with equal scores in the same order.
+        scores = np.array(start_logits, dtype=np.float64) + np.array(end_logits, dtype=np.float64)
+        order = np.argsort(-scores, kind="stable")
+        # Only the spans needed to fill the n-best are turned into predictions.
+        prelim_predictions = (
+            _PrelimPrediction(
+                feature_index=feature_indexes[i],
+                start_index=start_indexes[i],
+                end_index=end_indexes[i],
+                start_logit=start_logits[i],
+                end_logit=end_logits[i])
+            for i in order)
 
         seen_predictions = {}
         nbest = []
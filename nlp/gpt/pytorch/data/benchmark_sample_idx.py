@@ -0,0 +1,77 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the sample index builders of `indexed_dataset.py` on a
+synthetic document size array.
+
+Example:
+    python data/benchmark_sample_idx.py --num-documents 100000000 --epochs 2
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from indexed_dataset import (_build_doc_idx, _build_sample_idx,
+                             _build_sample_idx_fast, _num_tokens, numba)
+
+
+def timed(name, fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    print(f"{name:<12} {time.time() - start:10.2f} s")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-documents', default=100_000_000, type=int,
+                        help='number of synthetic documents')
+    parser.add_argument('--mean-document-length', default=64, type=int,
+                        help='mean number of tokens per synthetic document')
+    parser.add_argument('--epochs', default=1, type=int,
+                        help='number of epochs to build the index for')
+    parser.add_argument('--max-len', default=1024, type=int,
+                        help='max length of input sequence')
+    parser.add_argument('--seed', type=int, default=42, help='random seed')
+    parser.add_argument('--skip-reference', action='store_true',
+                        help='do not run the (slow) pure Python builder')
+    args = parser.parse_args()
+
+    np_rng = np.random.RandomState(seed=args.seed)
+    sizes = np_rng.geometric(1.0 / args.mean_document_length,
+                             size=args.num_documents).astype(np.int32)
+    documents = np.arange(args.num_documents, dtype=np.int32)
+    tokens_per_epoch = _num_tokens(documents, sizes)
+    doc_idx = _build_doc_idx(documents, args.epochs, np_rng)
+    print(f"{args.num_documents} documents, {tokens_per_epoch} tokens per epoch, "
+          f"{(args.epochs * tokens_per_epoch - 1) // args.max_len} samples")
+
+    build_args = (sizes, doc_idx, args.max_len, args.epochs, tokens_per_epoch)
+    results = {}
+    results["vectorized"] = timed("vectorized", _build_sample_idx_fast,
+                                  *build_args, use_numba=False)
+    if numba is not None:
+        # The first call includes the JIT compilation time.
+        timed("numba (jit)", _build_sample_idx_fast, *build_args, use_numba=True)
+        results["numba"] = timed("numba", _build_sample_idx_fast,
+                                 *build_args, use_numba=True)
+    if not args.skip_reference:
+        results["python"] = timed("python", _build_sample_idx, *build_args)
+
+    reference = results["vectorized"]
+    for name, sample_idx in results.items():
+        assert np.array_equal(sample_idx, reference), f"{name} does not match"
+    print("All sample indices are identical.")
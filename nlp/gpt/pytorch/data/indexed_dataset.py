@@ -12,16 +12,25 @@
 #    An empty sentence no longer separates documents.
 
 import os
+import fcntl
 import struct
+import hashlib
 import logging
+import tempfile
 
 import torch
 import numpy as np
 
+from contextlib import contextmanager
 from functools import lru_cache
 from itertools import accumulate
 from torch.utils.data import Dataset
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def logger(msg):
     logging.info(msg)
@@ -130,7 +139,7 @@ class MMapIndexedDataset(Dataset):
         return self._path
 
     def __setstate__(self, state):
-        self._do_init(state)
+        self._do_init(state, skip_warmup=True)
 
     def _do_init(self, path, skip_warmup):
         self._path = path
@@ -192,6 +201,15 @@ class MMapIndexedDataset(Dataset):
     def sizes(self):
         return self._index.sizes
 
+    @property
+    def pointers(self):
+        return self._index._pointers
+
+    @property
+    def tokens(self):
+        """Zero-copy view of the whole token stream of the `.bin` file."""
+        return np.frombuffer(self._bin_buffer, dtype=self._index.dtype)
+
     @property
     def doc_idx(self):
         return self._index.doc_idx
@@ -223,16 +241,18 @@ def make_indexed_dataset(path, skip_warmup=False):
 
 
 class GPTDataset(Dataset):
-    def __init__(self, args, data_prefix, documents, indexed_dataset, num_epochs=None, num_samples=None):
+    def __init__(self, args, data_prefix, documents, indexed_dataset, num_epochs=None, num_samples=None,
+                 dtype=np.int64):
         self.indexed_dataset = indexed_dataset
         self.seq_length = args.max_len
         self.seed = args.seed
+        self.dtype = dtype
         if num_epochs is None:
             num_epochs = args.epochs
         # Build index mappings.
         self.doc_idx, self.sample_idx, self.shuffle_idx = _build_index_mappings(
             data_prefix, documents, self.indexed_dataset.sizes,
-            self.seq_length, self.see, num_epochs, num_samples)
+            self.seq_length, self.seed, num_epochs, num_samples)
 
     def __len__(self):
         # -1 is due to data structure used to retieve the index:
@@ -240,31 +260,58 @@ class GPTDataset(Dataset):
         return self.sample_idx.shape[0] - 1
 
     def __getitem__(self, idx):
-        # Get the shuffled index.
-        idx = self.shuffle_idx[idx]
-        # Start and end documents and offsets.
-        doc_index_f = self.sample_idx[idx][0]
-        doc_index_l = self.sample_idx[idx + 1][0]
-        offset_f = self.sample_idx[idx][1]
-        offset_l = self.sample_idx[idx + 1][1]
-        # If we are within the same document, just extract the chunk.
-        if doc_index_f == doc_index_l:
-            sample = self.indexed_dataset.get(self.doc_idx[doc_index_f],
-                                              offset=offset_f,
-                                              length=offset_l - offset_f + 1)
-        else:
-            # Otherwise, get the rest of the initial document.
-            sample_list = [self.indexed_dataset.get(self.doc_idx[doc_index_f],
-                                                    offset=offset_f)]
-            # Loop over all in between documents and add the entire document.
-            for i in range(doc_index_f + 1, doc_index_l):
-                sample_list.append(self.indexed_dataset.get(self.doc_idx[i]))
-            # And finally add the relevant portion of last document.
-            sample_list.append(self.indexed_dataset.get(
-                self.doc_idx[doc_index_l],
-                length=offset_l + 1))
-            sample = np.concatenate(sample_list)
-        return np.array(sample, dtype=np.int64)
+        return self.get_batch([idx])[0]
+
+    def get_batch(self, indices, out=None):
+        """Gather the samples `indices` into a single [len(indices), seq_length + 1]
+        array. Each document span is copied once, straight from the memory-mapped
+        token stream into `out` (allocated if not given)."""
+        if out is None:
+            out = np.empty((len(indices), self.seq_length + 1), dtype=self.dtype)
+        tokens = self.indexed_dataset.tokens
+        pointers = self.indexed_dataset.pointers
+        sizes = self.indexed_dataset.sizes
+        itemsize = tokens.itemsize
+        for row, idx in enumerate(indices):
+            # Get the shuffled index.
+            idx = self.shuffle_idx[idx]
+            # Start and end documents and offsets.
+            doc_index_f, offset_f = self.sample_idx[idx]
+            doc_index_l, offset_l = self.sample_idx[idx + 1]
+            position = 0
+            for i in range(doc_index_f, doc_index_l + 1):
+                doc = self.doc_idx[i]
+                doc_start = pointers[doc] // itemsize
+                # The first document starts at its offset, the last one ends
+                # at its offset (inclusive), the ones in between are copied whole.
+                start = doc_start + (offset_f if i == doc_index_f else 0)
+                end = doc_start + (offset_l + 1 if i == doc_index_l else sizes[doc])
+                length = end - start
+                out[row, position:position + length] = tokens[start:end]
+                position += length
+        return out
+
+
+class GPTSampleIndexDataset(Dataset):
+    """Returns sample indices of a `GPTDataset`, to be gathered in a single
+    `get_batch` call by `GPTBatchCollator` inside the DataLoader workers."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return idx
+
+
+class GPTBatchCollator:
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __call__(self, indices):
+        return torch.from_numpy(self.dataset.get_batch(indices))
 
 
 def _build_index_mappings(data_prefix, documents, sizes,
@@ -283,39 +330,42 @@ def _build_index_mappings(data_prefix, documents, sizes,
     # rng state
     np_rng = np.random.RandomState(seed=seed)
 
-    # Filename of the index mappings.
-    _filename = "{}_indexmap_{}ns_{}sl_{}s".format(
-        data_prefix, num_epochs, seq_length, seed)
+    # Filename of the index mappings. The name includes a hash identifying
+    # the index file and the selected documents so that a cache built for a
+    # different dataset or split is never picked up by mistake.
+    _filename = "{}_indexmap_{}ns_{}sl_{}s_{}".format(
+        data_prefix, num_epochs, seq_length, seed,
+        _index_mappings_hash(data_prefix, documents))
     doc_idx_filename = _filename + '_doc_idx.npy'
     sample_idx_filename = _filename + '_sample_idx.npy'
     shuffle_idx_filename = _filename + '_shuffle_idx.npy'
-
-    # Build the indexed mapping if not exist.
-    # Maybe popdist.rank is needed
-    if (not os.path.isfile(doc_idx_filename)) or \
-        (not os.path.isfile(sample_idx_filename)) or \
-            (not os.path.isfile(shuffle_idx_filename)):
-
-        # print_rank_0(' > WARNING: could not find index map files, building '
-        #              'the indices on rank 0 ...')
-
-        # doc-idx.
-        doc_idx = _build_doc_idx(documents, num_epochs, np_rng)
-        np.save(doc_idx_filename, doc_idx, allow_pickle=True)
-        # sample-idx.
-        # Megatron Used C++ implementation for speed here.
-        assert doc_idx.dtype == np.int32
-        assert sizes.dtype == np.int32
-        sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
-                                       num_epochs, tokens_per_epoch)
-        np.save(sample_idx_filename, sample_idx, allow_pickle=True)
-        # shuffle-idx.
-        # -1 is due to data structure used to retieve the index:
-        #    sample i --> [sample_idx[i], sample_idx[i+1])
-        num_samples_ = sample_idx.shape[0] - 1
-        shuffle_idx = _build_shuffle_idx(num_samples_,
-                                         sample_idx.shape[0] - 1, np_rng)
-        np.save(shuffle_idx_filename, shuffle_idx, allow_pickle=True)
+    filenames = (doc_idx_filename, sample_idx_filename, shuffle_idx_filename)
+
+    # Build the indexed mapping if not exist. Only one process (across all
+    # instances sharing the file system) builds it while holding the lock,
+    # the others wait and then load the files it wrote.
+    if not all(os.path.isfile(f) for f in filenames):
+        with _file_lock(_filename + '.lock'):
+            if not all(os.path.isfile(f) for f in filenames):
+                logger('    building index mappings {}'.format(_filename))
+                # doc-idx.
+                doc_idx = _build_doc_idx(documents, num_epochs, np_rng)
+                # sample-idx.
+                # Megatron used a C++ implementation for speed here, we use a
+                # vectorized (or Numba compiled) equivalent.
+                assert doc_idx.dtype == np.int32
+                assert sizes.dtype == np.int32
+                sample_idx = _build_sample_idx_fast(sizes, doc_idx, seq_length,
+                                                    num_epochs, tokens_per_epoch)
+                # shuffle-idx.
+                # -1 is due to data structure used to retieve the index:
+                #    sample i --> [sample_idx[i], sample_idx[i+1])
+                num_samples_ = sample_idx.shape[0] - 1
+                shuffle_idx = _build_shuffle_idx(num_samples_,
+                                                 sample_idx.shape[0] - 1, np_rng)
+                _save_atomic(doc_idx_filename, doc_idx)
+                _save_atomic(sample_idx_filename, sample_idx)
+                _save_atomic(shuffle_idx_filename, shuffle_idx)
 
     # Load mappings.
     doc_idx = np.load(doc_idx_filename, allow_pickle=True, mmap_mode='r')
@@ -328,6 +378,53 @@ def _build_index_mappings(data_prefix, documents, sizes,
     return doc_idx, sample_idx, shuffle_idx
 
 
+def _index_mappings_hash(data_prefix, documents):
+    """Hash identifying the `.idx` file and the `documents` array.
+
+    The `.idx` file is identified by its size, modification time and
+    header (magic, version, dtype, number of sequences and of documents)
+    rather than by its content, so that every process does not read the
+    whole file at startup."""
+    hasher = hashlib.sha1()
+    path = index_file_path(data_prefix)
+    stat = os.stat(path)
+    hasher.update('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(path, 'rb') as stream:
+        hasher.update(stream.read(9 + 8 + 1 + 8 + 8))
+    documents = np.ascontiguousarray(documents)
+    hasher.update(str(documents.dtype).encode())
+    hasher.update(documents.tobytes())
+    return hasher.hexdigest()[:16]
+
+
+@contextmanager
+def _file_lock(path):
+    """Exclusive lock on `path`, shared by all processes and instances
+    using the same file system."""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _save_atomic(filename, array):
+    """Save `array` to a temporary file and rename it to `filename` so
+    readers never see a partially written file."""
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
 def _num_tokens(documents, sizes):
     """Total number of tokens in the dataset."""
     return np.sum(sizes[documents])
@@ -413,6 +510,77 @@ def _build_sample_idx(sizes, doc_idx, seq_length,
     return sample_idx
 
 
+def _build_sample_idx_vectorized(sizes, doc_idx, seq_length,
+                                 num_epochs, tokens_per_epoch):
+    """Vectorized equivalent of `_build_sample_idx`.
+
+    Consecutive samples overlap by one token, so the boundary between
+    sample i-1 and sample i is the global token position i * seq_length
+    in the stream of concatenated documents. The document holding that
+    token is found with a binary search over the cumulative document
+    lengths; empty documents are skipped exactly as in the loop version."""
+    num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+    sample_idx = np.zeros([num_samples + 1, 2], dtype=np.int32)
+
+    # End position (exclusive) of every document in the token stream.
+    doc_ends = np.cumsum(sizes[doc_idx], dtype=np.int64)
+    positions = np.arange(1, num_samples + 1, dtype=np.int64) * seq_length
+    # First document whose end lies strictly after the boundary token.
+    doc_idx_index = np.searchsorted(doc_ends, positions, side='right')
+    doc_starts = doc_ends[doc_idx_index] - sizes[doc_idx[doc_idx_index]]
+    sample_idx[1:, 0] = doc_idx_index
+    sample_idx[1:, 1] = positions - doc_starts
+    return sample_idx
+
+
+if numba is not None:
+    @numba.njit
+    def _build_sample_idx_numba_kernel(sizes, doc_idx, seq_length, num_samples):
+        sample_idx = np.zeros((num_samples + 1, 2), dtype=np.int32)
+        doc_idx_index = 0
+        doc_offset = 0
+        for sample_index in range(1, num_samples + 1):
+            remaining_seq_length = seq_length + 1
+            while remaining_seq_length != 0:
+                doc_length = sizes[doc_idx[doc_idx_index]] - doc_offset
+                remaining_seq_length -= doc_length
+                if remaining_seq_length <= 0:
+                    doc_offset += (remaining_seq_length + doc_length - 1)
+                    remaining_seq_length = 0
+                else:
+                    doc_idx_index += 1
+                    doc_offset = 0
+            sample_idx[sample_index, 0] = doc_idx_index
+            sample_idx[sample_index, 1] = doc_offset
+        return sample_idx
+
+
+def _build_sample_idx_numba(sizes, doc_idx, seq_length,
+                            num_epochs, tokens_per_epoch):
+    """Numba compiled version of the `_build_sample_idx` loop. It needs no
+    temporary arrays, so it is preferred when memory is tight."""
+    if numba is None:
+        raise ImportError("Numba is required for the compiled sample index "
+                          "builder. Please install with: 'pip install numba'")
+    num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+    return _build_sample_idx_numba_kernel(sizes, doc_idx, int(seq_length),
+                                          int(num_samples))
+
+
+def _build_sample_idx_fast(sizes, doc_idx, seq_length,
+                           num_epochs, tokens_per_epoch, use_numba=None):
+    """Build the same sample index as `_build_sample_idx` without the
+    Python loop. By default the Numba path is used when Numba is
+    installed and the vectorized NumPy path otherwise."""
+    if use_numba is None:
+        use_numba = numba is not None
+    if use_numba:
+        return _build_sample_idx_numba(sizes, doc_idx, seq_length,
+                                       num_epochs, tokens_per_epoch)
+    return _build_sample_idx_vectorized(sizes, doc_idx, seq_length,
+                                        num_epochs, tokens_per_epoch)
+
+
 def _build_shuffle_idx(num_samples, total_size, np_rng):
     """Build the range [0, size) and shuffle."""
     print(' > building shuffle index with split [0, {}) and [{}, {}) '
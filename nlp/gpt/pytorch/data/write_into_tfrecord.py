@@ -17,6 +17,7 @@ import collections
 import os
 import pdb
 import pickle
+import multiprocessing
 from tqdm import tqdm
 import argparse
 
@@ -73,6 +74,111 @@ def write_instance_to_example_files(train_path, output_dir, max_seq_length, stri
     tf.compat.v1.logging.info("Wrote %d total instances", total_written)
 
 
+def find_shard_ranges(input_file, shard_size):
+    """Split `input_file` into byte ranges of about `shard_size` bytes, each
+    ending on a line boundary. The ranges only depend on the file and the
+    shard size, so the output does not depend on the number of workers."""
+    file_size = os.path.getsize(input_file)
+    boundaries = [0]
+    with open(input_file, "rb") as f:
+        while boundaries[-1] < file_size:
+            f.seek(min(boundaries[-1] + shard_size, file_size))
+            f.readline()
+            boundaries.append(min(f.tell(), file_size))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_shard_lines(input_file, start, end):
+    with open(input_file, "rb") as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def article_to_samples(article, max_seq_length, stride):
+    """Cut a tokenized article into windows of `max_seq_length` tokens."""
+    samples = []
+    start_point = 0
+    while start_point < len(article) - max_seq_length:
+        samples.append(article[start_point: start_point + max_seq_length])
+        start_point += stride
+    if start_point < len(article) - (max_seq_length // 2):
+        samples.append(article[start_point:])
+    return samples
+
+
+_tokenizer = None
+
+
+def _init_shard_worker(tokenizer_name):
+    global _tokenizer
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    from transformers import GPT2TokenizerFast
+    _tokenizer = GPT2TokenizerFast.from_pretrained(tokenizer_name, add_prefix_space=False)
+
+
+def write_shard(task):
+    """Tokenize the lines of one byte range of the input text and write them
+    to their own TFRecord file, together with its `.index` file."""
+    (shard_index, start, end, input_file, output_dir,
+     max_seq_length, stride, min_length, seed) = task
+    eod = _tokenizer.encode('<|endoftext|>')
+    samples = []
+    for line in read_shard_lines(input_file, start, end):
+        input_ids = []
+        # Same processing as wikipedia_preprocess.py
+        for utterance in line.decode("utf-8").split("\n"):
+            input_ids += _tokenizer.encode(utterance, add_special_tokens=False)
+            input_ids += eod
+        if len(input_ids) >= min_length:
+            samples.extend(article_to_samples(input_ids, max_seq_length, stride))
+    random.Random(seed + shard_index).shuffle(samples)
+
+    output_file = os.path.join(output_dir, 'data_{:05d}.tfrecord'.format(shard_index))
+    index_file = output_file.replace(".tfrecord", ".index")
+    offset = 0
+    with tf.io.TFRecordWriter(output_file) as writer, open(index_file, "w") as index:
+        for input_ids in samples:
+            features = collections.OrderedDict()
+            features["input_ids"] = create_int_feature(input_ids)
+            tf_example = tf.train.Example(
+                features=tf.train.Features(feature=features))
+            record = tf_example.SerializeToString()
+            writer.write(record)
+            # Same format as tfrecord.tools.tfrecord2idx, a record is stored as
+            # length (8 bytes), length crc (4), data, data crc (4).
+            index.write("{} {}\n".format(offset, len(record) + 16))
+            offset += len(record) + 16
+    return os.path.basename(output_file), len(samples)
+
+
+def write_sharded_text_to_example_files(input_file, output_dir, max_seq_length, stride,
+                                        shard_size_mb=256, num_workers=None, min_length=10,
+                                        seed=42, tokenizer_name='gpt2'):
+    """Tokenize one-article-per-line text and write it as TFRecord shards
+    using a pool of worker processes. The same set of files, each with the
+    same examples, is produced for any number of workers."""
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    ranges = find_shard_ranges(input_file, int(shard_size_mb * 1024 * 1024))
+    tasks = [(i, start, end, input_file, output_dir, max_seq_length, stride, min_length, seed)
+             for i, (start, end) in enumerate(ranges)]
+
+    with multiprocessing.Pool(num_workers, initializer=_init_shard_worker,
+                              initargs=(tokenizer_name,)) as pool:
+        shards = list(tqdm(pool.imap(write_shard, tasks), total=len(tasks)))
+
+    with open(os.path.join(output_dir, 'shards.index'), "w") as f:
+        for filename, num_examples in shards:
+            f.write("{} {}\n".format(filename, num_examples))
+    total_written = sum(num_examples for _, num_examples in shards)
+    tf.compat.v1.logging.info("Wrote %d total instances in %d shards", total_written, len(shards))
+    return shards
+
+
 def create_int_feature(values):
     feature = tf.train.Feature(
         int64_list=tf.train.Int64List(value=list(values)))
@@ -91,6 +197,23 @@ if __name__ == "__main__":
                         required=False, help='stride window size to sample dataset')
     parser.add_argument('--num-output', type=int, default=4,
                         help="number of output files")
+    parser.add_argument('--input-text-file', default=None, type=str,
+                        help="one article per line text file (see wikipedia_preprocess.py). If given, the text "
+                             "is tokenized and written in parallel to one TFRecord file per shard.")
+    parser.add_argument('--shard-size-mb', default=256, type=float,
+                        help="size of the input text processed into each output file")
+    parser.add_argument('--num-workers', default=None, type=int,
+                        help="number of worker processes, defaults to the number of cores")
+    parser.add_argument('--min-length', default=10, type=int,
+                        help='minimal length of an article in tokens')
+    parser.add_argument('--seed', default=42, type=int, help='random seed for the shuffling of each shard')
     args = parser.parse_args()
-    write_instance_to_example_files(train_path=args.input_file_path, output_dir=args.output_file_path,
-                                    max_seq_length=args.seq_length, stride=args.stride, num_output=args.num_output)
+    if args.input_text_file is not None:
+        write_sharded_text_to_example_files(input_file=args.input_text_file, output_dir=args.output_file_path,
+                                            max_seq_length=args.seq_length, stride=args.stride,
+                                            shard_size_mb=args.shard_size_mb, num_workers=args.num_workers,
+                                            min_length=args.min_length, seed=args.seed)
+    else:
+        write_instance_to_example_files(train_path=args.input_file_path, output_dir=args.output_file_path,
+                                        max_seq_length=args.seq_length, stride=args.stride,
+                                        num_output=args.num_output)
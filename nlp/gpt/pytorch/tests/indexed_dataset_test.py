@@ -0,0 +1,138 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import argparse
+import pytest
+import torch
+import numpy as np
+
+import import_helper
+from data.indexed_dataset import (GPTBatchCollator, GPTDataset, GPTSampleIndexDataset,
+                                  MMapIndexedDataset, _build_doc_idx, _build_index_mappings,
+                                  _build_sample_idx, _build_sample_idx_fast,
+                                  _num_tokens, numba)
+
+
+@pytest.mark.ipus(0)
+@pytest.mark.parametrize("use_numba", [False, pytest.param(
+    True, marks=pytest.mark.skipif(numba is None, reason="Numba is not installed"))])
+@pytest.mark.parametrize("seq_length", [1, 7, 64])
+@pytest.mark.parametrize("num_epochs", [1, 3])
+def test_build_sample_idx_fast(use_numba, seq_length, num_epochs):
+    """
+    Test that the fast sample index builders give bit-identical results
+    to the reference Python loop, including for empty documents.
+    """
+    np_rng = np.random.RandomState(1234)
+    sizes = np_rng.randint(0, 100, size=500).astype(np.int32)
+    sizes[::17] = 0
+    documents = np.arange(len(sizes), dtype=np.int32)
+    tokens_per_epoch = _num_tokens(documents, sizes)
+    doc_idx = _build_doc_idx(documents, num_epochs, np_rng)
+
+    expected = _build_sample_idx(sizes, doc_idx, seq_length,
+                                 num_epochs, tokens_per_epoch)
+    result = _build_sample_idx_fast(sizes, doc_idx, seq_length,
+                                    num_epochs, tokens_per_epoch,
+                                    use_numba=use_numba)
+    assert result.dtype == expected.dtype
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.ipus(0)
+def test_build_index_mappings_cache(tmp_path):
+    """
+    Test that the index mappings are written once, atomically, and that the
+    cache is keyed by the index file (size, modification time and header)
+    and the documents.
+    """
+    data_prefix = str(tmp_path / "dataset")
+    with open(data_prefix + ".idx", "wb") as f:
+        f.write(b"index file content")
+    sizes = np.random.RandomState(0).randint(1, 50, size=100).astype(np.int32)
+    documents = np.arange(len(sizes), dtype=np.int32)
+
+    first = _build_index_mappings(data_prefix, documents, sizes, 16, 1234, num_epochs=2)
+    files = sorted(os.listdir(tmp_path))
+    assert not any(f.endswith(".tmp") for f in files)
+    second = _build_index_mappings(data_prefix, documents, sizes, 16, 1234, num_epochs=2)
+    assert sorted(os.listdir(tmp_path)) == files
+    for a, b in zip(first, second):
+        assert isinstance(b, np.memmap)
+        np.testing.assert_array_equal(a, b)
+
+    # A different document split gets its own cache entry.
+    _build_index_mappings(data_prefix, documents[:50], sizes, 16, 1234, num_epochs=2)
+    assert len(os.listdir(tmp_path)) > len(files)
+    files = sorted(os.listdir(tmp_path))
+
+    # So does a rewritten index file.
+    with open(data_prefix + ".idx", "wb") as f:
+        f.write(b"new index file content")
+    _build_index_mappings(data_prefix, documents, sizes, 16, 1234, num_epochs=2)
+    assert len(os.listdir(tmp_path)) > len(files)
+
+
+def _write_mmap_dataset(data_prefix, documents):
+    sizes = np.array([len(d) for d in documents], dtype=np.int32)
+    pointers = np.concatenate([[0], np.cumsum(sizes[:-1], dtype=np.int64)]) * 2
+    with open(data_prefix + ".bin", "wb") as f:
+        f.write(np.concatenate(documents).astype(np.uint16).tobytes())
+    with open(data_prefix + ".idx", "wb") as f:
+        f.write(MMapIndexedDataset.Index._HDR_MAGIC)
+        f.write(struct.pack("<Q", 1))
+        f.write(struct.pack("<B", 8))
+        f.write(struct.pack("<Q", len(sizes)))
+        f.write(struct.pack("<Q", len(sizes) + 1))
+        f.write(sizes.tobytes())
+        f.write(pointers.tobytes())
+        f.write(np.arange(len(sizes) + 1, dtype=np.int64).tobytes())
+
+
+@pytest.mark.ipus(0)
+def test_gpt_dataset_get_batch(tmp_path):
+    """
+    Test that batched reads return the concatenation of the document
+    spans described by the sample index.
+    """
+    np_rng = np.random.RandomState(0)
+    documents = [np_rng.randint(0, 50257, size=n) for n in np_rng.randint(1, 40, size=64)]
+    data_prefix = str(tmp_path / "dataset")
+    _write_mmap_dataset(data_prefix, documents)
+    indexed_dataset = MMapIndexedDataset(data_prefix, skip_warmup=True)
+    args = argparse.Namespace(max_len=16, seed=1234, epochs=2)
+    dataset = GPTDataset(args, data_prefix, np.arange(len(documents), dtype=np.int32), indexed_dataset)
+
+    stream = np.concatenate([documents[d] for d in dataset.doc_idx])
+    starts = np.concatenate([[0], np.cumsum([len(documents[d]) for d in dataset.doc_idx])])
+    indices = np.arange(len(dataset))
+    batch = dataset.get_batch(indices)
+    assert batch.dtype == np.int64
+    assert batch.shape == (len(dataset), args.max_len + 1)
+    for row, idx in enumerate(dataset.shuffle_idx[indices]):
+        doc_index, offset = dataset.sample_idx[idx]
+        start = starts[doc_index] + offset
+        np.testing.assert_array_equal(batch[row], stream[start:start + args.max_len + 1])
+        np.testing.assert_array_equal(dataset[row], batch[row])
+
+    index_dataset = GPTSampleIndexDataset(dataset)
+    assert len(index_dataset) == len(dataset)
+    collated = GPTBatchCollator(dataset)([index_dataset[i] for i in range(4)])
+    assert collated.dtype == torch.int64
+    np.testing.assert_array_equal(collated.numpy(), batch[:4])
+
+    dataset.dtype = np.int32
+    assert dataset.get_batch([0, 1]).dtype == np.int32
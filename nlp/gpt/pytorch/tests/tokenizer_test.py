@@ -14,10 +14,12 @@
 
 import os
 import pytest
+import regex as re
 import transformers
 
 import import_helper
 from tokenizer import build_megatron_tokenizer
+from tokenizer.gpt2_tokenization import GPT2Tokenizer, get_pairs
 
 base_dir = os.path.abspath(os.path.dirname(__file__))
 
@@ -44,3 +46,61 @@ def test_tokenzier():
     tokens_b = tokenizer_b.encode(text)
 
     assert tokens_a == tokens_b
+
+
+def reference_bpe(tokenizer, token):
+    """The original GPT2Tokenizer.bpe merge loop, used as a reference."""
+    word = tuple(token)
+    pairs = get_pairs(word)
+    if not pairs:
+        return token
+    while True:
+        bigram = min(pairs, key=lambda pair: tokenizer.bpe_ranks.get(pair, float('inf')))
+        if bigram not in tokenizer.bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except BaseException:
+                new_word.extend(word[i:])
+                break
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = get_pairs(word)
+    return ' '.join(word)
+
+
+@pytest.mark.ipus(0)
+def test_bpe_merge_engine():
+    """
+    Test that the heap based BPE merge engine gives the same tokens as the
+    original merge loop, and that the cache stays bounded.
+    """
+    tokenizer = GPT2Tokenizer(vocab_file=base_dir + "/../tokenizer/gpt2-vocab-50256.json",
+                              merges_file=base_dir + "/../tokenizer/gpt2-merges-50256.txt",
+                              cache_size=64)
+    with open(base_dir + "/../README.md", encoding="utf-8") as f:
+        text = f.read()
+    text += " aaaaaaa  lllllll ----------- 1234567890 ÄÖÜ ñandú 日本語のテキスト 🙂🙂🙂"
+
+    tokens = []
+    for token in re.findall(tokenizer.pat, text):
+        token = ''.join(tokenizer.byte_encoder[b] for b in token.encode('utf-8'))
+        assert tokenizer.bpe(token) == reference_bpe(tokenizer, token), token
+        tokens.append(token)
+    assert len(tokenizer.cache) <= 64
+
+    lines = text.splitlines()
+    assert tokenizer.batch_encode(lines) == [tokenizer.encode(line) for line in lines]
@@ -0,0 +1,126 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+from collections import Counter
+
+import pytest
+
+import import_helper
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("transformers")
+from data.write_into_tfrecord import (find_shard_ranges, read_shard_lines,
+                                      write_sharded_text_to_example_files)
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+
+def write_articles(path, num_articles, trailing_newline=True, seed=0):
+    rng = random.Random(seed)
+    words = ["graphcore", "ipu", "poplar", "the", "a", "model", "of", "text", "data", "train"]
+    lines = [" ".join(rng.choices(words, k=rng.randint(1, 80))) for _ in range(num_articles)]
+    text = "\n".join(lines) + ("\n" if trailing_newline else "")
+    with open(path, "wb") as f:
+        f.write(text.encode("utf-8"))
+    return text.encode("utf-8")
+
+
+def read_records(filename):
+    """The serialized records of a TFRecord file, stored as length (8 bytes),
+    length crc (4), data, data crc (4)."""
+    records = []
+    with open(filename, "rb") as f:
+        while True:
+            length = f.read(8)
+            if not length:
+                return records
+            length, = struct.unpack("<Q", length)
+            f.read(4)
+            records.append(f.read(length))
+            f.read(4)
+
+
+@pytest.fixture(name="tokenizer_dir", scope="module")
+def tokenizer_dir_fixture(tmp_path_factory):
+    # The GPT-2 vocabulary shipped with the application, so the test does not download it
+    tokenizer_dir = tmp_path_factory.mktemp("tokenizer")
+    shutil.copy(os.path.join(base_dir, "..", "tokenizer", "gpt2-vocab-50256.json"), tokenizer_dir / "vocab.json")
+    shutil.copy(os.path.join(base_dir, "..", "tokenizer", "gpt2-merges-50256.txt"), tokenizer_dir / "merges.txt")
+    return str(tokenizer_dir)
+
+
+@pytest.mark.ipus(0)
+@pytest.mark.parametrize("trailing_newline", [True, False])
+@pytest.mark.parametrize("shard_size", [1, 37, 200, 100000])
+def test_shard_ranges_cover_every_line(tmp_path, trailing_newline, shard_size):
+    """
+    Test that the shard byte ranges end on line boundaries and cover every
+    line exactly once, including lines straddling the shard size and a last
+    line without a newline.
+    """
+    input_file = str(tmp_path / "articles.txt")
+    text = write_articles(input_file, 50, trailing_newline)
+    ranges = find_shard_ranges(input_file, shard_size)
+
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(text)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+        assert text[end - 1:end] == b"\n"
+    assert all(start < end for start, end in ranges)
+
+    lines = [line for start, end in ranges for line in read_shard_lines(input_file, start, end)]
+    assert lines == text.splitlines(keepends=True)
+
+
+@pytest.mark.ipus(0)
+def test_sharded_examples_do_not_depend_on_workers(tmp_path, tokenizer_dir):
+    """
+    Test that the shards hold the same examples for any number of workers,
+    and that their index files match the ones of tfrecord2idx.
+    """
+    input_file = str(tmp_path / "articles.txt")
+    text = write_articles(input_file, 200, trailing_newline=False)
+    kwargs = dict(max_seq_length=16, stride=8, shard_size_mb=len(text) / 5 / 1024 ** 2,
+                  min_length=10, seed=1234, tokenizer_name=tokenizer_dir)
+
+    outputs = {}
+    for num_workers in [1, 3]:
+        output_dir = str(tmp_path / f"workers_{num_workers}")
+        shards = write_sharded_text_to_example_files(input_file, output_dir, num_workers=num_workers, **kwargs)
+        assert len(shards) >= 5
+        examples = Counter()
+        for filename, num_examples in shards:
+            records = read_records(os.path.join(output_dir, filename))
+            assert len(records) == num_examples
+            examples.update(tuple(tf.train.Example.FromString(record).features.feature["input_ids"].int64_list.value)
+                            for record in records)
+        outputs[num_workers] = shards, examples
+
+        for filename, _ in shards:
+            tfrecord_file = os.path.join(output_dir, filename)
+            expected_index = str(tmp_path / "expected.index")
+            subprocess.run([sys.executable, "-m", "tfrecord.tools.tfrecord2idx", tfrecord_file, expected_index], check=True)
+            with open(tfrecord_file.replace(".tfrecord", ".index")) as index, open(expected_index) as expected:
+                assert index.read() == expected.read()
+
+    assert outputs[1][0] == outputs[3][0]
+    assert outputs[1][1] == outputs[3][1]
+    assert sum(outputs[1][1].values()) > 0
+    for filename, _ in outputs[1][0]:
+        assert read_records(str(tmp_path / "workers_1" / filename)) == read_records(str(tmp_path / "workers_3" / filename))
@@ -115,6 +115,9 @@ class _GPT2BPETokenizer(AbstractTokenizer):
     def encode(self, text):
         return self.tokenizer.encode(text)
 
+    def batch_encode(self, texts):
+        return self.tokenizer.batch_encode(texts)
+
     def detokenize(self, token_ids):
         return self.tokenizer.decode(token_ids)
 
@@ -23,9 +23,11 @@ from __future__ import (absolute_import, division, print_function,
 
 import sys
 import json
+import heapq
 import logging
 import os
 import regex as re
+from collections import OrderedDict
 from io import open
 
 try:
@@ -78,6 +80,38 @@ def get_pairs(word):
     return pairs
 
 
+class LRUCache(object):
+    """Dictionary holding at most `maxsize` entries, the least recently
+    used entry is evicted first."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def __getitem__(self, key):
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
 class GPT2Tokenizer(object):
     """
     GPT-2 BPE tokenizer. Peculiarities:
@@ -85,7 +119,7 @@ class GPT2Tokenizer(object):
     """
 
     def __init__(self, vocab_file, merges_file, errors='replace',
-                 special_tokens=None, max_len=None):
+                 special_tokens=None, max_len=None, cache_size=2**18):
         self.max_len = max_len if max_len is not None else int(1e12)
         self.encoder = json.load(open(vocab_file))
         self.decoder = {v: k for k, v in self.encoder.items()}
@@ -95,7 +129,8 @@ class GPT2Tokenizer(object):
         bpe_data = open(merges_file, encoding='utf-8').read().split('\n')[1:-1]
         bpe_merges = [tuple(merge.split()) for merge in bpe_data]
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache = LRUCache(cache_size)
+        self._build_merge_table(bpe_merges)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for
         # capitalized versions of contractions
@@ -124,45 +159,82 @@ class GPT2Tokenizer(object):
             v: k for k, v in self.special_tokens.items()}
         logger.info("Special tokens {}".format(self.special_tokens))
 
-    def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
+    def _build_merge_table(self, bpe_merges):
+        """Map every merge symbol to an integer id and every merge pair of
+        ids to its (rank, merged id)."""
+        self._symbol_ids = {}
+        self._merges = {}
 
-        if not pairs:
-            return token
+        def symbol_id(symbol):
+            return self._symbol_ids.setdefault(symbol, len(self._symbol_ids))
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(
-                pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except BaseException:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
+        for rank, (first, second) in enumerate(bpe_merges):
+            pair = (symbol_id(first), symbol_id(second))
+            self._merges.setdefault(pair, (rank, symbol_id(first + second)))
+
+    def _merge_symbols(self, token):
+        """Apply the BPE merges to `token` and return the list of symbols.
+
+        The word is kept as a linked list of integer symbol ids and the
+        candidate pairs in a heap ordered by (rank, position). As in the
+        reference algorithm, every occurrence of the lowest ranked pair is
+        merged (left to right) before the pairs it creates are considered."""
+        ids = [self._symbol_ids.get(char, -1) for char in token]
+        length = len(ids)
+        symbols = list(token)
+        next_ = list(range(1, length + 1))
+        prev = list(range(-1, length - 1))
+        merges = self._merges
+
+        heap = []
+        for i in range(length - 1):
+            merge = merges.get((ids[i], ids[i + 1]))
+            if merge is not None:
+                heap.append((merge[0], i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            merged = []
+            while heap and heap[0][0] == rank:
+                _, i = heapq.heappop(heap)
+                j = next_[i]
+                if ids[i] is None or j >= length:
+                    continue
+                merge = merges.get((ids[i], ids[j]))
+                if merge is None or merge[0] != rank:
+                    # Stale entry: the pair was changed by an earlier merge.
+                    continue
+                ids[i] = merge[1]
+                symbols[i] += symbols[j]
+                ids[j] = None
+                next_[i] = next_[j]
+                if next_[j] < length:
+                    prev[next_[j]] = i
+                merged.append(i)
+
+            candidates = set()
+            for i in merged:
+                if ids[i] is None:
+                    continue
+                if prev[i] >= 0:
+                    candidates.add(prev[i])
+                if next_[i] < length:
+                    candidates.add(i)
+            for i in candidates:
+                merge = merges.get((ids[i], ids[next_[i]]))
+                if merge is not None:
+                    heapq.heappush(heap, (merge[0], i))
+
+        return [symbols[i] for i in range(length) if ids[i] is not None]
+
+    def bpe(self, token):
+        word = self.cache.get(token)
+        if word is not None:
+            return word
+        if len(token) < 2:
+            return token
+        word = ' '.join(self._merge_symbols(token))
         self.cache[token] = word
         return word
 
@@ -215,6 +287,10 @@ class GPT2Tokenizer(object):
     def encode(self, text):
         return self.convert_tokens_to_ids(self.tokenize(text))
 
+    def batch_encode(self, texts):
+        """ Encode a list of strings, returns a list of lists of ids. """
+        return [self.encode(text) for text in texts]
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c]
@@ -190,6 +190,12 @@ if __name__ == "__main__":
     start_loading = time.perf_counter()
     train_dataset, validate_dataset = load_dataset(
         logger, args, model_config.vocab_size)
+    train_collate_fn = collate_fn
+    if 'dynamic' in args.train_path:
+        # Gather whole batches in the workers straight from the mmapped tokens.
+        from data.indexed_dataset import GPTBatchCollator, GPTSampleIndexDataset
+        train_collate_fn = GPTBatchCollator(train_dataset)
+        train_dataset = GPTSampleIndexDataset(train_dataset)
     loader = DataLoader(opts,
                         train_dataset,
                         shuffle=True if args.train_path.endswith(
@@ -197,7 +203,7 @@ if __name__ == "__main__":
                         batch_size=args.batch_size,
                         num_workers=args.num_workers,
                         worker_init_fn=_WorkerInit(args.seed),
-                        collate_fn=collate_fn if 'dynamic' not in args.train_path else None,
+                        collate_fn=train_collate_fn,
                         drop_last=True,
                         auto_distributed_partitioning=not isinstance(
                             train_dataset, torch.utils.data.IterableDataset),
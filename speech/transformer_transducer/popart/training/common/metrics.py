@@ -13,33 +13,12 @@
 # limitations under the License.
 
 
-def __levenshtein(a, b):
-    """Calculates the Levenshtein distance between two sequences."""
+from .scoring import alignment_counts
 
-    n, m = len(a), len(b)
-    if n > m:
-        # Make sure n <= m, to use O(min(n,m)) space
-        a, b = b, a
-        n, m = m, n
 
-    current = list(range(n + 1))
-    for i in range(1, m + 1):
-        previous, current = current, [i] + [0] * n
-        for j in range(1, n + 1):
-            add, delete = previous[j] + 1, current[j - 1] + 1
-            change = previous[j - 1]
-            if a[j - 1] != b[i - 1]:
-                change = change + 1
-            current[j] = min(add, delete, change)
-
-    return current[n]
-
-
-def word_error_rate(hypotheses, references):
+def word_error_rate(hypotheses, references, num_workers=1):
     """Computes average Word Error Rate (WER) between two text lists."""
 
-    scores = 0
-    words = 0
     len_diff = len(references) - len(hypotheses)
     if len_diff > 0:
         raise ValueError("Uneqal number of hypthoses and references: "
@@ -47,14 +26,9 @@ def word_error_rate(hypotheses, references):
     elif len_diff < 0:
         hypotheses = hypotheses[:len_diff]
 
-    for h, r in zip(hypotheses, references):
-        if len(h) == 0 and len(r) == 0:
-            continue
-
-        h_list = h.split()
-        r_list = r.split()
-        words += len(r_list)
-        scores += __levenshtein(h_list, r_list)
+    counts = alignment_counts(hypotheses, references, 'word', num_workers)
+    scores = int(counts[:, :3].sum())
+    words = int(counts[:, 3].sum())
     if words!=0:
         wer = 1.0*scores/words
     else:
@@ -0,0 +1,135 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+"""
+Batched word and character error rates, with the substitutions, insertions and
+deletions of the alignment of each hypothesis with its reference.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numba
+import numpy as np
+
+
+@numba.njit(nogil=True)
+def _alignment_kernel(hyp_ids, hyp_offsets, ref_ids, ref_offsets, counts):
+    """Levenshtein alignment of each pair of token id sequences.
+
+    The cost of a cell is encoded as one integer, distance * M^2 + insertions * M + deletions
+    with M larger than the number of tokens of the pair, so the counts are read from the
+    minimum cost. Among the alignments of minimum distance, the one with the fewest
+    insertions, and so the fewest deletions, is chosen.
+    """
+    for n in range(counts.shape[0]):
+        hyp = hyp_ids[hyp_offsets[n]:hyp_offsets[n + 1]]
+        ref = ref_ids[ref_offsets[n]:ref_offsets[n + 1]]
+        num_hyp, num_ref = hyp.shape[0], ref.shape[0]
+        m = np.int64(num_hyp + num_ref + 1)
+        substitution = m * m
+        insertion = m * m + m
+        deletion = m * m + 1
+
+        row = np.arange(num_hyp + 1) * insertion
+        for i in range(1, num_ref + 1):
+            diagonal = row[0]
+            row[0] = i * deletion
+            for j in range(1, num_hyp + 1):
+                above = row[j]
+                cost = diagonal if hyp[j - 1] == ref[i - 1] else diagonal + substitution
+                cost = min(cost, above + deletion, row[j - 1] + insertion)
+                diagonal = above
+                row[j] = cost
+
+        distance = row[num_hyp] // (m * m)
+        insertions = row[num_hyp] // m % m
+        deletions = row[num_hyp] % m
+        counts[n, 0] = distance - insertions - deletions
+        counts[n, 1] = insertions
+        counts[n, 2] = deletions
+        counts[n, 3] = num_ref
+
+
+def _tokens(text, unit):
+    if unit == 'word':
+        return text.split()
+    elif unit == 'char':
+        return ''.join(text.split())
+    raise ValueError("Unit {} not supported. Valid options are 'word' or 'char'".format(unit))
+
+
+def _token_ids(texts, unit, vocab):
+    """Concatenated token ids of the texts, and the offset of each text"""
+    ids = []
+    lengths = []
+    for text in texts:
+        tokens = _tokens(text, unit)
+        ids.extend([vocab.setdefault(token, len(vocab)) for token in tokens])
+        lengths.append(len(tokens))
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.array(ids, dtype=np.int64), offsets
+
+
+def _chunk_alignment_counts(hypotheses, references, unit):
+    vocab = {}
+    hyp_ids, hyp_offsets = _token_ids(hypotheses, unit, vocab)
+    ref_ids, ref_offsets = _token_ids(references, unit, vocab)
+    counts = np.zeros((len(references), 4), dtype=np.int64)
+    _alignment_kernel(hyp_ids, hyp_offsets, ref_ids, ref_offsets, counts)
+    return counts
+
+
+def alignment_counts(hypotheses, references, unit='word', num_workers=1, chunk_size=1000):
+    """Aligns each hypothesis with its reference.
+
+    Args:
+        hypotheses: list of hypothesis texts.
+        references: list of reference texts, of the same length.
+        unit: 'word' to align the words of the texts, or 'char' to align their
+            characters, whitespace excluded.
+        num_workers: number of processes aligning chunks of the texts; with 1
+            the texts are aligned in the calling process.
+        chunk_size: number of texts in each chunk given to a process.
+
+    Returns:
+        (N, 4) int64 array of the substitutions, insertions, deletions and
+        reference tokens of each pair.
+    """
+    if len(hypotheses) != len(references):
+        raise ValueError("Unequal number of hypotheses and references: "
+                         "{0} and {1}".format(len(hypotheses), len(references)))
+    if num_workers <= 1 or len(references) <= chunk_size:
+        return _chunk_alignment_counts(hypotheses, references, unit)
+
+    starts = range(0, len(references), chunk_size)
+    with ProcessPoolExecutor(num_workers) as executor:
+        counts = executor.map(_chunk_alignment_counts,
+                              [hypotheses[start:start + chunk_size] for start in starts],
+                              [references[start:start + chunk_size] for start in starts],
+                              repeat(unit))
+        return np.concatenate(list(counts))
+
+
+def batch_error_rate(hypotheses, references, unit='word', num_workers=1):
+    """Computes the error rate of a list of hypotheses.
+
+    Returns:
+        Tuple (rate, errors, num_tokens, counts) where counts is the tuple of the
+        substitutions, insertions and deletions; the rate is inf without
+        reference tokens.
+    """
+    substitutions, insertions, deletions, num_tokens = alignment_counts(
+        hypotheses, references, unit, num_workers).sum(axis=0).tolist()
+    errors = substitutions + insertions + deletions
+    rate = errors / num_tokens if num_tokens != 0 else float('inf')
+    return rate, errors, num_tokens, (substitutions, insertions, deletions)
+
+
+def batch_word_error_rate(hypotheses, references, num_workers=1):
+    """Computes the Word Error Rate (WER) of a list of hypotheses, see batch_error_rate."""
+    return batch_error_rate(hypotheses, references, 'word', num_workers)
+
+
+def batch_char_error_rate(hypotheses, references, num_workers=1):
+    """Computes the Character Error Rate (CER) of a list of hypotheses, see batch_error_rate."""
+    return batch_error_rate(hypotheses, references, 'char', num_workers)
@@ -0,0 +1,60 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+import random
+
+import numpy as np
+import pytest
+
+from common.metrics import word_error_rate
+from common.scoring import alignment_counts, batch_char_error_rate, batch_word_error_rate
+
+
+def levenshtein(a, b):
+    """ Pure python Levenshtein distance, used as reference """
+    current = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        previous, current = current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + (a[i - 1] != b[j - 1]))
+    return current[len(b)]
+
+
+def generate_texts(num_texts, vocab="abcdef", max_words=30):
+    random.seed(0)
+    words = ["".join(random.choices(vocab, k=random.randint(1, 3))) for _ in range(20)]
+    return [" ".join(random.choices(words, k=random.randint(0, max_words))) for _ in range(num_texts)]
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_alignment_counts(num_workers):
+    hypotheses, references = generate_texts(200), generate_texts(201)[1:]
+    counts = alignment_counts(hypotheses, references, num_workers=num_workers, chunk_size=64)
+
+    for (substitutions, insertions, deletions, num_ref), h, r in zip(counts, hypotheses, references):
+        assert num_ref == len(r.split())
+        assert substitutions + insertions + deletions == levenshtein(h.split(), r.split())
+        # The insertions and deletions are the difference of lengths
+        assert insertions - deletions == len(h.split()) - len(r.split())
+        assert substitutions + deletions <= num_ref
+
+
+def test_word_error_rate():
+    hypotheses, references = generate_texts(100), generate_texts(101)[1:]
+    scores = sum(levenshtein(h.split(), r.split()) for h, r in zip(hypotheses, references))
+    words = sum(len(r.split()) for r in references)
+
+    assert word_error_rate(hypotheses + ["extra"], references) == (scores / words, scores, words)
+    wer, errors, num_words, counts = batch_word_error_rate(hypotheses, references, num_workers=2)
+    assert (wer, errors, num_words) == (scores / words, scores, words)
+    assert sum(counts) == errors
+    with pytest.raises(ValueError):
+        word_error_rate(hypotheses[:-1], references)
+    assert word_error_rate([""], [""])[0] == float('inf')
+
+
+def test_char_error_rate():
+    cer, errors, num_chars, counts = batch_char_error_rate(["the cat sat", "on  a mat", ""], ["the bat sat", "on the mat", "ab"])
+    assert (errors, num_chars) == (1 + 3 + 2, 9 + 8 + 2)
+    assert counts == (1 + 1, 0, 2 + 2)
+    assert cer == errors / num_chars
+    assert np.array_equal(alignment_counts(["ab"], ["b"], 'char'), [[0, 1, 0, 1]])
@@ -0,0 +1,35 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+import pytest
+import torch
+
+from rnnt_reference.model import RNNT
+from transducer_decoder import TransducerGreedyDecoder
+
+
+@pytest.mark.parametrize("max_symbols_per_step", [1, 3, 30])
+@pytest.mark.parametrize("max_symbol_per_sample", [None, 4])
+def test_batched_greedy_decode(max_symbols_per_step, max_symbol_per_sample):
+    """ The batched greedy decoding gives the same sentences as the decoding
+    of one sequence at a time """
+    torch.manual_seed(0)
+    num_classes, enc_n_hid, batch_size, max_len = 12, 16, 6, 20
+    model = RNNT(n_classes=num_classes, in_feats=8, enc_n_hid=enc_n_hid,
+                 enc_pre_rnn_layers=1, enc_post_rnn_layers=1, enc_stack_time_factor=2,
+                 enc_dropout=0.0, pred_dropout=0.0, joint_dropout=0.0,
+                 pred_n_hid=16, pred_rnn_layers=2, joint_n_hid=16,
+                 forget_gate_bias=1.0, weights_init_scale=2.0)
+    model.eval()
+
+    x = model.joint_enc(torch.randn(batch_size, max_len, enc_n_hid))
+    out_lens = torch.tensor([20, 1, 13, 0, 20, 7], dtype=torch.int32)
+
+    sentences = {}
+    for batched in [False, True]:
+        decoder = TransducerGreedyDecoder(blank_idx=0,
+                                          max_symbols_per_step=max_symbols_per_step,
+                                          max_symbol_per_sample=max_symbol_per_sample,
+                                          batched=batched)
+        sentences[batched] = decoder.decode(model, x, out_lens)
+
+    assert sentences[True] == sentences[False]
+    assert any(len(sentence) > 0 for sentence in sentences[True])
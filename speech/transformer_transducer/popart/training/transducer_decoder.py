@@ -19,8 +19,12 @@ class TransducerGreedyDecoder:
         max_symbols_per_step: The maximum number of symbols that can be added
             to a sequence in a single time step; if set to None then there is
             no limit.
+        batched: decode all the sequences of a batch in lockstep instead of
+            one sequence at a time; both give the same sentences, up to the
+            rounding of the batched matmuls when two symbols are tied.
     """
-    def __init__(self, blank_idx, max_symbols_per_step=30, max_symbol_per_sample=None, shift_labels_by_one=True):
+    def __init__(self, blank_idx, max_symbols_per_step=30, max_symbol_per_sample=None, shift_labels_by_one=True,
+                 batched=True):
         self.blank_idx = blank_idx
         assert max_symbols_per_step is None or max_symbols_per_step > 0
         self.max_symbols = max_symbols_per_step
@@ -28,6 +32,7 @@ class TransducerGreedyDecoder:
         self.max_symbol_per_sample = max_symbol_per_sample
         self._SOS = -1   # start of sequence
         self.shift_labels_by_one = shift_labels_by_one
+        self.batched = batched
 
     def _pred_step(self, model, label, hidden, device):
         if label == self._SOS:
@@ -72,6 +77,9 @@ class TransducerGreedyDecoder:
             # Excluding transcription network
             logits = x
 
+            if self.batched:
+                return self._greedy_decode_batch(model, logits, out_lens)
+
             output = []
             for batch_idx in range(logits.size(0)):
                 inseq = logits[batch_idx, :, :].unsqueeze(1)
@@ -128,3 +136,64 @@ class TransducerGreedyDecoder:
                 symbols_added += 1
 
         return label
+
+    def _greedy_decode_batch(self, model, x, out_lens):
+        """Greedy decoding of all the sequences of a batch in lockstep.
+
+        At each time step, the joint network is evaluated for all the sequences
+        that have not emitted a blank yet, and the prediction network is only
+        run for the sequences that emitted a symbol. The output and state of
+        the prediction network for the last symbol of each sequence are cached,
+        they do not change while the sequence emits blanks.
+
+        Args:
+            x: (B, T, H) output of the transcription network.
+            out_lens: length of each sequence.
+
+        Returns:
+            list containing batch number of label lists.
+        """
+        batch_size = x.size(0)
+        out_lens = torch.as_tensor(out_lens).view(-1).tolist()
+        labels = [[] for _ in range(batch_size)]
+
+        # The start of sequence prediction is the same for all the sequences
+        g, (h, c) = self._pred_step(model, self._SOS, None, x.device)
+        g = g.expand(batch_size, -1, -1).contiguous()
+        h = h.expand(-1, batch_size, -1).contiguous()
+        c = c.expand(-1, batch_size, -1).contiguous()
+
+        stopped = [False] * batch_size
+        for time_idx in range(max(out_lens, default=0)):
+            for batch_idx in range(batch_size):
+                if self.max_symbol_per_sample is not None \
+                        and len(labels[batch_idx]) > self.max_symbol_per_sample:
+                    stopped[batch_idx] = True
+            active = torch.tensor([time_idx < out_len and not stop
+                                   for out_len, stop in zip(out_lens, stopped)])
+            active_idx = active.nonzero(as_tuple=True)[0].to(x.device)
+
+            symbols_added = 0
+            while active_idx.numel() > 0 and (
+                    self.max_symbols is None or
+                    symbols_added < self.max_symbols):
+                f = x[active_idx, time_idx, :].unsqueeze(1)
+                joint = self._joint_step(model, f, g[active_idx], log_normalize=False)
+                k = joint.argmax(dim=1)
+
+                not_blank = k != self.blank_idx
+                emitted_idx = active_idx[not_blank]
+                if emitted_idx.numel() > 0:
+                    # See _greedy_decode for the offset of the labels
+                    k = k[not_blank] - 1 if self.shift_labels_by_one else k[not_blank]
+                    for batch_idx, label in zip(emitted_idx.tolist(), k.tolist()):
+                        labels[batch_idx].append(label)
+                    g_emitted, (h_emitted, c_emitted) = model.predict(
+                        k.unsqueeze(1), (h[:, emitted_idx], c[:, emitted_idx]), add_sos=False)
+                    g[emitted_idx] = g_emitted
+                    h[:, emitted_idx] = h_emitted
+                    c[:, emitted_idx] = c_emitted
+                active_idx = emitted_idx
+                symbols_added += 1
+
+        return labels
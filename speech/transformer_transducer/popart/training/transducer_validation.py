@@ -13,7 +13,6 @@ from common.data.text import Tokenizer
 from common.data import features
 
 import common.helpers as helpers
-import common.metrics as metrics
 
 import transducer_builder
 import conf_utils
@@ -448,9 +447,6 @@ def evaluate(conf, onnx_path, val_loader, val_feat_proc,
     for idx, (pred_result, gts_detokenized) in enumerate(pred_iter):
         preds_detokenized = helpers.gather_predictions(
             [pred_result.get()], detokenize)
-
-        batch_wer, batch_scores, batch_words = metrics.word_error_rate(
-            preds_detokenized, gts_detokenized)
         agg['preds'] += preds_detokenized
         agg['txts'] += gts_detokenized
 
@@ -239,7 +239,8 @@ class Workflow:
             lang = self.args['vocab']['vocab_path']
             symbol_table = read_symbol_table(lang)
             self.train_dataset = Dataset(self.args['train_dataset']['data_mode'], self.args['train_dataset']
-                                         ['data_list'], symbol_table, self.train_conf, None, None, True)
+                                         ['data_list'], symbol_table, self.train_conf, None, None, True,
+                                         rank=self.args['popdist_rank'])
             self.val_dataset = Dataset(self.args['train_dataset']['data_mode'], self.args['val_dataset']
                                        ['data_list'], symbol_table, self.cv_conf, None, None, partition=False)
         else:
@@ -20,16 +20,23 @@ This script has been adapted from some of the original WeNet repo found here:
 Main changes:
     modified the dataset function and IPUCollateFn class
     wenet needs to return 5 features, and then here return 6 values, namely target_in and target_out.
+    added the length bucketing of the DistributedSampler and the bucket batch type
+    added the feat data type reading the features of a feature store
+    added the batch spec augmentation after the padding
 '''
 
 
+import json
+import os
 import random
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch.utils.data import IterableDataset
 
 import src.iterator.processor as processor
+from src.iterator.length_index import bucket_boundaries, bucket_index, read_length_index
 from src.utils.file_utils import read_lists
 
 
@@ -57,12 +64,50 @@ class Processor(IterableDataset):
         return Processor(self, f, *self.args, **self.kw)
 
 
+class SeededProcessor(Processor):
+    def __init__(self, source, f, seed, rank=0, *args, **kw):
+        """ Processor of a seeded random function, called with a new `seed`
+            on each pass over the data. The seed mixes the conf seed, the
+            rank, the dataloader worker id, the epoch and the number of
+            passes over the data of this processor, so that persistent
+            workers, which do not see set_epoch, still draw new values at
+            each epoch.
+        """
+        super().__init__(source, f, *args, **kw)
+        self.seed = seed
+        self.rank = rank
+        self.epoch = 0
+        self.passes = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        super().set_epoch(epoch)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        seed = np.random.SeedSequence(
+            [self.seed, self.rank, worker_id, self.epoch, self.passes])
+        self.passes += 1
+        return self.f(iter(self.source), *self.args,
+                      seed=int(seed.generate_state(1)[0]), **self.kw)
+
+
 class DistributedSampler:
-    def __init__(self, shuffle=True, partition=True):
+    def __init__(self, shuffle=True, partition=True, buckets=None, group_size=1):
+        """
+            Args:
+                buckets(List[int]): length bucket of each item of the data
+                    list, or None to not group the items by bucket
+                group_size(int): number of items of the same bucket that
+                    each worker receives in a row
+        """
         self.epoch = -1
         self.update()
         self.shuffle = shuffle
         self.partition = partition
+        self.buckets = buckets
+        self.group_size = group_size
 
     def update(self):
         assert dist.is_available()
@@ -104,15 +149,47 @@ class DistributedSampler:
         if self.partition:
             if self.shuffle:
                 random.Random(self.epoch).shuffle(data)
+            if self.buckets is not None:
+                data = self.group_by_bucket(data, self.world_size * self.num_workers)
             data = data[self.rank::self.world_size]
+        elif self.buckets is not None:
+            data = self.group_by_bucket(data, self.num_workers)
         data = data[self.worker_id::self.num_workers]
         return data
 
+    def group_by_bucket(self, data, num_partitions):
+        """ Reorder the data in groups of items of the same bucket, so that
+            after the strided partition every rank and worker receives
+            `group_size` items of the same bucket in a row. The order of the
+            groups only depends on the epoch, so every rank computes the same
+            partition.
+
+            Args:
+                data(List): indexes of the data list
+                num_partitions(int): number of ranks times workers the data
+                    is partitioned into
+
+            Returns:
+                List: indexes reordered by groups
+        """
+        group_size = self.group_size * num_partitions
+        bucket_items = {}
+        for index in data:
+            bucket_items.setdefault(self.buckets[index], []).append(index)
+        groups = []
+        for bucket in sorted(bucket_items):
+            items = bucket_items[bucket]
+            groups.extend(items[i:i + group_size]
+                          for i in range(0, len(items), group_size))
+        if self.shuffle:
+            random.Random(self.epoch).shuffle(groups)
+        return [index for group in groups for index in group]
+
 
 class DataList(IterableDataset):
-    def __init__(self, lists, shuffle=True, partition=True):
+    def __init__(self, lists, shuffle=True, partition=True, buckets=None, group_size=1):
         self.lists = lists
-        self.sampler = DistributedSampler(shuffle, partition)
+        self.sampler = DistributedSampler(shuffle, partition, buckets, group_size)
 
     def set_epoch(self, epoch):
         self.sampler.set_epoch(epoch)
@@ -136,61 +213,107 @@ def Dataset(data_type,
             conf,
             bpe_model=None,
             non_lang_syms=None,
-            partition=True):
+            partition=True,
+            rank=0):
     """ Construct dataset from arguments
 
         We have two shuffle stage in the Dataset. The first is global
         shuffle at shards tar/raw file level. The second is global shuffle
         at training samples level.
 
+        With the `bucket` batch type, the bucket boundaries are derived
+        from the `length_index` utt2num_frames file of the batch conf when
+        they are not set, and the raw data list is sampled in groups of
+        utterances of the same bucket.
+
+        The `feat` data type reads the fbank features written by
+        src.iterator.feature_store, `data_list_file` is the data.list of the
+        store. With speed_perturb, the speed perturbed features of the store
+        are used.
+
         Args:
-            data_type(str): raw/shard
+            data_type(str): raw/shard/feat
             bpe_model(str): model for english bpe part
             partition(bool): whether to do data partition in terms of rank
+            rank(int): rank of the instance, mixed in the seed of the batch
+                spec augmentation
     """
-    assert data_type in ['raw', 'shard']
+    assert data_type in ['raw', 'shard', 'feat']
     lists = read_lists(data_list_file)
     shuffle = conf.get('shuffle', False)
-    dataset = DataList(lists, shuffle=shuffle, partition=partition)
+    batch_conf = dict(conf.get('batch_conf', {}))
+    buckets = None
+    if batch_conf.get('batch_type') == 'bucket':
+        length_index_file = batch_conf.pop('length_index', None)
+        num_buckets = batch_conf.pop('num_buckets', 8)
+        if length_index_file is not None:
+            lengths = read_length_index(length_index_file)
+            if 'bucket_boundaries' not in batch_conf:
+                batch_conf['bucket_boundaries'] = bucket_boundaries(
+                    lengths.values(), num_buckets)
+            if data_type in ['raw', 'feat']:
+                buckets = [bucket_index(lengths.get(json.loads(line)['key'], 0),
+                                        batch_conf['bucket_boundaries'])
+                           for line in lists]
+    dataset = DataList(lists, shuffle=shuffle, partition=partition,
+                       buckets=buckets, group_size=batch_conf.get('batch_size', 16))
+    speed_perturb = conf.get('speed_perturb', True)
     if data_type == 'shard':
         dataset = Processor(dataset, processor.url_opener)
         dataset = Processor(dataset, processor.tar_file_and_group)
+    elif data_type == 'feat':
+        dataset = Processor(dataset, processor.parse_feat,
+                            os.path.dirname(data_list_file), speed_perturb)
     else:
         dataset = Processor(dataset, processor.parse_raw)
 
     dataset = Processor(dataset, processor.tokenize, symbol_table, bpe_model,
                         non_lang_syms, conf.get('split_with_space', False))
 
-    resample_conf = conf.get('resample_conf', {})
-    dataset = Processor(dataset, processor.resample, **resample_conf)
+    if data_type != 'feat':
+        resample_conf = conf.get('resample_conf', {})
+        dataset = Processor(dataset, processor.resample, **resample_conf)
 
-    speed_perturb = conf.get('speed_perturb', True)
-    if speed_perturb:
-        dataset = Processor(dataset, processor.speed_perturb)
+        if speed_perturb:
+            dataset = Processor(dataset, processor.speed_perturb)
 
     filter_conf = conf.get('filter_conf', {})
     dataset = Processor(dataset, processor.filter, **filter_conf)
 
-    fbank_conf = conf.get('fbank_conf', {})
-    dataset = Processor(dataset, processor.compute_fbank, **fbank_conf)
+    if data_type != 'feat':
+        fbank_conf = conf.get('fbank_conf', {})
+        dataset = Processor(dataset, processor.compute_fbank, **fbank_conf)
 
     spec_aug = conf.get('spec_aug', True)
-    if spec_aug:
-        spec_aug_conf = conf.get('spec_aug_conf', {})
+    spec_aug_conf = dict(conf.get('spec_aug_conf', {}))
+    # The batch spec augmentation is applied after the padding instead
+    batch_spec_aug = spec_aug_conf.pop('batch', False)
+    spec_aug_inplace = spec_aug_conf.pop('inplace', True)
+    spec_aug_seed = spec_aug_conf.pop('seed', None)
+    if spec_aug and not batch_spec_aug:
         dataset = Processor(dataset, processor.spec_aug, **spec_aug_conf)
 
     if shuffle:
         shuffle_conf = conf.get('shuffle_conf', {})
         dataset = Processor(dataset, processor.shuffle, **shuffle_conf)
 
-    sort = conf.get('sort', True)
+    # The bucket batch already groups utterances of similar lengths
+    sort = conf.get('sort', True) and batch_conf.get('batch_type') != 'bucket'
     if sort:
         sort_conf = conf.get('sort_conf', {})
         dataset = Processor(dataset, processor.sort, **sort_conf)
 
-    batch_conf = conf.get('batch_conf', {})
     dataset = Processor(dataset, processor.batch, **batch_conf)
     dataset = Processor(dataset, processor.padding)
+
+    if spec_aug and batch_spec_aug:
+        if spec_aug_seed is None:
+            dataset = Processor(dataset, processor.batch_spec_aug,
+                                inplace=spec_aug_inplace, **spec_aug_conf)
+        else:
+            dataset = SeededProcessor(dataset, processor.batch_spec_aug,
+                                      spec_aug_seed, rank,
+                                      inplace=spec_aug_inplace, **spec_aug_conf)
     return dataset
 
 
@@ -203,18 +326,22 @@ class IPUCollateFn:
         self.eos = eos_id
 
     def __call__(self, batch):
-        batch_size = len(batch)
+        # Each item of the batch is a padded batch of one or more utterances
         feature_length = torch.cat([i[3] for i in batch])
+        batch_size = feature_length.size(0)
         target_length = torch.cat([(i[4]) for i in batch])
         padded_feature = torch.zeros(
             size=[batch_size, self.max_feature_length, batch[0][1].size(2)])
         padded_target = torch.zeros(
             size=[batch_size, self.max_target_length], dtype=torch.long)
         keys = []
-        for index, sample in enumerate(batch):
-            padded_feature[index, :sample[1][0].size(0), :] = sample[1][0]
-            padded_target[index, :sample[2][0].size(0)] = sample[2][0]
-            keys.append(sample[0][0])
+        index = 0
+        for sample in batch:
+            for key, feature, target, length, label_length in zip(*sample):
+                padded_feature[index, :length, :] = feature[:length]
+                padded_target[index, :label_length] = target[:label_length]
+                keys.append(key)
+                index += 1
         target_out = padded_target.scatter(
             1, target_length.unsqueeze(1).long(), self.eos)
         target_in = torch.nn.functional.pad(
@@ -0,0 +1,177 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Offline fbank extraction into a feature store, read by the `feat` data type
+of the dataset.
+
+The store directory holds:
+    meta.json: the feature dim, dtype, speeds and fbank conf of the store
+    speed{speed}/{shard}.bin: the float16 features of the utterances of a
+        shard, concatenated along the time axis
+    data.list: one json line per utterance with its key, txt and, for each
+        speed, the shard, frame offset and number of frames of its features
+
+Usage:
+    python -m src.iterator.feature_store --data_type raw \
+        --data_list data/train/data.list --output_dir data/train/fbank \
+        --speeds 0.9 1.0 1.1
+'''
+
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+import src.iterator.processor as processor
+from src.utils.file_utils import read_lists
+
+STORE_DTYPE = 'float16'
+
+
+def read_waveforms(data_type, lines):
+    """ Read the waveforms of data list lines
+
+        Args:
+            data_type(str): raw/shard
+            lines(List[str]): data list lines
+
+        Returns:
+            Iterable[{key, wav, txt, sample_rate}]
+    """
+    data = [dict(src=line) for line in lines]
+    if data_type == 'shard':
+        return processor.tar_file_and_group(processor.url_opener(data))
+    return processor.parse_raw(data)
+
+
+def write_shard(data_type, lines, output_dir, shard, speeds, resample_rate,
+                fbank_conf):
+    """ Extract the fbank of the utterances of data list lines, for each speed,
+        and write them in a shard of the store
+
+        Returns:
+            List[dict]: the index json objects of the utterances
+    """
+    index = {}
+    files = {}
+    offsets = {}
+    for speed in speeds:
+        speed_dir = 'speed{}'.format(speed)
+        os.makedirs(os.path.join(output_dir, speed_dir), exist_ok=True)
+        files[speed] = os.path.join(speed_dir, '{:05d}.bin'.format(shard))
+        offsets[speed] = 0
+    fouts = {speed: open(os.path.join(output_dir, path), 'wb')
+             for speed, path in files.items()}
+    try:
+        for sample in read_waveforms(data_type, lines):
+            sample = next(processor.resample([sample], resample_rate))
+            feats = {}
+            for speed in speeds:
+                waveform = processor.apply_speed(sample['wav'],
+                                                 sample['sample_rate'], speed)
+                mat = processor.fbank(waveform, sample['sample_rate'],
+                                      **fbank_conf)
+                mat.numpy().astype(STORE_DTYPE).tofile(fouts[speed])
+                feats[str(speed)] = [files[speed], offsets[speed], mat.size(0)]
+                offsets[speed] += mat.size(0)
+            index[sample['key']] = dict(key=sample['key'], txt=sample['txt'],
+                                        feats=feats)
+    finally:
+        for fout in fouts.values():
+            fout.close()
+    return list(index.values())
+
+
+def build_feature_store(data_type,
+                        data_list_file,
+                        output_dir,
+                        fbank_conf,
+                        resample_rate=16000,
+                        speeds=None,
+                        utterances_per_shard=1000,
+                        num_workers=1):
+    """ Write the fbank features of a data list in a feature store
+
+        Args:
+            data_type(str): raw/shard, a shard of the store is written for
+                each tar file, or for `utterances_per_shard` raw utterances
+            data_list_file(str): data list
+            output_dir(str): directory of the feature store
+            fbank_conf(dict): conf of processor.compute_fbank, the features
+                are extracted without dither
+            resample_rate(int): sample rate of the waveforms
+            speeds(List[float]): speeds of the speed perturbed features
+            num_workers(int): number of shards written in parallel
+    """
+    assert data_type in ['raw', 'shard']
+    speeds = speeds or [1.0]
+    assert 1.0 in speeds
+    fbank_conf = dict(fbank_conf, dither=0.0)
+    lists = read_lists(data_list_file)
+    if data_type == 'shard':
+        shards = [[line] for line in lists]
+    else:
+        shards = [lists[i:i + utterances_per_shard]
+                  for i in range(0, len(lists), utterances_per_shard)]
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(write_shard, data_type, lines, output_dir,
+                                   shard, speeds, resample_rate, fbank_conf)
+                   for shard, lines in enumerate(shards)]
+        with open(os.path.join(output_dir, 'data.list'), 'w',
+                  encoding='utf8') as fout:
+            for shard, future in enumerate(futures):
+                for obj in future.result():
+                    fout.write(json.dumps(obj, ensure_ascii=False) + '\n')
+                logging.info('Wrote shard {}/{}'.format(shard + 1, len(shards)))
+
+    meta = dict(feat_dim=fbank_conf.get('num_mel_bins', 23),
+                dtype=STORE_DTYPE,
+                speeds=[str(speed) for speed in speeds],
+                fbank_conf=fbank_conf,
+                resample_rate=resample_rate)
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as fout:
+        json.dump(meta, fout, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Extract the fbank features of a data list into a feature store')
+    parser.add_argument('--data_type', default='raw', choices=['raw', 'shard'])
+    parser.add_argument('--data_list', required=True, help='data list file')
+    parser.add_argument('--output_dir', required=True,
+                        help='directory of the feature store')
+    parser.add_argument('--config', default='configs/train.yaml',
+                        help='config with the fbank and resample conf of train_conf')
+    parser.add_argument('--speeds', type=float, nargs='+', default=[1.0],
+                        help='speeds of the speed perturbed features')
+    parser.add_argument('--utterances_per_shard', type=int, default=1000)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, 'r') as fin:
+        train_conf = yaml.safe_load(fin)['train_conf']
+    build_feature_store(args.data_type,
+                        args.data_list,
+                        args.output_dir,
+                        train_conf.get('fbank_conf', {}),
+                        train_conf.get('resample_conf', {}).get('resample_rate', 16000),
+                        args.speeds,
+                        args.utterances_per_shard,
+                        args.num_workers)
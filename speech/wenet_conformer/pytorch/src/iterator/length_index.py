@@ -0,0 +1,151 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Length index of a data list, in the Kaldi utt2num_frames format, and the
+length buckets derived from it.
+
+Usage:
+    python -m src.iterator.length_index --data_type raw \
+        --data_list data/train/data.list --output data/train/utt2num_frames
+'''
+
+import argparse
+import bisect
+import json
+import logging
+import tarfile
+
+import numpy as np
+import torchaudio
+
+from src.iterator.processor import AUDIO_FORMAT_SETS
+from src.utils.file_utils import read_lists
+
+# The features have 100 frames every second, like in processor.filter
+FRAMES_PER_SECOND = 100
+
+
+def raw_num_frames(json_line):
+    """ Number of feature frames of a raw data list line
+
+        Args:
+            json_line(str): json line with key/wav/txt
+
+        Returns:
+            Tuple(key, num_frames)
+    """
+    obj = json.loads(json_line)
+    if 'start' in obj:
+        duration = obj['end'] - obj['start']
+    else:
+        info = torchaudio.info(obj['wav'])
+        duration = info.num_frames / info.sample_rate
+    return obj['key'], int(duration * FRAMES_PER_SECOND)
+
+
+def shard_num_frames(tar_file):
+    """ Number of feature frames of all the utterances of a shard
+
+        Args:
+            tar_file(str): local shard
+
+        Returns:
+            List[Tuple(key, num_frames)]
+    """
+    lengths = []
+    with tarfile.open(tar_file, mode="r|*") as stream:
+        for tarinfo in stream:
+            pos = tarinfo.name.rfind('.')
+            prefix, postfix = tarinfo.name[:pos], tarinfo.name[pos + 1:]
+            if postfix in AUDIO_FORMAT_SETS:
+                with stream.extractfile(tarinfo) as file_obj:
+                    waveform, sample_rate = torchaudio.load(file_obj)
+                lengths.append(
+                    (prefix, int(waveform.size(1) / sample_rate * FRAMES_PER_SECOND)))
+    return lengths
+
+
+def build_length_index(data_type, data_list_file):
+    """ Number of feature frames of every utterance of a data list
+
+        Args:
+            data_type(str): raw/shard
+            data_list_file(str): data list
+
+        Returns:
+            Dict[key, num_frames]
+    """
+    assert data_type in ['raw', 'shard']
+    lengths = {}
+    for line in read_lists(data_list_file):
+        if data_type == 'raw':
+            key, num_frames = raw_num_frames(line)
+            lengths[key] = num_frames
+        else:
+            lengths.update(shard_num_frames(line))
+    return lengths
+
+
+def write_length_index(lengths, index_file):
+    with open(index_file, 'w', encoding='utf8') as fout:
+        for key, num_frames in lengths.items():
+            fout.write('{} {}\n'.format(key, num_frames))
+
+
+def read_length_index(index_file):
+    lengths = {}
+    for line in read_lists(index_file):
+        key, num_frames = line.split()
+        lengths[key] = int(num_frames)
+    return lengths
+
+
+def bucket_boundaries(lengths, num_buckets):
+    """ Upper bounds of length buckets holding the same number of utterances
+
+        Args:
+            lengths(Iterable[int]): number of frames of the utterances
+            num_buckets(int): number of buckets
+
+        Returns:
+            List[int]: the num_buckets - 1 boundaries, the last bucket has
+                no upper bound
+    """
+    quantiles = np.quantile(np.fromiter(lengths, dtype=np.float64),
+                            np.arange(1, num_buckets) / num_buckets)
+    return sorted(set(int(np.ceil(q)) for q in quantiles))
+
+
+def bucket_index(num_frames, boundaries):
+    """ Bucket of an utterance, an utterance of `boundaries[i]` frames is
+        in the bucket i
+    """
+    return bisect.bisect_left(boundaries, num_frames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write the number of frames of each utterance of a data list')
+    parser.add_argument('--data_type', default='raw', choices=['raw', 'shard'])
+    parser.add_argument('--data_list', required=True, help='data list file')
+    parser.add_argument('--output', required=True, help='utt2num_frames file')
+    parser.add_argument('--num_buckets', type=int, default=8,
+                        help='number of buckets of the printed boundaries')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    lengths = build_length_index(args.data_type, args.data_list)
+    write_length_index(lengths, args.output)
+    logging.info('{} utterances, bucket boundaries: {}'.format(
+        len(lengths), bucket_boundaries(lengths.values(), args.num_buckets)))
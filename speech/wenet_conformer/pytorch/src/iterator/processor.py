@@ -19,16 +19,22 @@ This script has been adapted from some of the original WeNet repo found here:
 ]
 Main change:
     modified the padding function's label_lengths dtype
+    added the bucket_batch function
+    added the parse_feat function reading the features of a feature store
+    added the batch_spec_aug function
 '''
 
+import bisect
 import logging
 import json
+import os
 import random
 import re
 import tarfile
 from subprocess import PIPE, Popen
 from urllib.parse import urlparse
 
+import numpy as np
 import torch
 import torchaudio
 import torchaudio.compliance.kaldi as kaldi
@@ -159,6 +165,40 @@ def parse_raw(data):
             logging.warning('Failed to read {}'.format(wav_file))
 
 
+def parse_feat(data, store_dir, speed_perturb=False):
+    """ Read key/txt/feat of a feature store index json line. The features
+        are views of the memory-mapped shards, they are only copied when
+        they are modified.
+
+        Args:
+            data: Iterable[str], str is a json line has key/txt/feats
+            store_dir: directory of the feature store
+            speed_perturb: pick a random speed among the speeds of the store,
+                the features of the speed 1.0 are read otherwise
+
+        Returns:
+            Iterable[{key, txt, feat}]
+    """
+    with open(os.path.join(store_dir, 'meta.json'), 'r') as fin:
+        meta = json.load(fin)
+    shards = {}
+    for sample in data:
+        assert 'src' in sample
+        obj = json.loads(sample['src'])
+        assert 'key' in obj
+        assert 'txt' in obj
+        assert 'feats' in obj
+        feats = obj['feats']
+        speed = random.choice(sorted(feats)) if speed_perturb else '1.0'
+        shard, offset, num_frames = feats[speed]
+        if shard not in shards:
+            shards[shard] = np.memmap(os.path.join(store_dir, shard),
+                                      dtype=meta['dtype'],
+                                      mode='c').reshape(-1, meta['feat_dim'])
+        feat = torch.from_numpy(shards[shard][offset:offset + num_frames])
+        yield dict(key=obj['key'], txt=obj['txt'], feat=feat)
+
+
 def filter(data,
            max_length=10240,
            min_length=10,
@@ -170,7 +210,8 @@ def filter(data,
         Inplace operation.
 
         Args::
-            data: Iterable[{key, wav, label, sample_rate}]
+            data: Iterable[{key, wav, label, sample_rate}] or
+                Iterable[{key, feat, label}]
             max_length: drop utterance which is greater than max_length(10ms)
             min_length: drop utterance which is less than min_length(10ms)
             token_max_length: drop utterance which is greater than
@@ -187,11 +228,14 @@ def filter(data,
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
-        assert 'sample_rate' in sample
-        assert 'wav' in sample
         assert 'label' in sample
-        # sample['wav'] is torch.Tensor, we have 100 frames every second
-        num_frames = sample['wav'].size(1) / sample['sample_rate'] * 100
+        if 'feat' in sample:
+            num_frames = sample['feat'].size(0)
+        else:
+            assert 'sample_rate' in sample
+            assert 'wav' in sample
+            # sample['wav'] is torch.Tensor, we have 100 frames every second
+            num_frames = sample['wav'].size(1) / sample['sample_rate'] * 100
         if num_frames < min_length:
             continue
         if num_frames > max_length:
@@ -231,6 +275,17 @@ def resample(data, resample_rate=16000):
         yield sample
 
 
+def apply_speed(waveform, sample_rate, speed):
+    """ Change the speed of a waveform, keeping its sample rate
+    """
+    if speed == 1.0:
+        return waveform
+    wav, _ = torchaudio.sox_effects.apply_effects_tensor(
+        waveform, sample_rate,
+        [['speed', str(speed)], ['rate', str(sample_rate)]])
+    return wav
+
+
 def speed_perturb(data, speeds=None):
     """ Apply speed perturb to the data.
         Inplace operation.
@@ -250,15 +305,29 @@ def speed_perturb(data, speeds=None):
         sample_rate = sample['sample_rate']
         waveform = sample['wav']
         speed = random.choice(speeds)
-        if speed != 1.0:
-            wav, _ = torchaudio.sox_effects.apply_effects_tensor(
-                waveform, sample_rate,
-                [['speed', str(speed)], ['rate', str(sample_rate)]])
-            sample['wav'] = wav
+        sample['wav'] = apply_speed(waveform, sample_rate, speed)
 
         yield sample
 
 
+def fbank(waveform,
+          sample_rate,
+          num_mel_bins=23,
+          frame_length=25,
+          frame_shift=10,
+          dither=0.0):
+    """ Kaldi fbank of a waveform
+    """
+    waveform = waveform * (1 << 15)
+    return kaldi.fbank(waveform,
+                       num_mel_bins=num_mel_bins,
+                       frame_length=frame_length,
+                       frame_shift=frame_shift,
+                       dither=dither,
+                       energy_floor=0.0,
+                       sample_frequency=sample_rate)
+
+
 def compute_fbank(data,
                   num_mel_bins=23,
                   frame_length=25,
@@ -277,17 +346,9 @@ def compute_fbank(data,
         assert 'wav' in sample
         assert 'key' in sample
         assert 'label' in sample
-        sample_rate = sample['sample_rate']
-        waveform = sample['wav']
-        waveform = waveform * (1 << 15)
         # Only keep key, feat, label
-        mat = kaldi.fbank(waveform,
-                          num_mel_bins=num_mel_bins,
-                          frame_length=frame_length,
-                          frame_shift=frame_shift,
-                          dither=dither,
-                          energy_floor=0.0,
-                          sample_frequency=sample_rate)
+        mat = fbank(sample['wav'], sample['sample_rate'], num_mel_bins,
+                    frame_length, frame_shift, dither)
         yield dict(key=sample['key'], label=sample['label'], feat=mat)
 
 
@@ -409,6 +470,64 @@ def spec_aug(data, num_t_mask=2, num_f_mask=2, max_t=50, max_f=10, max_w=80):
         yield sample
 
 
+def batch_spec_aug(data, num_t_mask=2, num_f_mask=2, max_t=50, max_f=10,
+                   max_w=80, inplace=True, seed=None):
+    """ Do spec augmentation on padded batches, the masks of all the
+        utterances of a batch are drawn and applied at once. The masks are
+        drawn like in spec_aug, the time masks start inside the utterance
+        lengths.
+
+        Args:
+            data: Iterable[Tuple(keys, feats, labels, feats lengths,
+                label lengths)]
+            num_t_mask: number of time mask to apply
+            num_f_mask: number of freq mask to apply
+            max_t: max width of time mask
+            max_f: max width of freq mask
+            max_w: max width of time warp, unused like in spec_aug
+            inplace: mask the padded features in place instead of a copy
+            seed: seed of the masks of this pass over the data, see
+                dataset.SeededProcessor, the torch global generator is used
+                if None
+
+        Returns:
+            Iterable[Tuple(keys, feats, labels, feats lengths, label lengths)]
+    """
+    generator = None
+    if seed is not None:
+        generator = torch.Generator().manual_seed(seed)
+    for sample in data:
+        keys, feats, labels, feats_lengths, label_lengths = sample
+        assert isinstance(feats, torch.Tensor)
+        batch_size, max_frames, max_freq = feats.shape
+        lengths = feats_lengths.unsqueeze(1).long()
+        # time mask
+        start = (torch.rand(batch_size, num_t_mask, generator=generator) *
+                 lengths).long()
+        end = torch.min(lengths, start + torch.randint(
+            1, max_t + 1, (batch_size, num_t_mask), generator=generator))
+        frames = torch.arange(max_frames).view(1, 1, -1)
+        t_mask = ((frames >= start.unsqueeze(2)) &
+                  (frames < end.unsqueeze(2))).any(1)
+        # freq mask
+        start = torch.randint(0, max_freq, (batch_size, num_f_mask),
+                              generator=generator)
+        end = torch.clamp(start + torch.randint(
+            1, max_f + 1, (batch_size, num_f_mask), generator=generator),
+            max=max_freq)
+        freqs = torch.arange(max_freq).view(1, 1, -1)
+        f_mask = ((freqs >= start.unsqueeze(2)) &
+                  (freqs < end.unsqueeze(2))).any(1)
+        if not inplace:
+            feats = feats.clone()
+        # Only write the masked frames and frequencies
+        batch_index, frame_index = t_mask.nonzero(as_tuple=True)
+        feats[batch_index, frame_index] = 0
+        batch_index, freq_index = f_mask.nonzero(as_tuple=True)
+        feats[batch_index, :, freq_index] = 0
+        yield (keys, feats, labels, feats_lengths, label_lengths)
+
+
 def shuffle(data, shuffle_size=10000):
     """ Local shuffle the data
 
@@ -510,13 +629,108 @@ def dynamic_batch(data, max_frames_in_batch=12000):
         yield buf
 
 
-def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000):
-    """ Wrapper for static/dynamic batch
+def bucket_batch(data,
+                 bucket_boundaries=None,
+                 batch_size=16,
+                 max_frames_in_batch=0,
+                 max_tokens_in_batch=0,
+                 drop_last=False,
+                 log_interval=1000):
+    """ Batch the data in length buckets, a batch only holds utterances of
+        the same bucket. A batch is emitted when it has `batch_size`
+        utterances, or when adding an utterance would make the padded frames
+        or tokens of the batch exceed `max_frames_in_batch` or
+        `max_tokens_in_batch`. The padding efficiency, the ratio of the real
+        frames over the padded frames of the batches, is logged every
+        `log_interval` batches.
+
+        Args:
+            data: Iterable[{key, feat, label}]
+            bucket_boundaries(List[int]): upper bounds of the feature
+                lengths of the buckets, the last bucket has no upper bound
+            batch_size: max number of utterances in one batch
+            max_frames_in_batch: max padded frames in one batch, 0 for no limit
+            max_tokens_in_batch: max padded tokens in one batch, 0 for no limit
+            drop_last: drop the batches left over at the end of the data
+                that have less than `batch_size` utterances, so that all the
+                batches have the same size; it can not be used with
+                `max_frames_in_batch` or `max_tokens_in_batch`
+            log_interval: number of batches between the efficiency logs,
+                0 to disable them
+
+        Returns:
+            Iterable[List[{key, feat, label}]]
+    """
+    if bucket_boundaries is None:
+        raise ValueError(
+            'The bucket batch type needs bucket boundaries: set '
+            '`bucket_boundaries` in the batch conf, or `length_index` to an '
+            'utt2num_frames file written by src.iterator.length_index')
+    if drop_last and (max_frames_in_batch or max_tokens_in_batch):
+        raise ValueError(
+            'drop_last of the bucket batch type keeps batches of batch_size '
+            'utterances, max_frames_in_batch and max_tokens_in_batch must be 0')
+    num_buckets = len(bucket_boundaries) + 1
+    buckets = [[] for _ in range(num_buckets)]
+    longest_frames = [0] * num_buckets
+    longest_tokens = [0] * num_buckets
+    stats = dict(batches=0, frames=0, padded_frames=0)
+
+    def emit(bucket):
+        buf = buckets[bucket]
+        stats['batches'] += 1
+        stats['frames'] += sum(x['feat'].size(0) for x in buf)
+        stats['padded_frames'] += longest_frames[bucket] * len(buf)
+        if log_interval and stats['batches'] % log_interval == 0:
+            logging.info('bucket_batch: {} batches, padding efficiency {:.3f}'.format(
+                stats['batches'], stats['frames'] / stats['padded_frames']))
+        buckets[bucket] = []
+        longest_frames[bucket] = 0
+        longest_tokens[bucket] = 0
+        return buf
+
+    for sample in data:
+        assert 'feat' in sample
+        assert isinstance(sample['feat'], torch.Tensor)
+        new_sample_frames = sample['feat'].size(0)
+        new_sample_tokens = len(sample['label'])
+        bucket = bisect.bisect_left(bucket_boundaries, new_sample_frames)
+        buf = buckets[bucket]
+        if len(buf) > 0:
+            frames_after_padding = max(longest_frames[bucket],
+                                       new_sample_frames) * (len(buf) + 1)
+            tokens_after_padding = max(longest_tokens[bucket],
+                                       new_sample_tokens) * (len(buf) + 1)
+            if (max_frames_in_batch and frames_after_padding > max_frames_in_batch) or \
+                    (max_tokens_in_batch and tokens_after_padding > max_tokens_in_batch):
+                yield emit(bucket)
+        buckets[bucket].append(sample)
+        longest_frames[bucket] = max(longest_frames[bucket], new_sample_frames)
+        longest_tokens[bucket] = max(longest_tokens[bucket], new_sample_tokens)
+        if len(buckets[bucket]) >= batch_size:
+            yield emit(bucket)
+    # The samples left over
+    for bucket in range(num_buckets):
+        if len(buckets[bucket]) > 0 and not drop_last:
+            yield emit(bucket)
+
+
+def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=None,
+          **bucket_conf):
+    """ Wrapper for static/dynamic/bucket batch, `max_frames_in_batch` is
+        12000 for the dynamic batch and 0 (no limit) for the bucket batch
+        when not set
     """
     if batch_type == 'static':
         return static_batch(data, batch_size)
     elif batch_type == 'dynamic':
+        if max_frames_in_batch is None:
+            max_frames_in_batch = 12000
         return dynamic_batch(data, max_frames_in_batch)
+    elif batch_type == 'bucket':
+        return bucket_batch(data, batch_size=batch_size,
+                            max_frames_in_batch=max_frames_in_batch or 0,
+                            **bucket_conf)
     else:
         logging.fatal('Unsupported batch type {}'.format(batch_type))
 
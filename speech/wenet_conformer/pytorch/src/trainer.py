@@ -105,7 +105,7 @@ class Trainer:
             count += 1
         self.steps_per_epoch = count
         self.logger.info(f'step num per epoch is: {self.steps_per_epoch}.')
-        self.samples_per_step = self.train_iterator._combined_batch_size
+        self.samples_per_step = self.train_iterator._combined_batch_size * self._utterances_per_item()
         self.logger.info(f'sample num per step is: {self.samples_per_step}.')
         self.logger.info(f'preparing training done.')
         self.num_epochs = self.args['trainer']['num_epochs']
@@ -123,7 +123,7 @@ class Trainer:
             count += 1
         self.steps_per_epoch = count
         self.logger.info(f'step num per epoch is: {self.steps_per_epoch}.')
-        self.samples_per_step = self.val_iterator._combined_batch_size
+        self.samples_per_step = self.val_iterator._combined_batch_size * self._utterances_per_item()
         self.logger.info(f'sample num per step is: {self.samples_per_step}.')
         self.logger.info(f'preparing val done.')
         self.num_epochs = self.args['trainer']['num_epochs']
@@ -131,6 +131,13 @@ class Trainer:
         self.save_checkpoint_path = self.args['checkpoints']['save_checkpoint_path']
 
 
+    def _utterances_per_item(self):
+        # An item of the dataset is a batch of `batch_size` utterances with the bucket batch type
+        batch_conf = self.args['train_conf'].get('batch_conf', {})
+        if batch_conf.get('batch_type') == 'bucket' and not self.args['train_dataset']['use_generated_data']:
+            return batch_conf.get('batch_size', 16)
+        return 1
+
     def _wrap_model(self, type):
         self.logger.info(f'wrapping model.')
         if type == 'train':
@@ -247,6 +254,8 @@ class Trainer:
 
         for epoch in range(self.start_epoch, self.num_epochs):
             self.logger.info(f'training epoch: {epoch}')
+            if hasattr(self.train_iterator.dataset, 'set_epoch'):
+                self.train_iterator.dataset.set_epoch(epoch)
             start = time.time()
             self._train_one_epoch(epoch)
             end = time.time()
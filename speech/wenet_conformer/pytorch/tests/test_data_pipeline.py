@@ -0,0 +1,179 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import random
+
+import numpy as np
+import pytest
+import torch
+
+import src.iterator.processor as processor
+from src.iterator.dataset import DistributedSampler, IPUCollateFn, SeededProcessor
+from src.iterator.length_index import bucket_boundaries, bucket_index
+
+
+def random_samples(num_samples, feat_dim=4, seed=0):
+    rng = random.Random(seed)
+    samples = []
+    for i in range(num_samples):
+        num_frames = rng.randint(10, 500)
+        samples.append(dict(key='utt{}'.format(i),
+                            feat=torch.rand(num_frames, feat_dim),
+                            label=[rng.randint(1, 9) for _ in range(rng.randint(1, 20))]))
+    return samples
+
+
+@pytest.mark.parametrize("max_frames_in_batch", [0, 1500])
+def test_bucket_batch(max_frames_in_batch):
+    samples = random_samples(300)
+    boundaries = bucket_boundaries([x['feat'].size(0) for x in samples], 4)
+    batches = list(processor.bucket_batch(samples, boundaries, batch_size=8,
+                                          max_frames_in_batch=max_frames_in_batch))
+
+    assert sorted(x['key'] for b in batches for x in b) == sorted(x['key'] for x in samples)
+    for b in batches:
+        assert 0 < len(b) <= 8
+        assert len(set(bucket_index(x['feat'].size(0), boundaries) for x in b)) == 1
+        if max_frames_in_batch:
+            assert len(b) == 1 or max(x['feat'].size(0) for x in b) * len(b) <= max_frames_in_batch
+
+    full_batches = list(processor.bucket_batch(samples, boundaries, batch_size=8, drop_last=True))
+    assert all(len(b) == 8 for b in full_batches)
+
+
+def test_bucket_batch_conf():
+    samples = [dict(key='utt{}'.format(i), feat=torch.rand(1000, 4), label=[1]) for i in range(48)]
+    # Without max_frames_in_batch, the bucket batches are not limited in frames
+    batches = list(processor.batch(samples, batch_type='bucket', batch_size=16,
+                                   bucket_boundaries=[500], drop_last=True))
+    assert [len(b) for b in batches] == [16, 16, 16]
+
+    with pytest.raises(ValueError, match='max_frames_in_batch'):
+        list(processor.batch(samples, batch_type='bucket', batch_size=16, max_frames_in_batch=12000,
+                             bucket_boundaries=[500], drop_last=True))
+    with pytest.raises(ValueError, match='length_index'):
+        list(processor.batch(samples, batch_type='bucket', batch_size=16))
+
+
+def test_sampler_group_by_bucket():
+    buckets = [random.Random(0).randint(0, 3) for _ in range(1000)]
+    partitions = []
+    for rank in range(2):
+        sampler = DistributedSampler(shuffle=True, partition=True, buckets=buckets, group_size=4)
+        sampler.rank, sampler.world_size = rank, 2
+        sampler.set_epoch(3)
+        partitions.append(sampler.sample(buckets))
+
+    assert sorted(partitions[0] + partitions[1]) == list(range(1000))
+    # The partition only depends on the epoch
+    sampler.set_epoch(3)
+    assert sampler.sample(buckets) == partitions[1]
+    # Each rank receives groups of items of the same bucket
+    first_group = [buckets[i] for i in partitions[0][:4]]
+    assert len(set(first_group)) == 1
+
+
+def test_collate_bucket_batches():
+    samples = random_samples(6)
+    padded = list(processor.padding(processor.static_batch(samples, 3)))
+    keys, features, feature_length, _, target_out, target_length = IPUCollateFn(
+        600, 30, torch.float32, 10, 10)(padded)
+
+    assert features.shape == (6, 600, 4)
+    for index, key in enumerate(keys):
+        sample = next(x for x in samples if x['key'] == key)
+        num_frames = sample['feat'].size(0)
+        assert feature_length[index] == num_frames
+        assert torch.equal(features[index, :num_frames], sample['feat'])
+        assert features[index, num_frames:].abs().sum() == 0
+        assert target_out[index, :len(sample['label'])].tolist() == sample['label']
+        assert target_out[index, len(sample['label'])] == 10
+        assert target_length[index] == len(sample['label']) + 1
+
+
+def test_parse_feat(tmp_path):
+    feats = {'utt0': torch.rand(30, 4), 'utt1': torch.rand(12, 4), 'utt2': torch.rand(7, 4)}
+    os.makedirs(tmp_path / 'speed1.0')
+    lines = []
+    offset = 0
+    with open(tmp_path / 'speed1.0' / '00000.bin', 'wb') as fout:
+        for key, feat in feats.items():
+            feat.numpy().astype(np.float16).tofile(fout)
+            lines.append(json.dumps(dict(key=key, txt='a b', feats={'1.0': ['speed1.0/00000.bin', offset, feat.size(0)]})))
+            offset += feat.size(0)
+    with open(tmp_path / 'meta.json', 'w') as fout:
+        json.dump(dict(feat_dim=4, dtype='float16', speeds=['1.0']), fout)
+
+    samples = list(processor.parse_feat([dict(src=line) for line in lines], str(tmp_path)))
+    assert [x['key'] for x in samples] == list(feats)
+    for sample in samples:
+        assert sample['txt'] == 'a b'
+        assert torch.equal(sample['feat'], feats[sample['key']].half())
+
+
+@pytest.mark.parametrize("inplace", [True, False])
+def test_batch_spec_aug(inplace):
+    samples = random_samples(8, feat_dim=40)
+    for sample in samples:
+        sample['feat'] += 1.
+    padded = list(processor.padding(processor.static_batch(samples, 4)))
+    original = [batch[1].clone() for batch in padded]
+    augmented = list(processor.batch_spec_aug(padded, max_t=20, max_f=5, inplace=inplace, seed=0))
+
+    for batch, input_batch, feats in zip(augmented, padded, original):
+        assert (batch[1] is input_batch[1]) == inplace
+        for index, length in enumerate(batch[3].tolist()):
+            feat = batch[1][index]
+            masked = feat[:length] == 0
+            masked_frames = masked.all(1)
+            masked_freqs = masked.all(0)
+            assert 0 < masked_frames.sum() <= 2 * 20
+            assert 0 < masked_freqs.sum() <= 2 * 5
+            # Every masked value is in a masked frame or a masked frequency
+            assert torch.equal(masked, masked_frames[:, None] | masked_freqs[None, :])
+            unmasked = ~masked
+            assert torch.equal(feat[:length][unmasked], feats[index, :length][unmasked])
+            assert feat[length:].abs().sum() == 0
+
+    padded = list(processor.padding(processor.static_batch(samples, 4)))
+    again = list(processor.batch_spec_aug(padded, max_t=20, max_f=5, inplace=False, seed=0))
+    for batch, other in zip(augmented, again):
+        assert torch.equal(batch[1], other[1])
+
+
+def test_seeded_batch_spec_aug():
+    class Batches:
+        def __init__(self):
+            self.epoch = -1
+
+        def set_epoch(self, epoch):
+            self.epoch = epoch
+
+        def __iter__(self):
+            samples = random_samples(4, feat_dim=40)
+            return processor.padding(processor.static_batch(samples, 4))
+
+    def masks(rank, epoch, passes=1):
+        dataset = SeededProcessor(Batches(), processor.batch_spec_aug, 0, rank, max_t=20, max_f=5)
+        dataset.set_epoch(epoch)
+        for _ in range(passes):
+            feats = next(iter(dataset))[1]
+        return feats == 0
+
+    assert torch.equal(masks(0, 1), masks(0, 1))
+    # The masks change with the epoch, the rank, and at each pass of persistent workers
+    assert not torch.equal(masks(0, 1), masks(0, 2))
+    assert not torch.equal(masks(0, 1), masks(1, 1))
+    assert not torch.equal(masks(0, 1), masks(0, 1, passes=2))
@@ -126,6 +126,125 @@ def hard_nms(dets, iou_thresh=None):
   return dets[keep]
 
 
+def pairwise_iou(boxes1, boxes2, method=None):
+  """IOU, or DIOU, between all the pairs of boxes of each image.
+
+  The areas follow the +1 pixel convention of hard_nms and diou_nms.
+
+  Args:
+    boxes1: boxes with shape (batch, n, 4) and format [x1, y1, x2, y2].
+    boxes2: boxes with shape (batch, m, 4) and format [x1, y1, x2, y2].
+    method: 'diou' for the DIOU, the IOU otherwise.
+
+  Returns:
+    numpy.array: IOU with shape (batch, n, m).
+  """
+  x1a, y1a, x2a, y2a = [boxes1[:, :, None, i] for i in range(4)]
+  x1b, y1b, x2b, y2b = [boxes2[:, None, :, i] for i in range(4)]
+  areas_a = (x2a - x1a + 1) * (y2a - y1a + 1)
+  areas_b = (x2b - x1b + 1) * (y2b - y1b + 1)
+
+  w = np.maximum(0.0, np.minimum(x2a, x2b) - np.maximum(x1a, x1b) + 1)
+  h = np.maximum(0.0, np.minimum(y2a, y2b) - np.maximum(y1a, y1b) + 1)
+  intersection = w * h
+  iou = intersection / (areas_a + areas_b - intersection)
+  if method != 'diou':
+    return iou
+
+  square_of_the_diagonal = (
+      (np.maximum(x2a, x2b) - np.minimum(x1a, x1b))**2 +
+      (np.maximum(y2a, y2b) - np.minimum(y1a, y1b))**2)
+  square_of_center_distance = (((x1a + x2a) / 2 - (x1b + x2b) / 2)**2 +
+                               ((y1a + y2a) / 2 - (y1b + y2b) / 2)**2)
+  # Add 1e-10 for numerical stability.
+  return iou - square_of_center_distance / (square_of_the_diagonal + 1e-10)
+
+
+def batched_nms(boxes, scores, classes=None, iou_thresh=None, method=None,
+                max_output_size=None, block_size=512):
+  """Hard or DIOU non-maximum suppression of a batch of images at once.
+
+  The boxes are visited by decreasing score in blocks. Each block is first
+  suppressed by the boxes retained in the previous blocks, then the greedy
+  suppression inside the block is solved with the Cluster-NMS fixed point
+  iteration, which retains the same boxes as hard_nms and diou_nms.
+
+  Reference: https://arxiv.org/abs/2005.03572
+
+  Args:
+    boxes: boxes with shape (batch, num, 4) and format [x1, y1, x2, y2].
+    scores: scores with shape (batch, num).
+    classes: classes with shape (batch, num). If set, boxes only suppress the
+      boxes of their class, like the nms of each class in per_class_nms.
+    iou_thresh: IOU threshold.
+    method: 'diou' for the DIOU non-maximum suppression, hard otherwise.
+    max_output_size: maximum number of retained boxes per image.
+    block_size: number of boxes suppressed at once.
+
+  Returns:
+    numpy.array: indices of the retained boxes by decreasing score, with shape
+      (batch, max_output_size) and padded with -1.
+    numpy.array: number of retained boxes per image, with shape (batch,).
+  """
+  iou_thresh = iou_thresh or 0.5
+  batch_size, num_boxes = scores.shape
+  max_output_size = max_output_size or num_boxes
+
+  order = scores.argsort(axis=1)[:, ::-1]
+  boxes = np.take_along_axis(boxes, order[:, :, None], axis=1)
+  if classes is not None:
+    classes = np.take_along_axis(classes, order, axis=1)
+
+  # Positions in the sorted boxes of the retained boxes
+  keep_positions = np.full((batch_size, max_output_size), -1, dtype=np.int64)
+  num_keep = np.zeros(batch_size, dtype=np.int64)
+  batch_range = np.arange(batch_size)
+
+  for start in range(0, num_boxes, block_size):
+    active = num_keep < max_output_size
+    if not active.any():
+      break
+    block_boxes = boxes[:, start:start + block_size]
+    candidates = np.repeat(active[:, None], block_boxes.shape[1], axis=1)
+
+    max_keep = num_keep.max()
+    if max_keep > 0:
+      previous = np.maximum(keep_positions[:, :max_keep], 0)
+      overlap = pairwise_iou(block_boxes, boxes[batch_range[:, None], previous],
+                             method) > iou_thresh
+      overlap &= (np.arange(max_keep) < num_keep[:, None])[:, None, :]
+      if classes is not None:
+        overlap &= (classes[:, start:start + block_size, None] ==
+                    classes[batch_range[:, None], previous][:, None, :])
+      candidates &= ~overlap.any(axis=2)
+
+    # A box can only be suppressed by a retained box with a higher score.
+    overlap = np.triu(pairwise_iou(block_boxes, block_boxes, method) > iou_thresh,
+                      k=1)
+    if classes is not None:
+      block_classes = classes[:, start:start + block_size]
+      overlap &= block_classes[:, :, None] == block_classes[:, None, :]
+    overlap &= candidates[:, :, None]
+    keep = candidates
+    while True:
+      new_keep = candidates & ~(overlap & keep[:, :, None]).any(axis=1)
+      if np.array_equal(new_keep, keep):
+        break
+      keep = new_keep
+
+    positions = num_keep[:, None] + np.cumsum(keep, axis=1) - 1
+    keep &= positions < max_output_size
+    batch_indices, block_indices = np.nonzero(keep)
+    keep_positions[batch_indices, positions[batch_indices, block_indices]] = (
+        start + block_indices)
+    num_keep += keep.sum(axis=1)
+
+  indices = np.where(keep_positions >= 0,
+                     np.take_along_axis(order, np.maximum(keep_positions, 0),
+                                        axis=1), -1)
+  return indices, num_keep
+
+
 def soft_nms(dets, nms_configs):
   """Soft non-maximum suppression.
 
@@ -217,9 +336,22 @@ def nms(dets, nms_configs):
   raise ValueError('Unknown NMS method: {}'.format(method))
 
 
+def _generate_dummy_detections(image_id, number):
+  detections_dummy = np.zeros((number, 7), dtype=np.float32)
+  detections_dummy[:, 0] = image_id
+  detections_dummy[:, 5] = _DUMMY_DETECTION_SCORE
+  return detections_dummy
+
+
 def per_class_nms(boxes, scores, classes, image_id, image_scale, num_classes,
                   max_boxes_to_draw, nms_configs):
   """Perform per class nms."""
+  nms_configs = nms_configs or {}
+  if nms_configs.get('method') in ('hard', 'diou', None, ''):
+    return batched_per_class_nms(boxes[None], scores[None], classes[None],
+                                 image_id, image_scale, num_classes,
+                                 max_boxes_to_draw, nms_configs)[0]
+
   boxes = boxes[:, [1, 0, 3, 2]]
   detections = []
   for c in range(num_classes):
@@ -240,12 +372,6 @@ def per_class_nms(boxes, scores, classes, image_id, image_scale, num_classes,
     )
     detections.append(top_detections_cls)
 
-  def _generate_dummy_detections(number):
-    detections_dummy = np.zeros((number, 7), dtype=np.float32)
-    detections_dummy[:, 0] = image_id[0]
-    detections_dummy[:, 5] = _DUMMY_DETECTION_SCORE
-    return detections_dummy
-
   if detections:
     detections = np.vstack(detections)
     # take final 100 detections
@@ -254,12 +380,59 @@ def per_class_nms(boxes, scores, classes, image_id, image_scale, num_classes,
         detections[indices[0:max_boxes_to_draw]], dtype=np.float32)
     # Add dummy detections to fill up to 100 detections
     n = max(max_boxes_to_draw - len(detections), 0)
-    detections_dummy = _generate_dummy_detections(n)
+    detections_dummy = _generate_dummy_detections(image_id[0], n)
     detections = np.vstack([detections, detections_dummy])
   else:
-    detections = _generate_dummy_detections(max_boxes_to_draw)
+    detections = _generate_dummy_detections(image_id[0], max_boxes_to_draw)
 
   detections[:, 1:5] *= image_scale
 
   return detections
 
+
+def batched_per_class_nms(boxes, scores, classes, image_ids, image_scales,
+                          num_classes, max_boxes_to_draw, nms_configs):
+  """Perform per class nms on a batch of images.
+
+  The hard and DIOU methods suppress all the classes of all the images at once
+  with batched_nms, the soft methods run per_class_nms on each image.
+
+  Args:
+    boxes: boxes with shape (batch, num, 4) and format [y1, x1, y2, x2].
+    scores: scores with shape (batch, num).
+    classes: classes with shape (batch, num).
+    image_ids: image ids with shape (batch,).
+    image_scales: image scales with shape (batch,).
+    num_classes: number of classes.
+    max_boxes_to_draw: number of detections per image.
+    nms_configs: a dict config that may contain parameters.
+
+  Returns:
+    numpy.array: detections with shape (batch, max_boxes_to_draw, 7) and format
+      [image_id, x1, y1, x2, y2, score, class], padded with dummy detections.
+  """
+  nms_configs = nms_configs or {}
+  method = nms_configs.get('method')
+  if method not in ('hard', 'diou', None, ''):
+    return np.stack([
+        per_class_nms(boxes[i], scores[i], classes[i], image_ids[i:i + 1],
+                      image_scales[i:i + 1], num_classes, max_boxes_to_draw,
+                      nms_configs) for i in range(len(boxes))
+    ])
+
+  boxes = boxes[:, :, [1, 0, 3, 2]]
+  indices, num_detections = batched_nms(
+      boxes, scores, classes, nms_configs.get('iou_thresh'), method,
+      max_boxes_to_draw)
+  detected = indices >= 0
+  indices = np.maximum(indices, 0)
+
+  detections = np.zeros(indices.shape + (7,), dtype=np.float32)
+  detections[:, :, 0] = np.asarray(image_ids)[:, None]
+  detections[:, :, 1:5] = np.take_along_axis(boxes, indices[:, :, None], axis=1)
+  detections[:, :, 5] = np.take_along_axis(scores, indices, axis=1)
+  detections[:, :, 6] = np.take_along_axis(classes, indices, axis=1) + 1
+  detections[~detected, 1:] = 0
+  detections[~detected, 5] = _DUMMY_DETECTION_SCORE
+  detections[:, :, 1:5] *= np.asarray(image_scales)[:, None, None]
+  return detections
@@ -0,0 +1,128 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+os.chdir(Path(__file__).parent.parent)
+import nms_np
+
+
+def random_detections(seed, batch_size=3, num_boxes=300, num_classes=5):
+    rng = np.random.default_rng(seed)
+    top_left = rng.uniform(0, 200, (batch_size, num_boxes, 2))
+    bottom_right = top_left + rng.uniform(5, 60, (batch_size, num_boxes, 2))
+    # Boxes are in the [y1, x1, y2, x2] format of the EfficientDet outputs
+    boxes = np.concatenate([top_left, bottom_right], axis=-1).astype(np.float32)
+    scores = rng.uniform(0, 1, (batch_size, num_boxes)).astype(np.float32)
+    classes = rng.integers(0, num_classes, (batch_size, num_boxes)).astype(np.float32)
+    return boxes, scores, classes
+
+
+def reference_per_class_nms(boxes, scores, classes, image_id, image_scale, num_classes,
+                            max_boxes_to_draw, nms_configs):
+    """
+    Per class nms of one image with a loop over the classes, as done before batched_nms
+    """
+    boxes = boxes[:, [1, 0, 3, 2]]
+    detections = []
+    for c in range(num_classes):
+        indices = np.where(classes == c)[0]
+        if indices.shape[0] == 0:
+            continue
+        top_detections_cls = nms_np.nms(np.column_stack((boxes[indices], scores[indices])), nms_configs)
+        detections.append(np.column_stack((np.repeat(image_id, len(top_detections_cls)),
+                                           top_detections_cls,
+                                           np.repeat(c + 1, len(top_detections_cls)))))
+
+    detections = np.vstack(detections)
+    indices = np.argsort(-detections[:, -2])
+    detections = np.array(detections[indices[0:max_boxes_to_draw]], dtype=np.float32)
+    n = max(max_boxes_to_draw - len(detections), 0)
+    detections = np.vstack([detections, nms_np._generate_dummy_detections(image_id, n)])
+    detections[:, 1:5] *= image_scale
+    return detections
+
+
+@pytest.mark.parametrize("method", ['hard', 'diou'])
+@pytest.mark.parametrize("block_size", [16, 512])
+@pytest.mark.parametrize("max_output_size", [100, 300])
+def test_batched_nms(method, block_size, max_output_size):
+    boxes, scores, _ = random_detections(0)
+    # batched_nms takes the [x1, y1, x2, y2] format of hard_nms and diou_nms
+    boxes = boxes[:, :, [1, 0, 3, 2]]
+
+    indices, num_detections = nms_np.batched_nms(boxes, scores, iou_thresh=0.5, method=method,
+                                                 max_output_size=max_output_size, block_size=block_size)
+
+    assert indices.shape == (len(boxes), max_output_size)
+    for i in range(len(boxes)):
+        expected = nms_np.nms(np.column_stack((boxes[i], scores[i])), {'method': method, 'iou_thresh': 0.5})
+        expected = expected[:max_output_size]
+        num = len(expected)
+        assert num == max_output_size if max_output_size == 100 else num < max_output_size
+        assert num_detections[i] == num
+        assert np.array_equal(np.column_stack((boxes[i], scores[i]))[indices[i, :num]], expected)
+        assert np.all(indices[i, num:] == -1)
+
+
+@pytest.mark.parametrize("method", ['hard', 'diou'])
+@pytest.mark.parametrize("max_boxes_to_draw", [20, 400])
+def test_batched_per_class_nms(method, max_boxes_to_draw):
+    boxes, scores, classes = random_detections(1)
+    image_ids = np.array([7., 8., 9.], dtype=np.float32)
+    image_scales = np.array([1., 0.5, 2.5], dtype=np.float32)
+    num_classes = 5
+    nms_configs = {'method': method, 'iou_thresh': 0.5}
+
+    detections = nms_np.batched_per_class_nms(boxes, scores, classes, image_ids, image_scales,
+                                              num_classes, max_boxes_to_draw, nms_configs)
+
+    assert detections.shape == (len(boxes), max_boxes_to_draw, 7)
+    assert detections.dtype == np.float32
+    for i in range(len(boxes)):
+        expected = reference_per_class_nms(boxes[i], scores[i], classes[i], image_ids[i], image_scales[i],
+                                           num_classes, max_boxes_to_draw, nms_configs)
+        assert np.array_equal(detections[i], expected)
+
+        detected = detections[i, :, 5] != nms_np._DUMMY_DETECTION_SCORE
+        num = detected.sum()
+        # The detections come first by decreasing score, then the padding
+        assert np.all(detected[:num])
+        assert np.all(np.diff(detections[i, :num, 5]) <= 0)
+        assert np.all(detections[i, :, 0] == image_ids[i])
+        # Classes are 1-based, the padding has class 0
+        assert np.all(np.isin(detections[i, :num, 6], classes[i] + 1))
+        assert np.all(detections[i, num:, 1:5] == 0) and np.all(detections[i, num:, 6] == 0)
+        # Each detection is an input box in the [x1, y1, x2, y2] format scaled by the image scale
+        matches = np.all(detections[i, :num, None, 1:5] == (boxes[i][:, [1, 0, 3, 2]] * image_scales[i])[None], axis=-1)
+        matches &= detections[i, :num, None, 5] == scores[i][None]
+        matches &= detections[i, :num, None, 6] == classes[i][None] + 1
+        assert np.all(matches.sum(axis=1) == 1)
+        if max_boxes_to_draw == 20:
+            assert num == max_boxes_to_draw
+        else:
+            assert num < max_boxes_to_draw
+
+
+def test_per_class_nms_is_batched_per_class_nms():
+    boxes, scores, classes = random_detections(2, batch_size=1)
+    nms_configs = {'method': 'hard', 'iou_thresh': 0.5}
+    detections = nms_np.per_class_nms(boxes[0], scores[0], classes[0], np.array([3.]), np.array([1.5]),
+                                      5, 100, nms_configs)
+    expected = reference_per_class_nms(boxes[0], scores[0], classes[0], 3., 1.5, 5, 100, nms_configs)
+    assert np.array_equal(detections, expected)
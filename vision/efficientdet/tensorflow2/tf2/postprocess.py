@@ -541,37 +541,39 @@ def generate_detections(params,
   if params['nms_configs'].get('pyfunc', True):
     # numpy based soft-nms gives better accuracy than the tensorflow builtin
     # the reason why is unknown
-    detections_bs = []
+    # the whole batch is suppressed in a single call to amortize the host
+    # round trip and batch the hard and diou nms of all the images
     boxes, scores, classes = pre_nms(params, cls_outputs, box_outputs)
-    for index in range(boxes.shape[0]):
-      nms_configs = params['nms_configs']
-      detections = tf.numpy_function(
-          functools.partial(nms_np.per_class_nms, nms_configs=nms_configs), [
-              boxes[index],
-              scores[index],
-              classes[index],
-              tf.slice(image_ids, [index], [1]),
-              tf.slice(image_scales, [index], [1]),
-              params['num_classes'],
-              nms_configs['max_output_size'],
-          ], tf.float32)
-
-      if flip:
-        detections = tf.stack([
-            detections[:, 0],
-            # the mirrored location of the left edge is the image width
-            # minus the position of the right edge
-            original_image_widths[index] - detections[:, 3],
-            detections[:, 2],
-            # the mirrored location of the right edge is the image width
-            # minus the position of the left edge
-            original_image_widths[index] - detections[:, 1],
-            detections[:, 4],
-            detections[:, 5],
-            detections[:, 6],
-        ], axis=-1)
-      detections_bs.append(detections)
-    return tf.stack(detections_bs, axis=0, name='detections')
+    nms_configs = params['nms_configs']
+    detections_bs = tf.numpy_function(
+        functools.partial(nms_np.batched_per_class_nms,
+                          nms_configs=nms_configs), [
+                              boxes,
+                              scores,
+                              classes,
+                              image_ids,
+                              image_scales,
+                              params['num_classes'],
+                              nms_configs['max_output_size'],
+                          ], tf.float32)
+    detections_bs.set_shape(
+        [boxes.shape[0], nms_configs['max_output_size'], 7])
+
+    if flip:
+      detections_bs = tf.stack([
+          detections_bs[:, :, 0],
+          # the mirrored location of the left edge is the image width
+          # minus the position of the right edge
+          original_image_widths - detections_bs[:, :, 3],
+          detections_bs[:, :, 2],
+          # the mirrored location of the right edge is the image width
+          # minus the position of the left edge
+          original_image_widths - detections_bs[:, :, 1],
+          detections_bs[:, :, 4],
+          detections_bs[:, :, 5],
+          detections_bs[:, :, 6],
+      ], axis=-1)
+    return tf.identity(detections_bs, name='detections')
 
   if pre_class_nms:
     postprocess = postprocess_per_class
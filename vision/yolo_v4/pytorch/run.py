@@ -273,8 +273,9 @@ def inference(
         pruned_preds_batch = processed_batch[0]
         processed_labels_batch = processed_batch[1]
         if cfg.eval.metrics:
-            for idx, (pruned_preds, processed_labels) in enumerate(zip(pruned_preds_batch, processed_labels_batch)):
-                stat_recorder.record_eval_stats(processed_labels, pruned_preds, image_sizes[idx], loader.dataset.images_id[image_indxs[idx]], run_coco_eval)
+            num_images = min(len(pruned_preds_batch), len(processed_labels_batch))
+            image_ids = [loader.dataset.images_id[image_indx] for image_indx in image_indxs[:num_images]]
+            stat_recorder.record_eval_stats_batch(processed_labels_batch[:num_images], pruned_preds_batch[:num_images], image_sizes[:num_images], image_ids, run_coco_eval)
 
     stat_recorder.logging(print, run_coco_eval)
 
@@ -46,3 +46,16 @@ class TestAutoAnchors():
     def test_fitness(self, data_manager):
         fitness = data_manager.auto_anchors.fitness(data_manager.k_points, data_manager.wh)
         assert (fitness == 1.)
+
+    def test_population_fitness(self, data_manager):
+        population = np.random.uniform(2., 20., (5, 12, 2))
+        wh = torch.tensor(np.random.uniform(2., 20., (1000, 2))).float()
+        population_fitness = data_manager.auto_anchors.population_fitness(population, wh)
+        fitness = torch.stack([data_manager.auto_anchors.fitness(k_points, wh) for k_points in population])
+        assert torch.allclose(population_fitness, fitness, atol=1e-5)
+
+    def test_mutate_population(self, data_manager):
+        mutations = data_manager.auto_anchors.mutate_population(100, (12, 2))
+        assert mutations.shape == (100, 12, 2)
+        assert not (mutations == 1).reshape(100, -1).all(1).any()
+        assert ((mutations >= 0.3) & (mutations <= 3.0)).all()
@@ -0,0 +1,55 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+
+import pytest
+import torch
+
+from utils.nms import batched_nms, pairwise_iou
+
+
+def greedy_nms(scores, boxes, classes, iou_threshold, score_threshold, iou_type, per_class):
+    """
+    Sequential greedy NMS of one image, used as reference
+    """
+    keep = []
+    for index in torch.argsort(scores, descending=True).tolist():
+        if score_threshold is not None and scores[index] <= score_threshold:
+            break
+        suppressed = False
+        for kept in keep:
+            same_class = not per_class or classes[kept] == classes[index]
+            if same_class and pairwise_iou(boxes[None, None, kept], boxes[None, None, index], iou_type)[0, 0, 0] > iou_threshold:
+                suppressed = True
+                break
+        if not suppressed:
+            keep.append(index)
+    return keep
+
+
+class TestBatchedNms:
+    """Tests the batched host NMS against the sequential greedy NMS"""
+
+    @pytest.mark.parametrize("iou_type", [None, 'diou'])
+    @pytest.mark.parametrize("per_class", [False, True])
+    @pytest.mark.parametrize("score_threshold", [None, 0.3])
+    def test_batched_nms(self, iou_type, per_class, score_threshold):
+        torch.manual_seed(0)
+        batch_size, num_boxes, max_detections = 2, 200, 40
+        scores = torch.rand(batch_size, num_boxes)
+        top_left = torch.rand(batch_size, num_boxes, 2) * 100
+        boxes = torch.cat([top_left, top_left + torch.rand(batch_size, num_boxes, 2) * 40 + 1], axis=-1)
+        classes = torch.randint(0, 4, (batch_size, num_boxes))
+
+        indices, nms_scores, nms_boxes, nms_classes, num_detections = batched_nms(
+            scores, boxes, classes, 0.5, max_detections, score_threshold, iou_type, per_class, block_size=32)
+
+        for i in range(batch_size):
+            expected = greedy_nms(scores[i], boxes[i], classes[i], 0.5, score_threshold, iou_type, per_class)[:max_detections]
+            num = len(expected)
+            assert num_detections[i] == num
+            assert indices[i, :num].tolist() == expected
+            assert torch.all(indices[i, num:] == -1)
+            assert torch.equal(nms_scores[i, :num], scores[i, expected])
+            assert torch.equal(nms_boxes[i, :num], boxes[i, expected])
+            assert torch.equal(nms_classes[i, :num], classes[i, expected].int())
+            assert torch.all(nms_scores[i, num:] == 0.)
+            assert torch.all(nms_classes[i, num:] == torch.iinfo(torch.int32).max)
@@ -0,0 +1,42 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+
+import pickle
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.dataset import ImageCache, convert_image
+from utils.preprocessing import ResizeImage
+
+
+@pytest.mark.parametrize("input_channels", [3, 1])
+def test_image_cache(tmp_path, input_channels):
+    """
+    Checks the cached images are the same as the decoded and resized ones, and
+    that the cache is not loaded for a different config
+    """
+    images_path, images_shapes, labels = [], [], []
+    for i, (width, height) in enumerate([(64, 48), (32, 96), (416, 416), (500, 300)]):
+        image_path = str(tmp_path / ("%06d.png" % i))
+        Image.fromarray(np.random.randint(0, 256, [height, width, 3], dtype=np.uint8)).save(image_path)
+        images_path.append(image_path)
+        images_shapes.append([width, height])
+        labels.append(np.random.rand(i, 5).astype(np.float32))
+
+    cache_path = str(tmp_path / "cache")
+    metadata = ImageCache.get_metadata(images_path, 416, input_channels, "train")
+    assert ImageCache.load(cache_path, metadata) is None
+    ImageCache.build(cache_path, metadata, images_path, images_shapes, labels, num_workers=2, images_per_task=3)
+    image_cache = pickle.loads(pickle.dumps(ImageCache.load(cache_path, metadata)))
+
+    resize_image = ResizeImage(416)
+    for i, image_path in enumerate(images_path):
+        image, _ = resize_image((convert_image(Image.open(image_path), input_channels), None))
+        cached_image = image_cache.get_image(i)
+        assert cached_image.mode == image.mode
+        assert cached_image.size == image.size
+        assert np.array_equal(np.array(cached_image), np.array(image))
+        assert np.array_equal(image_cache.labels[i], labels[i])
+
+    assert ImageCache.load(cache_path, dict(metadata, image_size=640)) is None
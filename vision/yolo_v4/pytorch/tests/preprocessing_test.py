@@ -6,6 +6,8 @@ import numpy as np
 from PIL import Image
 
 from utils.preprocessing import Cutout, HSV, VerticalFlip, HorizontalFlip, ToTensor, Pad, ResizeImage
+from utils.preprocessing import HSVNumpy, VerticalFlipNumpy, HorizontalFlipNumpy, LetterboxNumpy, ResizeImageNumpy, Mosaic, MosaicNumpy
+from utils.preprocessing import RandomPerspective, RandomPerspectiveNumpy
 
 
 @pytest.fixture(name="data_manager", scope="class")
@@ -101,3 +103,75 @@ class TestPreprocessing:
 
         assert (image_size in augmented_img.shape)
         assert np.array_equal(augmented_label, data_manager.labels)
+
+    @pytest.mark.parametrize("image_size", [48, 64, 128])
+    def test_resize_image_numpy(self, data_manager, image_size):
+        img, label = ResizeImage(image_size)((Image.fromarray(np.uint8(data_manager.img3)), np.copy(data_manager.labels)))
+        img_numpy, label_numpy = ResizeImageNumpy(image_size)((np.uint8(data_manager.img3), np.copy(data_manager.labels)))
+        img = np.ascontiguousarray(img)
+
+        assert img_numpy.shape == img.shape
+        assert np.array_equal(label_numpy, label)
+        if image_size <= data_manager.img3.shape[0]:
+            # Same nearest pixels as PIL when downscaling, and no resize at the same size
+            assert np.array_equal(img_numpy, img)
+        else:
+            assert np.abs(img_numpy.astype(np.int32) - img).max() <= 1
+
+    def test_hsv_numpy(self, data_manager):
+        hsv = HSVNumpy(h_gain=.5, s_gain=.5, v_gain=.5)
+        augmented_img, augmented_label = hsv((np.uint8(data_manager.img2), np.copy(data_manager.labels)))
+
+        assert np.array_equal(augmented_label, data_manager.labels)
+        assert (augmented_img == augmented_img[0][0]).all()
+
+        # Without gains the image is only converted to HSV and back
+        hsv = HSVNumpy(h_gain=0., s_gain=0., v_gain=0.)
+        augmented_img, _ = hsv((np.uint8(data_manager.img1), np.copy(data_manager.labels)))
+        assert np.abs(augmented_img.astype(np.int32) - data_manager.img1).max() <= 8
+
+    def test_flip_numpy(self, data_manager):
+        for flip, flip_numpy in [(HorizontalFlip(), HorizontalFlipNumpy()), (VerticalFlip(), VerticalFlipNumpy())]:
+            img, label = flip((Image.fromarray(np.uint8(data_manager.img3)), np.copy(data_manager.labels)))
+            img_numpy, label_numpy = flip_numpy((np.uint8(data_manager.img3), np.copy(data_manager.labels)))
+
+            assert np.array_equal(img_numpy, np.ascontiguousarray(img))
+            assert np.array_equal(label_numpy, label)
+
+    @pytest.mark.parametrize("image_size", [48, 128])
+    def test_letterbox_numpy(self, data_manager, image_size):
+        img, label = Pad(image_size)(ResizeImage(image_size)((Image.fromarray(np.uint8(data_manager.img3)), np.copy(data_manager.labels))))
+        img_numpy, label_numpy = LetterboxNumpy(image_size)((np.uint8(data_manager.img3), np.copy(data_manager.labels)))
+
+        assert np.allclose(label_numpy, label)
+        if image_size < data_manager.img3.shape[0]:
+            # Same nearest pixels as PIL when downscaling
+            assert np.array_equal(img_numpy, np.ascontiguousarray(img))
+        else:
+            assert np.abs(img_numpy.astype(np.int32) - np.ascontiguousarray(img)).max() <= 1
+
+    def test_mosaic_numpy(self, data_manager):
+        item = [(np.uint8(img), np.copy(data_manager.labels)) for img in [data_manager.img1, data_manager.img2, data_manager.img3, data_manager.img1]]
+        img, label = Mosaic(64, 3)(tuple((Image.fromarray(img), np.copy(label)) for img, label in item))
+        img_numpy, label_numpy = MosaicNumpy(64, 3)(tuple((img, np.copy(label)) for img, label in item))
+
+        assert img_numpy.dtype == np.uint8
+        assert np.array_equal(img_numpy, np.ascontiguousarray(img))
+        assert np.array_equal(label_numpy, label)
+
+    def test_random_perspective_numpy(self, data_manager):
+        image_size = 96
+        labels = np.array([[1.0, 0.5, 0.5, 0.5, 0.6], [2.0, 0.3, 0.4, 0.2, 0.3]])
+        pil_pipeline = [ResizeImage(image_size), Pad(image_size), RandomPerspective(degrees=5, translate=0.1, scale=0.3, shear=5)]
+        img, label = Image.fromarray(np.uint8(data_manager.img3)), np.copy(labels)
+        np.random.seed(0)
+        for transform in pil_pipeline:
+            img, label = transform((img, label))
+
+        # The resize and the padding are fused with the perspective warp
+        random_perspective = RandomPerspectiveNumpy(degrees=5, translate=0.1, scale=0.3, shear=5, image_size=image_size)
+        np.random.seed(0)
+        img_numpy, label_numpy = random_perspective((np.uint8(data_manager.img3), np.copy(labels)))
+
+        assert img_numpy.shape == (image_size, image_size, 3)
+        assert np.allclose(label_numpy, label)
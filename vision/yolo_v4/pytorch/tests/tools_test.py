@@ -1,9 +1,50 @@
 # Copyright (c) 2021 Graphcore Ltd. All rights reserved.
 
+import json
+
 import numpy as np
+import pytest
 import torch
 
-from utils.tools import ioa, standardize_labels, bbox_iou, sparse_mean
+from utils.config import get_cfg_defaults
+from utils.tools import ioa, iou, standardize_labels, bbox_iou, sparse_mean, StatRecorder, evaluate_coco
+
+
+def write_synthetic_coco(tmp_path, num_images=11, seed=0):
+    """
+    Writes COCO annotations and predictions with boxes of every area range,
+    missed labels, false positives and images without predictions
+    """
+    rng = np.random.default_rng(seed)
+    category_ids = [1, 3, 7]
+    # Images listed out of order, to check that the shards are merged by sorted ids
+    image_ids = rng.permutation(np.arange(100, 100 + num_images)).tolist()
+    images = [{"id": image_id, "width": 640, "height": 480, "file_name": f"{image_id}.jpg"} for image_id in image_ids]
+    annotations, predictions = [], []
+    for image_id in image_ids:
+        for _ in range(rng.integers(0, 8)):
+            # Small, medium and large boxes
+            size = rng.choice([20., 60., 200.]) * rng.uniform(0.7, 1.3, 2)
+            box = [*rng.uniform(0, 400, 2), *size]
+            category_id = int(rng.choice(category_ids))
+            annotations.append({"id": len(annotations) + 1, "image_id": image_id, "category_id": category_id,
+                                "bbox": box, "area": float(size[0] * size[1]), "iscrowd": 0})
+            if image_id % 5 != 0 and rng.uniform() < 0.8:
+                noisy_box = (np.array(box) + rng.normal(0, 0.1, 4) * np.concatenate([size, size])).tolist()
+                predictions.append({"image_id": image_id, "category_id": category_id, "bbox": noisy_box,
+                                    "score": float(rng.uniform())})
+        for _ in range(rng.integers(0, 3)):
+            predictions.append({"image_id": image_id, "category_id": int(rng.choice(category_ids)),
+                                "bbox": [*rng.uniform(0, 400, 2), *rng.uniform(10, 200, 2)], "score": float(rng.uniform())})
+
+    annotation_file, predictions_file = tmp_path / "annotations.json", tmp_path / "predictions.json"
+    annotation_file.write_text(json.dumps({
+        "images": images,
+        "annotations": annotations,
+        "categories": [{"id": category_id, "name": str(category_id)} for category_id in category_ids],
+    }))
+    predictions_file.write_text(json.dumps(predictions))
+    return str(annotation_file), str(predictions_file)
 
 
 class TestTools:
@@ -60,3 +101,59 @@ class TestTools:
 
     def test_sparse_mean(self):
         assert sparse_mean(torch.Tensor([1, 2, 3, 0, 0, 0.1, 1e-8])) == torch.Tensor([1.525])
+
+    def test_iou_batch(self):
+        boxes1 = torch.rand(3, 5, 4) * 10
+        boxes1[..., 2:] += boxes1[..., :2]
+        boxes2 = torch.rand(3, 4, 4) * 10
+        boxes2[..., 2:] += boxes2[..., :2]
+
+        batch_iou = iou(boxes1, boxes2)
+        for i in range(3):
+            assert torch.equal(batch_iou[i], iou(boxes1[i], boxes2[i]))
+
+    def test_record_eval_stats_batch(self):
+        stat_recorder = StatRecorder(get_cfg_defaults(), '')
+        # class, center x, center y, width, height
+        labels = [torch.Tensor([[1., 20., 20., 20., 20.], [1., 60., 60., 20., 20.]]), torch.Tensor([[2., 20., 20., 10., 10.]])]
+        # center x, center y, width, height, score, class
+        predictions = [
+            torch.Tensor([
+                [20., 20., 20., 20., 0.9, 1.],  # matches the first label
+                [21., 20., 20., 20., 0.8, 1.],  # the first label is already detected
+                [63., 60., 20., 20., 0.7, 1.],  # matches the second label with an IoU of 0.74
+                [60., 60., 20., 20., 0.6, 2.],  # class without labels
+            ]),
+            None
+        ]
+        stat_recorder.record_eval_stats_batch(labels, predictions, torch.tensor([[100, 100], [100, 100]]), ['1', '2'], False)
+
+        correct, scores, class_pred, target_cls = stat_recorder.eval_stats[0]
+        assert stat_recorder.seen == 2
+        assert correct.all(1).tolist() == [True, False, False, False]
+        assert correct[2].tolist() == [True] * 5 + [False] * 5
+        assert np.allclose(scores, [0.9, 0.8, 0.7, 0.6])
+        assert class_pred.tolist() == [1., 1., 1., 2.]
+        assert target_cls.tolist() == [1., 1., 2.]
+
+    @pytest.mark.parametrize("num_workers", [2, 3, 20])
+    def test_evaluate_coco_workers(self, tmp_path, num_workers):
+        annotation_file, predictions_file = write_synthetic_coco(tmp_path)
+
+        expected = evaluate_coco(annotation_file, predictions_file, 1)
+        expected.summarize()
+        coco_eval = evaluate_coco(annotation_file, predictions_file, num_workers)
+        coco_eval.summarize()
+
+        # The merged evaluation of each category, area range and image is the one of a single process
+        assert len(coco_eval.evalImgs) == len(expected.evalImgs)
+        for eval_image, expected_eval_image in zip(coco_eval.evalImgs, expected.evalImgs):
+            assert (eval_image is None) == (expected_eval_image is None)
+            if eval_image is not None:
+                assert (eval_image["image_id"], eval_image["category_id"], eval_image["aRng"]) == \
+                    (expected_eval_image["image_id"], expected_eval_image["category_id"], expected_eval_image["aRng"])
+        assert np.array_equal(coco_eval.eval["precision"], expected.eval["precision"])
+        assert np.array_equal(coco_eval.eval["recall"], expected.eval["recall"])
+        assert np.array_equal(coco_eval.stats, expected.stats)
+        # Not a degenerate evaluation
+        assert 0 < expected.stats[0] < 1
@@ -51,6 +51,14 @@ config.model.ipu = True
 config.model.auto_anchors = False
 # Anchors threshold to compare against when chooseing the best anchors
 config.model.anchor_threshold = 4.0
+# Number of mutated sets of anchors evaluated together in each generation of the anchors evolution
+config.model.anchors_population = 64
+# Maximum number of labels sampled to evaluate the anchors evolution, 0 to use all of them
+config.model.anchors_max_labels = 10000
+# Stop the anchors evolution after this number of generations without improvement, 0 to run all of them
+config.model.anchors_patience = 30
+# Minimum increase of the fitness for a generation of the anchors evolution to count as an improvement
+config.model.anchors_min_improvement = 1e-4
 # Send the data using uint instead of floats to the IPU
 config.model.uint_io = True
 # Pipeline splits
@@ -138,14 +146,14 @@ config.model.max_nlabels_p5 = mask_n * len(config.model.anchors.p3width) * confi
 
 config.dataset.train = CN()
 config.dataset.test = CN()
-# Cache the images on ram instead of reading them from disk
+# Cache the images decoded and resized to the model image size in a memory-mapped file on disk
 config.dataset.train.cache_data = False
 config.dataset.test.cache_data = False
 # Path to the annotations of the coco dataset
 config.dataset.train.file = "train2017.txt"
 config.dataset.test.file = "val2017.txt"
 config.dataset.test.annotation = "instances_val2017.json"
-# Path to cache the data on disk (Labels, shapes and names of image files)
+# Path to cache the data on disk (Labels, shapes and names of image files, and the images if cache_data is set)
 config.dataset.train.cache_path = "./utils/data/train"
 config.dataset.test.cache_path = "./utils/data/test"
 # Use data augmentation
@@ -154,6 +162,8 @@ config.dataset.test.data_aug = False
 # Data augmentation modes mosaic and color (TODO)
 config.dataset.mosaic = False
 config.dataset.color = False
+# Run the pre-processing and augmentations on uint8 numpy arrays with OpenCV instead of on PIL images
+config.dataset.numpy_pipeline = False
 # Data aug (cutout) - proportion of object obscured in order to be removed from the label
 config.dataset.train.cutout_obscured_pct = 0.6
 # Data aug (cutout) - minimum cutout area scale required for label to be removed
@@ -177,6 +187,8 @@ config.eval = CN()
 config.eval.metrics = True
 # Display eval metrics per class
 config.eval.verbose = False
+# Number of processes running the COCO evaluation on shards of the images
+config.eval.coco_workers = 1
 
 
 def get_cfg_defaults():
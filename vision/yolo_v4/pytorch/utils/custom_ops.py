@@ -7,10 +7,11 @@ from typing import List
 from yacs.config import CfgNode
 
 import torch
-from torchvision.ops.boxes import nms as torchvision_nms
 
 import poptorch
 
+from utils.nms import batched_nms
+
 
 def load_custom_ops_lib(path_custom_op: str):
     """Loads the custom op binary
@@ -73,29 +74,7 @@ class Nms(torch.nn.Module):
         Returns:
             List[torch.Tensor]: Predictions filtered after NMS, indexes, scores, boxes, classes, and the number of detection per image
         """
-        batch = scores.shape[0]
-        selected_box_indx = torch.full((batch, max_detections), -1, dtype=torch.long)
-        cpu_classes = torch.full((batch, max_detections), torch.iinfo(torch.int32).max, dtype=int)
-        cpu_boxes = torch.zeros((batch, max_detections, 4))
-        cpu_scores = torch.zeros((batch, max_detections))
-        cpu_true_max_detections = torch.full((batch,), max_detections)
-
-        for i, (bscores, bboxes, bclasses) in enumerate(zip(scores, boxes, classes)):
-            nms_preds = torchvision_nms(bboxes, bscores, iou_threshold)
-
-            if nms_preds.shape[0] > max_detections:
-                selected_box_indx[i] = nms_preds[:max_detections]
-            else:
-                selected_box_indx[i, :nms_preds.shape[0]] = nms_preds
-                cpu_true_max_detections[i] = nms_preds.shape[0]
-
-            batch_indices = selected_box_indx[i, :cpu_true_max_detections[i]]
-
-            cpu_classes[i, :cpu_true_max_detections[i]] = bclasses[batch_indices]
-            cpu_boxes[i, :cpu_true_max_detections[i]] = bboxes[batch_indices]
-            cpu_scores[i, :cpu_true_max_detections[i]] = bscores[batch_indices]
-
-        return [selected_box_indx, cpu_scores, cpu_boxes, cpu_classes.int(), cpu_true_max_detections.int()]
+        return batched_nms(scores, boxes, classes, iou_threshold, max_detections)
 
     def forward(self, scores: torch.Tensor, boxes: torch.Tensor, classes: torch.Tensor = None) -> List[torch.Tensor]:
         batch = scores.shape[0]
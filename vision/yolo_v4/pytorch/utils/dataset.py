@@ -2,6 +2,8 @@
 import os
 import io
 import re
+import json
+import hashlib
 import PIL
 import yacs
 import torch
@@ -12,8 +14,177 @@ from pathlib import Path
 from PIL import Image
 from tqdm import tqdm
 from typing import Tuple, List, Any
+from concurrent.futures import ProcessPoolExecutor
 from torchvision.transforms import Compose
 from utils.preprocessing import HSV, ToNumpy, Pad, ToTensor, ResizeImage, Mosaic, RandomPerspective, HorizontalFlip, VerticalFlip
+from utils.preprocessing import HSVNumpy, LetterboxNumpy, ResizeImageNumpy, MosaicNumpy, RandomPerspectiveNumpy, HorizontalFlipNumpy, VerticalFlipNumpy
+
+
+def convert_image(image: PIL.Image.Image, input_channels: int) -> PIL.Image.Image:
+    """
+    Converts the image to the mode of the number of channels of the model
+    Parameters:
+        image: the image to convert
+        input_channels: the number of input channels of the model
+    Return:
+        image: image converted to RGB or LA
+    """
+    if input_channels == 3:
+        return image.convert('RGB')
+    elif input_channels == 1:
+        return image.convert('LA')
+    else:
+        raise RuntimeError("Unsupported number of channels! Supported: [1, 3]")
+
+
+def write_cached_images(images_path: List[str], offsets: List[int], data_path: str, data_size: int, image_size: int, input_channels: int):
+    """
+    Decodes, converts and resizes the images and writes their pixels in the data file of the image cache
+    Parameters:
+        images_path: the paths of the images to write
+        offsets: the offsets of the images in the data file
+        data_path: the path to the data file of the image cache
+        data_size: the size of the data file
+        image_size: the size of the model input the images are resized to
+        input_channels: the number of input channels of the model
+    """
+    data = np.memmap(data_path, dtype=np.uint8, mode='r+', shape=(data_size,))
+    resize_image = ResizeImage(image_size)
+    for image_path, offset in zip(images_path, offsets):
+        image, _ = resize_image((convert_image(Image.open(image_path), input_channels), None))
+        pixels = np.ascontiguousarray(image).reshape(-1)
+        data[offset:offset + pixels.size] = pixels
+    data.flush()
+
+
+class ImageCache(object):
+    """
+    Cache of the images of a dataset decoded and resized to the model image size, and of their labels.
+    The resized images are stored back to back as uint8 pixels in a single file that is memory-mapped,
+    so they are read without decoding and without loading the whole cache in memory.
+    Parameters:
+        path: the folder of the cache
+        metadata: the description of the cached images, used to invalidate the cache
+    """
+    METADATA_FILENAME = "metadata.json"
+
+    def __init__(self, path: str, metadata: dict):
+        self.path = path
+        self.metadata = metadata
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.shapes = np.load(os.path.join(path, "shapes.npy"))
+        self.images_shapes = np.load(os.path.join(path, "images_shapes.npy")).tolist()
+        label_offsets = np.load(os.path.join(path, "label_offsets.npy"))
+        labels = np.load(os.path.join(path, "labels.npy"))
+        self.labels = [labels[begin:end] for begin, end in zip(label_offsets[:-1], label_offsets[1:])]
+        self._data = None
+
+    @property
+    def data(self) -> np.memmap:
+        # Opened lazily, so each dataloader worker maps the file instead of receiving a copy
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.path, "images.bin"), dtype=np.uint8, mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def get_array(self, index: int) -> np.array:
+        """
+        Returns the resized image in the index position as a uint8 numpy array
+        Parameters:
+            index: the position of the image in the dataset
+        Return:
+            image: resized image in the index position
+        """
+        pixels = self.data[self.offsets[index]:self.offsets[index] + np.prod(self.shapes[index])]
+        return np.array(pixels).reshape(self.shapes[index])
+
+    def get_image(self, index: int) -> PIL.Image.Image:
+        """
+        Returns the resized image in the index position
+        Parameters:
+            index: the position of the image in the dataset
+        Return:
+            image: resized image in the index position
+        """
+        return Image.fromarray(self.get_array(index))
+
+    @staticmethod
+    def get_metadata(images_path: List[str], image_size: int, input_channels: int, mode: str) -> dict:
+        """
+        Returns the description of the images and config a cache is built for
+        """
+        return {
+            "num_images": len(images_path),
+            "images_hash": hashlib.sha1("\n".join(images_path).encode()).hexdigest(),
+            "image_size": image_size,
+            "input_channels": input_channels,
+            "mode": mode,
+        }
+
+    @classmethod
+    def load(cls, path: str, metadata: dict) -> "ImageCache":
+        """
+        Returns the image cache in path, or None if it doesn't exist or was built for different images or config
+        """
+        metadata_path = os.path.join(path, cls.METADATA_FILENAME)
+        if not os.path.isfile(metadata_path):
+            return None
+        with open(metadata_path, 'r') as metadata_file:
+            if json.load(metadata_file) != metadata:
+                return None
+        return cls(path, metadata)
+
+    @classmethod
+    def build(cls, path: str, metadata: dict, images_path: List[str], images_shapes: List[Tuple[int, int]],
+              labels: List[np.array], num_workers: int, images_per_task: int = 64) -> "ImageCache":
+        """
+        Decodes and resizes the images in parallel and writes them with their labels in a new image cache in path
+        """
+        os.makedirs(path, exist_ok=True)
+        metadata_path = os.path.join(path, cls.METADATA_FILENAME)
+        if os.path.isfile(metadata_path):
+            os.remove(metadata_path)
+
+        # Shapes of the images after ResizeImage, images_shapes are the PIL (width, height) sizes
+        shapes = []
+        channels = 3 if metadata["input_channels"] == 3 else 2
+        for width, height in images_shapes:
+            ratio_image_size = metadata["image_size"] / max(width, height)
+            if ratio_image_size != 1:
+                width, height = int(width * ratio_image_size), int(height * ratio_image_size)
+            shapes.append((height, width, channels))
+        shapes = np.array(shapes, dtype=np.int64).reshape(-1, 3)
+        offsets = np.concatenate([[0], np.cumsum(np.prod(shapes, axis=1))]).astype(np.int64)
+        data_size = max(int(offsets[-1]), 1)
+
+        data_path = os.path.join(path, "images.bin")
+        np.memmap(data_path, dtype=np.uint8, mode='w+', shape=(data_size,)).flush()
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            tasks = [executor.submit(write_cached_images,
+                                     images_path[start:start + images_per_task],
+                                     offsets[start:start + images_per_task].tolist(),
+                                     data_path,
+                                     data_size,
+                                     metadata["image_size"],
+                                     metadata["input_channels"])
+                     for start in range(0, len(images_path), images_per_task)]
+            for task in tqdm(tasks, desc='Caching images'):
+                task.result()
+
+        labels = [np.zeros((0, 5), dtype=np.float32) if label is None else label for label in labels]
+        np.save(os.path.join(path, "offsets.npy"), offsets[:-1])
+        np.save(os.path.join(path, "shapes.npy"), shapes)
+        np.save(os.path.join(path, "images_shapes.npy"), np.array(images_shapes, dtype=np.int64).reshape(-1, 2))
+        np.save(os.path.join(path, "label_offsets.npy"), np.cumsum([0] + [len(label) for label in labels]))
+        np.save(os.path.join(path, "labels.npy"), np.concatenate([np.zeros((0, 5), dtype=np.float32)] + labels).astype(np.float32))
+        # Written last, so an interrupted build is never loaded
+        with open(metadata_path, 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        return cls(path, metadata)
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -32,6 +203,7 @@ class Dataset(torch.utils.data.Dataset):
         self.images_path = None
         self.labels_path = None
         self.img_data = None
+        self.image_cache = None
 
         # Change the data type of the dataloader depeding of the options
         if self.cfg.model.uint_io:
@@ -42,28 +214,41 @@ class Dataset(torch.utils.data.Dataset):
             image_type = "half"
 
         # Create transforms
-        self.resize_image = ResizeImage(self.cfg.model.image_size)
-        self.mosaic = Mosaic(self.cfg.model.image_size, self.cfg.model.input_channels)
+        self.numpy_pipeline = self.cfg.dataset.numpy_pipeline
+        if self.numpy_pipeline:
+            # The resize and the padding of the images without mosaic are done in the same
+            # warp as the perspective augmentation, or in LetterboxNumpy without augmentation
+            self.resize_image = ResizeImageNumpy(self.cfg.model.image_size)
+            self.mosaic = MosaicNumpy(self.cfg.model.image_size, self.cfg.model.input_channels)
+            random_perspective, augment_options = RandomPerspectiveNumpy, {"image_size": self.cfg.model.image_size}
+            hsv, horizontal_flip, vertical_flip = HSVNumpy, HorizontalFlipNumpy, VerticalFlipNumpy
+            self.pad = LetterboxNumpy(self.cfg.model.image_size)
+        else:
+            self.resize_image = ResizeImage(self.cfg.model.image_size)
+            self.mosaic = Mosaic(self.cfg.model.image_size, self.cfg.model.input_channels)
+            random_perspective, augment_options = RandomPerspective, {}
+            hsv, horizontal_flip, vertical_flip = HSV, HorizontalFlip, VerticalFlip
+            self.pad = Pad(self.cfg.model.image_size)
         # We create two perspective transforms, one for the case with mosaic, and one without.
         # The difference is only in the border_to_remove parameter.
-        self.random_perspective_mosaic = RandomPerspective(self.cfg.dataset.train.degrees,
-                                                           self.cfg.dataset.train.translate,
-                                                           self.cfg.dataset.train.scale,
-                                                           self.cfg.dataset.train.shear,
-                                                           self.cfg.dataset.train.perspective,
-                                                           border_to_remove=[self.cfg.model.image_size, self.cfg.model.image_size])
-        self.random_perspective_augment = RandomPerspective(self.cfg.dataset.train.degrees,
+        self.random_perspective_mosaic = random_perspective(self.cfg.dataset.train.degrees,
                                                             self.cfg.dataset.train.translate,
                                                             self.cfg.dataset.train.scale,
                                                             self.cfg.dataset.train.shear,
                                                             self.cfg.dataset.train.perspective,
-                                                            border_to_remove=[0, 0])
-        self.hsv_augment = HSV(self.cfg.dataset.train.hsv_h_gain,
+                                                            border_to_remove=[self.cfg.model.image_size, self.cfg.model.image_size])
+        self.random_perspective_augment = random_perspective(self.cfg.dataset.train.degrees,
+                                                             self.cfg.dataset.train.translate,
+                                                             self.cfg.dataset.train.scale,
+                                                             self.cfg.dataset.train.shear,
+                                                             self.cfg.dataset.train.perspective,
+                                                             border_to_remove=[0, 0],
+                                                             **augment_options)
+        self.hsv_augment = hsv(self.cfg.dataset.train.hsv_h_gain,
                                self.cfg.dataset.train.hsv_s_gain,
                                self.cfg.dataset.train.hsv_v_gain)
-        self.horizontal_flip = HorizontalFlip()
-        self.vertical_flip = VerticalFlip()
-        self.pad = Pad(self.cfg.model.image_size)
+        self.horizontal_flip = horizontal_flip()
+        self.vertical_flip = vertical_flip()
         self.image_to_tensor = Compose([ToNumpy(), ToTensor(int(self.cfg.dataset.max_bbox_per_scale), image_type)])
 
         self.maximum_synthetic_data = 10000
@@ -97,10 +282,11 @@ class Dataset(torch.utils.data.Dataset):
                 np.save(self.dataset.cache_path + '.id', (np.array(self.images_id)))
                 np.save(self.dataset.cache_path + '.shape', (np.array(self.images_shapes)))
 
-            self.labels = self.get_labels()
-
             if self.dataset.cache_data:
-                print("Not available")
+                self.image_cache = self.load_or_cache_images()
+                self.labels = self.image_cache.labels
+            else:
+                self.labels = self.get_labels()
 
         if not self.dataset.data_aug:
             if self.cfg.dataset.mosaic:
@@ -108,6 +294,21 @@ class Dataset(torch.utils.data.Dataset):
             if self.cfg.dataset.color:
                 print("Warning: color augmentation won\'t be applied to a dataset with disabled data_aug.")
 
+    def load_or_cache_images(self) -> "ImageCache":
+        """
+        Returns the image cache of the dataset, building it if it doesn't exist or if it
+        was created for different images, image size or number of channels
+        Return:
+            image_cache: the cache of the resized images and of the labels
+        """
+        cache_path = self.dataset.cache_path + '.images'
+        metadata = ImageCache.get_metadata(self.images_path, self.cfg.model.image_size, self.cfg.model.input_channels, self.mode)
+        image_cache = ImageCache.load(cache_path, metadata)
+        if image_cache is None:
+            image_cache = ImageCache.build(cache_path, metadata, self.images_path, self.images_shapes,
+                                           self.get_labels(), self.cfg.system.num_workers)
+        return image_cache
+
     def get_image_names_shapes(self, path: str) -> Tuple[List[str], List[Tuple[int, int]]]:
         """
         Verifies and returns the names and shapes of the images in a set path
@@ -231,30 +432,35 @@ class Dataset(torch.utils.data.Dataset):
             image: transformed image in the index position
             labels: transformed labels in the index position
         """
-        image = self.get_image(index)
-        labels = self.labels[index].copy()  # Format: [0] is the Class, [1, 2] is the Center x, y point and [3, 4] is the width and height of the box
-        size = torch.as_tensor(image.size)
-
-        transformed_image, transformed_labels = self.resize_image((image, labels))
+        # The size of the image before the resize, images_shapes holds the PIL (width, height) sizes
+        size = torch.as_tensor(self.images_shapes[index])
 
         if self.cfg.dataset.mosaic and self.dataset.data_aug:
+            # Labels format: [0] is the Class, [1, 2] is the Center x, y point and [3, 4] is the width and height of the box
+            transformed_image, transformed_labels = self.get_resized_image(index)
             # sample other 3 images to stitch with the current image
             indices = np.random.randint(0, self.__len__(), 3)
-            mosaic_candidates = [
-                self.resize_image((self.get_image(i), self.labels[i].copy())) for i in indices
-            ]
+            mosaic_candidates = [self.get_resized_image(i) for i in indices]
             mosaic_candidates = [(transformed_image, transformed_labels)] + mosaic_candidates
             transformed_image, transformed_labels = self.mosaic(tuple(mosaic_candidates))
             transformed_image, transformed_labels = self.random_perspective_mosaic((transformed_image, transformed_labels))
 
+        elif self.numpy_pipeline:
+            # Resize and pad in a single operation, fused with the perspective augmentation
+            transformed_image, transformed_labels = self.get_image_array(index), self.labels[index].copy()
+            if self.dataset.data_aug:
+                transformed_image, transformed_labels = self.random_perspective_augment((transformed_image, transformed_labels))
+            else:
+                transformed_image, transformed_labels = self.pad((transformed_image, transformed_labels))
+
         else:
+            transformed_image, transformed_labels = self.get_resized_image(index)
             # Pad if we don't do the mosaic
             transformed_image, transformed_labels = self.pad((transformed_image, transformed_labels))
-
-        if self.dataset.data_aug:
-            if not self.cfg.dataset.mosaic:
+            if self.dataset.data_aug:
                 transformed_image, transformed_labels = self.random_perspective_augment((transformed_image, transformed_labels))
 
+        if self.dataset.data_aug:
             # HSV color augmentation
             if self.cfg.dataset.color:
                 transformed_image, transformed_labels = self.hsv_augment((transformed_image, transformed_labels))
@@ -271,6 +477,37 @@ class Dataset(torch.utils.data.Dataset):
 
         return transformed_image, transformed_labels, size, torch.as_tensor(index)
 
+    def get_resized_image(self, index: int) -> Tuple[Any, np.array]:
+        """
+        Returns the index image of the dataset resized to the model image size, from the
+        image cache if it is enabled, and a copy of its labels. The image is a numpy array
+        with the numpy pipeline
+        Parameters:
+            index: the position of the image in the dataset
+        Return:
+            image: resized image in the index position
+            labels: labels in the index position
+        """
+        labels = self.labels[index].copy()
+        if self.numpy_pipeline:
+            return self.resize_image((self.get_image_array(index), labels))
+        if self.image_cache is not None:
+            return self.image_cache.get_image(index), labels
+        return self.resize_image((self.get_image(index), labels))
+
+    def get_image_array(self, index: int) -> np.array:
+        """
+        Returns the index image of the dataset as a uint8 numpy array, already resized
+        to the model image size if it comes from the image cache
+        Parameters:
+            index: the position of the image in the dataset
+        Return:
+            image: image in the index position
+        """
+        if self.image_cache is not None:
+            return self.image_cache.get_array(index)
+        return np.asarray(self.get_image(index))
+
     def get_image(self, index: int) -> PIL.Image.Image:
         """
         Returns the index image of the dataset
@@ -284,10 +521,4 @@ class Dataset(torch.utils.data.Dataset):
         else:
             image = Image.open(self.images_path[index])
 
-
-        if self.cfg.model.input_channels == 3:
-            return image.convert('RGB')
-        elif self.cfg.model.input_channels == 1:
-            return image.convert('LA')
-        else:
-            raise RuntimeError("Unsupported number of channels! Supported: [1, 3]")
+        return convert_image(image, self.cfg.model.input_channels)
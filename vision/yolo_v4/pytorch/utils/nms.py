@@ -0,0 +1,135 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+
+from typing import List, Optional
+
+import torch
+
+"""
+Host non maximum suppression of a whole batch, with the outputs of the NMS custom op
+"""
+
+
+def pairwise_iou(boxes1: torch.Tensor, boxes2: torch.Tensor, iou_type: Optional[str] = None) -> torch.Tensor:
+    """
+    Computes the IoU, or the DIoU, between every pair of boxes of each image
+    Parameters:
+        boxes1 (torch.Tensor): BXNX4 boxes in (xmin, ymin, xmax, ymax)
+        boxes2 (torch.Tensor): BXMX4 boxes in (xmin, ymin, xmax, ymax)
+        iou_type (str): None for the IoU, or 'diou'
+    Returns:
+        torch.Tensor: BXNXM IoU between the boxes
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+    top_left = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    bottom_right = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
+    inter = (bottom_right - top_left).clamp(min=0).prod(-1)
+    iou_value = inter / (area1[..., :, None] + area2[..., None, :] - inter)
+
+    if not iou_type:
+        return iou_value
+    elif iou_type == 'diou':
+        convex = torch.max(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:]) - torch.min(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+        convex_diag_squared = (convex * convex).sum(-1) + torch.finfo(torch.float32).eps
+        center_distance = (boxes1[..., :, None, :2] + boxes1[..., :, None, 2:] - boxes2[..., None, :, :2] - boxes2[..., None, :, 2:]) / 2
+        return iou_value - (center_distance * center_distance).sum(-1) / convex_diag_squared
+    else:
+        raise ValueError("Type {} not supported. Valid options are 'diou' or None".format(iou_type))
+
+
+def batched_nms(
+    scores: torch.Tensor,
+    boxes: torch.Tensor,
+    classes: Optional[torch.Tensor],
+    iou_threshold: float,
+    max_detections: int,
+    score_threshold: Optional[float] = None,
+    iou_type: Optional[str] = None,
+    per_class: bool = False,
+    block_size: int = 512
+) -> List[torch.Tensor]:
+    """
+    Greedy non maximum suppression of all the images of a batch at once. The boxes are visited by
+    decreasing score in blocks: a block is first suppressed by the boxes kept in the previous blocks,
+    then the greedy suppression inside the block is solved with the fixed point iteration of Cluster-NMS,
+    which gives the same boxes as the sequential algorithm. It stops when every image has max_detections boxes.
+    Parameters:
+        scores (torch.Tensor): BXN scores of the boxes
+        boxes (torch.Tensor): BXNX4 boxes in (xmin, ymin, xmax, ymax)
+        classes (torch.Tensor): BXN classes of the boxes, or None
+        iou_threshold (float): boxes that overlap a kept box by more than this threshold are discarded
+        max_detections (int): maximum number of detections per image
+        score_threshold (float): if set, only the boxes with a score above this threshold are kept
+        iou_type (str): None for the IoU, or 'diou'
+        per_class (bool): if set, boxes only suppress boxes of their class
+        block_size (int): number of boxes suppressed at once
+    Returns:
+        List[torch.Tensor]: the indexes, scores, boxes and classes of the detections, padded to max_detections
+            with -1, 0, 0 and the int32 maximum, and the number of detections per image
+    """
+    batch_size, num_boxes = scores.shape
+    if classes is None:
+        classes = torch.zeros((batch_size, num_boxes), dtype=torch.long)
+
+    sorted_scores, order = torch.sort(scores, dim=1, descending=True, stable=True)
+    sorted_boxes = torch.gather(boxes, 1, order[..., None].expand(-1, -1, 4))
+    sorted_classes = torch.gather(classes, 1, order)
+    if score_threshold is not None:
+        valid = sorted_scores > score_threshold
+    else:
+        valid = torch.ones((batch_size, num_boxes), dtype=torch.bool)
+
+    # Positions in the sorted boxes of the detections
+    kept_positions = torch.full((batch_size, max_detections), -1, dtype=torch.long)
+    num_kept = torch.zeros(batch_size, dtype=torch.long)
+    batch_range = torch.arange(batch_size)
+    detection_range = torch.arange(max_detections)
+
+    for start in range(0, num_boxes, block_size):
+        candidates = valid[:, start:start + block_size] & (num_kept < max_detections)[:, None]
+        if not candidates.any():
+            # The valid boxes come first, so the remaining blocks are empty too
+            if not valid[:, start:].any() or (num_kept == max_detections).all():
+                break
+            continue
+        block_boxes = sorted_boxes[:, start:start + block_size]
+        block_classes = sorted_classes[:, start:start + block_size]
+
+        # Suppression by the boxes kept in the previous blocks
+        max_kept = int(num_kept.max())
+        if max_kept > 0:
+            previous_positions = kept_positions[:, :max_kept].clamp(min=0)
+            previous_boxes = sorted_boxes[batch_range[:, None], previous_positions]
+            overlap = pairwise_iou(block_boxes, previous_boxes, iou_type) > iou_threshold
+            overlap &= (detection_range[:max_kept] < num_kept[:, None])[:, None, :]
+            if per_class:
+                overlap &= block_classes[..., None] == sorted_classes[batch_range[:, None], previous_positions][:, None, :]
+            candidates &= ~overlap.any(2)
+
+        # Suppression inside the block, a box can only be suppressed by a kept box with a higher score
+        overlap = torch.triu(pairwise_iou(block_boxes, block_boxes, iou_type) > iou_threshold, diagonal=1)
+        if per_class:
+            overlap &= block_classes[..., None] == block_classes[:, None, :]
+        overlap &= candidates[..., None]
+        keep = candidates
+        while True:
+            new_keep = candidates & ~(overlap & keep[..., None]).any(1)
+            if torch.equal(new_keep, keep):
+                break
+            keep = new_keep
+
+        positions = num_kept[:, None] + keep.cumsum(1) - 1
+        keep &= positions < max_detections
+        batch_indices, block_indices = keep.nonzero(as_tuple=True)
+        kept_positions[batch_indices, positions[batch_indices, block_indices]] = start + block_indices
+        num_kept += keep.sum(1)
+
+    detected = kept_positions >= 0
+    gather_positions = kept_positions.clamp(min=0)
+    nms_indices = torch.where(detected, torch.gather(order, 1, gather_positions), kept_positions)
+    nms_scores = torch.gather(sorted_scores, 1, gather_positions) * detected
+    nms_boxes = torch.gather(sorted_boxes, 1, gather_positions[..., None].expand(-1, -1, 4)) * detected[..., None]
+    nms_classes = torch.where(detected, torch.gather(sorted_classes, 1, gather_positions).int(),
+                              torch.full_like(kept_positions, torch.iinfo(torch.int32).max, dtype=torch.int))
+
+    return [nms_indices, nms_scores, nms_boxes, nms_classes, num_kept.int()]
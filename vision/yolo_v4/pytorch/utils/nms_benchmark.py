@@ -0,0 +1,58 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+
+import time
+import argparse
+
+import torch
+from torchvision.ops.boxes import nms as torchvision_nms
+
+from utils.nms import batched_nms
+
+
+def per_image_nms(scores: torch.Tensor, boxes: torch.Tensor, iou_threshold: float, max_detections: int):
+    """
+    The previous host NMS, torchvision NMS called on each image of the batch
+    """
+    return [torchvision_nms(image_boxes, image_scores, iou_threshold)[:max_detections] for image_scores, image_boxes in zip(scores, boxes)]
+
+
+def random_predictions(batch_size: int, num_boxes: int, image_size: int, num_classes: int):
+    """
+    Returns random scores, boxes shifted by their class like in the NMS pre-processing, and classes
+    """
+    scores = torch.rand(batch_size, num_boxes)
+    centers = torch.rand(batch_size, num_boxes, 2) * image_size
+    sizes = torch.rand(batch_size, num_boxes, 2) * image_size / 4 + 1
+    classes = torch.randint(0, num_classes, (batch_size, num_boxes))
+    boxes = torch.cat([centers - sizes / 2, centers + sizes / 2], axis=-1) + 4096. * classes[..., None]
+    return scores, boxes, classes
+
+
+def benchmark(function, repeats: int) -> float:
+    """
+    Returns the mean time of the function in milliseconds
+    """
+    function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host benchmark of the batched and the per image NMS")
+    parser.add_argument('--batch-size', type=int, default=8, help='Number of images')
+    parser.add_argument('--num-boxes', type=int, nargs='+', default=[1000, 5000, 10000, 50000], help='Number of boxes per image')
+    parser.add_argument('--image-size', type=int, default=896, help='Size of the images')
+    parser.add_argument('--num-classes', type=int, default=80, help='Number of classes')
+    parser.add_argument('--iou-threshold', type=float, default=0.65, help='IoU threshold of the NMS')
+    parser.add_argument('--max-detections', type=int, default=300, help='Maximum number of detections per image')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of timed runs')
+
+    opt = parser.parse_args()
+    torch.manual_seed(0)
+    for num_boxes in opt.num_boxes:
+        scores, boxes, classes = random_predictions(opt.batch_size, num_boxes, opt.image_size, opt.num_classes)
+        per_image_time = benchmark(lambda: per_image_nms(scores, boxes, opt.iou_threshold, opt.max_detections), opt.repeats)
+        batched_time = benchmark(lambda: batched_nms(scores, boxes, classes, opt.iou_threshold, opt.max_detections), opt.repeats)
+        print("{} boxes: per image {:.1f} ms, batched {:.1f} ms".format(num_boxes, per_image_time, batched_time))
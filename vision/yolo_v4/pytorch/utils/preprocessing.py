@@ -1,7 +1,8 @@
 # Copyright (c) 2021 Graphcore Ltd. All rights reserved.
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
+import cv2
 import math
 import numpy as np
 import torch
@@ -10,7 +11,9 @@ from PIL import Image
 from utils.tools import ioa, normalize_labels, standardize_labels, xywh_to_xyxy, xyxy_to_xywh
 
 """
-Torch transformations for the YOLOv4 dataset
+Torch transformations for the YOLOv4 dataset.
+The transformations with the Numpy suffix are an alternative pipeline operating
+end-to-end on uint8 numpy arrays with OpenCV, see config.dataset.numpy_pipeline.
 """
 
 
@@ -268,6 +271,19 @@ class Mosaic(object):
 
         # base image of size self.image_size * 2 x self.image_size * 2
         base_img = np.full((self.image_size * 2, self.image_size * 2, self.input_channels), 114)
+        base_label = self.stitch(item, base_img)
+
+        return Image.fromarray(np.uint8(base_img)), base_label
+
+    def stitch(self, item: Tuple[Tuple[Image.Image, np.array]], base_img: np.array) -> np.array:
+        """
+        Copies the 4 images in their quadrant of base_img and returns their combined labels
+        Parameters:
+            item: 4 pairs of images and labels that will be stitched together
+            base_img: image of size self.image_size * 2 x self.image_size * 2 to copy the images in
+        Return:
+            labels: combined labels from the 4 images
+        """
         base_label = []
         # each grid in the base_img will be of size self.image_size x self.image_size
         center_x, center_y = self.image_size, self.image_size
@@ -309,8 +325,7 @@ class Mosaic(object):
             base_label = np.concatenate(base_label, 0)
         np.clip(base_label[:, 1:], 0, self.image_size, out=base_label[:, 1:])
 
-        return Image.fromarray(np.uint8(base_img)), base_label
-
+        return base_label
 
 
 class RandomPerspective(object):
@@ -348,10 +363,30 @@ class RandomPerspective(object):
         target_height = orig_height - self.border_to_remove[0]
         target_width = orig_width - self.border_to_remove[1]
 
+        combined_matrix, scale = self.get_matrix(orig_width, orig_height, target_width, target_height)
+        if (self.border_to_remove[0] != 0) or (self.border_to_remove[1] != 0) or (combined_matrix != np.eye(3)).any():  # check if image changed
+            combined_matrix_inv = np.linalg.inv(combined_matrix)
+            image = image.transform((target_width, target_height), Image.AFFINE, combined_matrix_inv.flatten()[:6], fillcolor=(114, 114, 114))
+
+        labels = self.transform_labels(labels, combined_matrix, scale, orig_width, orig_height, target_width, target_height)
+
+        return image, labels
+
+    def get_matrix(self, width: int, height: int, target_width: int, target_height: int) -> Tuple[np.array, float]:
+        """
+        Returns a random matrix combining the perspective, rotation, scale, shear and translation
+        from the pixel coordinates of the image to the ones of the target image
+        Parameters:
+            width, height: size of the image
+            target_width, target_height: size of the target image
+        Return:
+            combined_matrix: 3x3 transformation matrix
+            scale: scale of the transformation
+        """
         # Center
         center = np.eye(3)
-        center[0, 2] = -image.size[1] / 2  # x translation (pixels)
-        center[1, 2] = -image.size[0] / 2  # y translation (pixels)
+        center[0, 2] = -width / 2  # x translation (pixels)
+        center[1, 2] = -height / 2  # y translation (pixels)
 
         # Perspective
         perspective = np.eye(3)
@@ -380,17 +415,41 @@ class RandomPerspective(object):
 
         # Combined rotation matrix
         combined_matrix = translation @ shear @ rotation @ perspective @ center
-        if (self.border_to_remove[0] != 0) or (self.border_to_remove[1] != 0) or (combined_matrix != np.eye(3)).any():  # check if image changed
-            combined_matrix_inv = np.linalg.inv(combined_matrix)
-            image = image.transform((target_width, target_height), Image.AFFINE, combined_matrix_inv.flatten()[:6], fillcolor=(114, 114, 114))
+        return combined_matrix, scale
 
+    def transform_labels(
+        self,
+        labels: np.array,
+        combined_matrix: np.array,
+        scale: float,
+        width: int,
+        height: int,
+        target_width: int,
+        target_height: int,
+        input_matrix: Optional[np.array] = None
+    ) -> np.array:
+        """
+        Transforms the labels with combined_matrix and removes the boxes that became too small
+        Parameters:
+            labels: labels normalized to the image size
+            combined_matrix: 3x3 transformation matrix from get_matrix
+            scale: scale of the transformation
+            width, height: size of the image
+            target_width, target_height: size of the target image
+            input_matrix: optional 3x3 scale and translation matrix applied to the labels before combined_matrix
+        Return:
+            labels: labels of remaining objects normalized to the target image size
+        """
         if len(labels):
             n = len(labels)
 
             # Normalized xywh to pixel xywh format in order to manipulate the label
-            labels = standardize_labels(labels, orig_width, orig_height)
+            labels = standardize_labels(labels, width, height)
             # Convert to xyxy in order to perform transformation
             labels[:, 1:] = xywh_to_xyxy(labels[:, 1:])
+            if input_matrix is not None:
+                labels[:, [1, 3]] = labels[:, [1, 3]] * input_matrix[0, 0] + input_matrix[0, 2]
+                labels[:, [2, 4]] = labels[:, [2, 4]] * input_matrix[1, 1] + input_matrix[1, 2]
 
             xy = np.ones((n * 4, 3))
             xy[:, :2] = labels[:, [1, 2, 3, 4, 1, 4, 3, 2]].reshape(n * 4, 2)  # x1y1, x2y2, x1y2, x2y1
@@ -415,7 +474,7 @@ class RandomPerspective(object):
             labels[:, 1:] = xyxy_to_xywh(labels[:, 1:])
             labels = normalize_labels(labels, target_width, target_height)
 
-        return image, labels
+        return labels
 
     def box_candidates(
         self,
@@ -479,3 +538,229 @@ class VerticalFlip(object):
         output_image = image.transpose(Image.FLIP_TOP_BOTTOM)
         labels[:, 2] = 1 - labels[:, 2]
         return output_image, labels
+
+
+class ResizeImageNumpy(ResizeImage):
+    """
+    Returns a uint8 numpy image resized like ResizeImage, with OpenCV.
+    Call function:
+        Parameters:
+            item:
+                image: numpy image to resize
+                labels: labels doesn't perform any transformation
+        Return:
+            image: resized numpy image
+            labels: same labels
+    """
+    def get_size(self, width: int, height: int) -> Tuple[int, int]:
+        """
+        Returns the width and height of a width x height image after the resize
+        """
+        ratio_image_size = self.image_size / max(height, width)
+        if ratio_image_size != 1:
+            return int(width * ratio_image_size), int(height * ratio_image_size)
+        return width, height
+
+    def __call__(self, item: Tuple[np.array, np.array]) -> Tuple[np.array, np.array]:
+        image, labels = item
+
+        height, width = image.shape[0], image.shape[1]
+        resized_width, resized_height = self.get_size(width, height)
+        if (resized_width, resized_height) != (width, height):
+            # INTER_NEAREST_EXACT samples the same pixels as PIL's NEAREST
+            interp = cv2.INTER_LINEAR if resized_width > width else cv2.INTER_NEAREST_EXACT
+            return cv2.resize(image, (resized_width, resized_height), interpolation=interp), labels
+        else:
+            return image, labels
+
+
+class LetterboxNumpy(object):
+    """
+    Resizes the numpy image like ResizeImage and pads it to [self.image_size, self.image_size] like Pad,
+    writing the resized image directly in the padded image.
+    Call function:
+        Parameters:
+            item:
+                image: numpy image of any size
+                labels: labels to apply the transformation
+        Return:
+            image: image resized and padded to self.image_size
+            labels: label transformed to match the same bounding box position after the resize and the padding
+    """
+    def __init__(self, image_size: int):
+        self.image_size = image_size
+        self.resize_image = ResizeImageNumpy(image_size)
+
+    def get_padding(self, resized_width: int, resized_height: int) -> Tuple[int, int]:
+        pad_width = int(np.round(abs(self.image_size - resized_width) / 2))
+        pad_height = int(np.round(abs(self.image_size - resized_height) / 2))
+        return pad_width, pad_height
+
+    def get_matrix(self, width: int, height: int) -> np.array:
+        """
+        Returns the 3x3 scale and translation matrix of the resize and the padding of a width x height image
+        """
+        resized_width, resized_height = self.resize_image.get_size(width, height)
+        pad_width, pad_height = self.get_padding(resized_width, resized_height)
+        return np.array([[resized_width / width, 0., pad_width],
+                         [0., resized_height / height, pad_height],
+                         [0., 0., 1.]])
+
+    def __call__(self, item: Tuple[np.array, np.array]) -> Tuple[np.array, np.array]:
+        input_image, labels = item
+
+        input_image, _ = self.resize_image((input_image, None))
+        resized_height, resized_width = input_image.shape[0], input_image.shape[1]
+        pad_width, pad_height = self.get_padding(resized_width, resized_height)
+
+        output_image = np.full((self.image_size, self.image_size, input_image.shape[2]), 114, dtype=np.uint8)
+        output_image[pad_height:(resized_height + pad_height), pad_width:(resized_width + pad_width)] = input_image
+
+        labels[:, [1, 3]] *= resized_width/self.image_size
+        labels[:, [2, 4]] *= resized_height/self.image_size
+        labels[:, 1] += (pad_width)/self.image_size
+        labels[:, 2] += (pad_height)/self.image_size
+
+        return output_image, labels
+
+
+class HSVNumpy(HSV):
+    """
+    Apply HSV gains to the uint8 numpy RGB image with a single lookup table
+    Call function:
+        Parameters:
+            item:
+                image: numpy image to apply hsv
+                labels: labels remain unchanged
+        Return:
+            image: HSV enhanced image
+            labels: original labels
+    """
+    def __call__(self, item: Tuple[np.array, np.array]) -> Tuple[np.array, np.array]:
+        image, labels = item
+
+        r = np.random.uniform(-1, 1, 3) * [self.h_gain, self.s_gain, self.v_gain] + 1
+        img_hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+
+        # OpenCV hue of uint8 images is in [0, 180)
+        x = np.arange(0, 256)
+        lut = np.empty((1, 256, 3), dtype=np.uint8)
+        lut[0, :, 0] = (x * r[0]) % 180
+        lut[0, :, 1] = np.clip(x * r[1], 0, 255)
+        lut[0, :, 2] = np.clip(x * r[2], 0, 255)
+
+        cv2.LUT(img_hsv, lut, dst=img_hsv)
+        return cv2.cvtColor(img_hsv, cv2.COLOR_HSV2RGB), labels
+
+
+class MosaicNumpy(Mosaic):
+    """
+    Apply Mosaic on uint8 numpy images, copying the images directly in a preallocated uint8 image
+    Call function:
+        Parameters:
+            item:
+                4 pairs of numpy images and labels that will be stitched togeter. The first image
+                is the current image while the other 3 are randomly selected
+        Return:
+            image: combined target image with other 3 images
+            labels: combined labels from the target images with the other 3
+    """
+    def __call__(self, item: Tuple[Tuple[np.array, np.array]]) -> Tuple[np.array, np.array]:
+        base_img = np.full((self.image_size * 2, self.image_size * 2, item[0][0].shape[2]), 114, dtype=np.uint8)
+        base_label = self.stitch(item, base_img)
+
+        return base_img, base_label
+
+
+class RandomPerspectiveNumpy(RandomPerspective):
+    """
+    Apply the transformations of RandomPerspective on a uint8 numpy image with a single OpenCV warp.
+    If image_size is set, the image is first resized and padded to [image_size, image_size] like
+    ResizeImage and Pad, in the same warp.
+    Call function:
+        Parameters:
+            item:
+                image: numpy image to apply the transformation
+                labels: labels that will be transformed with the image
+        Return:
+            image: image after affine transform has been applied
+            labels: labels of remaining objects after the transformation
+    """
+
+    def __init__(self,
+                 degrees: int=10,
+                 translate: float=0.1,
+                 scale: float=0.1,
+                 shear: int=10,
+                 perspective: float=0.0,
+                 border_to_remove: Tuple[int, int]=(0, 0),
+                 image_size: Optional[int]=None
+                 ):
+        super().__init__(degrees, translate, scale, shear, perspective, border_to_remove)
+        self.letterbox = LetterboxNumpy(image_size) if image_size is not None else None
+
+    def __call__(self, item: Tuple[np.array, np.array]) -> Tuple[np.array, np.array]:
+        image, labels = item
+
+        orig_height, orig_width = image.shape[0], image.shape[1]
+        if self.letterbox is not None:
+            letterbox_matrix = self.letterbox.get_matrix(orig_width, orig_height)
+            input_width, input_height = self.letterbox.image_size, self.letterbox.image_size
+        else:
+            letterbox_matrix = None
+            input_width, input_height = orig_width, orig_height
+        target_height = input_height - self.border_to_remove[0]
+        target_width = input_width - self.border_to_remove[1]
+
+        combined_matrix, scale = self.get_matrix(input_width, input_height, target_width, target_height)
+        warp_matrix = combined_matrix if letterbox_matrix is None else combined_matrix @ letterbox_matrix
+        if (target_width, target_height) != (orig_width, orig_height) or (warp_matrix != np.eye(3)).any():  # check if image changed
+            # The matrix maps continuous coordinates, while OpenCV maps the pixel indices
+            half_pixel = np.eye(3)
+            half_pixel[:2, 2] = 0.5
+            pixel_matrix = np.linalg.inv(half_pixel) @ warp_matrix @ half_pixel
+            image = cv2.warpAffine(image, pixel_matrix[:2], (target_width, target_height),
+                                   flags=cv2.INTER_LINEAR, borderValue=(114, 114, 114))
+
+        labels = self.transform_labels(labels, combined_matrix, scale, orig_width, orig_height,
+                                       target_width, target_height, input_matrix=letterbox_matrix)
+
+        return image, labels
+
+
+class HorizontalFlipNumpy(object):
+    """
+    Flip the numpy image and labels horizontally
+    Call Function:
+        Parameters:
+            item:
+                image: numpy image to flip
+                labels: labels for the image
+        Return:
+            image: flipped image
+            labels: flipped labels
+    """
+    def __call__(self, item: Tuple[np.array, np.array]) -> Tuple[np.array, np.array]:
+        image, labels = item
+        output_image = cv2.flip(image, 1)
+        labels[:, 1] = 1 - labels[:, 1]
+        return output_image, labels
+
+
+class VerticalFlipNumpy(object):
+    """
+    Flip the numpy image and labels vertically
+    Call Function:
+        Parameters:
+            item:
+                image: numpy image to flip
+                labels: labels for the image
+        Return:
+            image: flipped image
+            labels: flipped labels
+    """
+    def __call__(self, item: Tuple[np.array, np.array]) -> Tuple[np.array, np.array]:
+        image, labels = item
+        output_image = cv2.flip(image, 0)
+        labels[:, 2] = 1 - labels[:, 2]
+        return output_image, labels
@@ -0,0 +1,96 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from utils.config import get_cfg_defaults
+from utils.dataset import Dataset
+
+
+def create_synthetic_dataset(path: str, cfg, num_images: int):
+    """
+    Writes random JPEG images of COCO sizes and random labels in the layout of the dataset
+    Parameters:
+        path: the folder to write the dataset in
+        cfg: the config, the dataset name, files and cache paths are set to the synthetic dataset
+        num_images: the number of images to write
+    """
+    rng = np.random.default_rng(0)
+    images_folder = os.path.join(path, cfg.dataset.name, "images")
+    labels_folder = os.path.join(path, cfg.dataset.name, "labels")
+    os.makedirs(images_folder)
+    os.makedirs(labels_folder)
+
+    images_path = []
+    for i in range(num_images):
+        width, height = rng.choice([640, 480, 427, 375, 333], size=2)
+        # Smooth random images so the JPEG decode cost is close to the one of natural images
+        image = rng.integers(0, 256, size=(height // 8, width // 8, 3), dtype=np.uint8)
+        image_path = os.path.join(images_folder, "%012d.jpg" % (i + 1))
+        Image.fromarray(image).resize((width, height), Image.BILINEAR).save(image_path, quality=90)
+        images_path.append(image_path)
+
+        num_boxes = rng.integers(1, 16)
+        boxes = np.concatenate([rng.integers(0, 80, size=(num_boxes, 1)),
+                                rng.uniform(0.3, 0.7, size=(num_boxes, 2)),
+                                rng.uniform(0.05, 0.4, size=(num_boxes, 2))], axis=1)
+        np.savetxt(os.path.join(labels_folder, "%012d.txt" % (i + 1)), boxes, fmt=["%d"] + ["%.6f"] * 4)
+
+    with open(os.path.join(path, cfg.dataset.name, "synthetic.txt"), "w") as images_file:
+        images_file.write("\n".join(images_path))
+    for dataset in [cfg.dataset.train, cfg.dataset.test]:
+        dataset.file = "synthetic.txt"
+        dataset.cache_path = os.path.join(path, "cache", "synthetic")
+
+
+def benchmark_dataset(dataset: Dataset, num_samples: int) -> float:
+    """
+    Returns the number of samples per second of the dataset in a single process,
+    the throughput of one dataloader worker
+    """
+    # Warm up the page cache and the image cache
+    for index in range(min(len(dataset), num_samples)):
+        dataset[index]
+
+    start = time.perf_counter()
+    for index in range(num_samples):
+        dataset[index % len(dataset)]
+    return num_samples / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host benchmark of the PIL and numpy pre-processing pipelines of the dataset")
+    parser.add_argument(
+        '--data', type=str, default=None, help='Dataset, a synthetic dataset is created if it is not set')
+    parser.add_argument(
+        '--config', type=str, default='configs/training-yolov4p5.yaml', help='Configuration of the model and the augmentations')
+    parser.add_argument(
+        '--mode', type=str, default='train', choices=['train', 'test'], help='Dataset mode to benchmark')
+    parser.add_argument(
+        '--num-images', type=int, default=128, help='Number of images of the synthetic dataset')
+    parser.add_argument(
+        '--num-samples', type=int, default=256, help='Number of samples to time for each pipeline')
+
+    opt = parser.parse_args()
+    cfg = get_cfg_defaults()
+    cfg.merge_from_file(opt.config)
+
+    with tempfile.TemporaryDirectory() as synthetic_data:
+        data = opt.data
+        if data is None:
+            create_synthetic_dataset(synthetic_data, cfg, opt.num_images)
+            data = synthetic_data + "/"
+
+        for numpy_pipeline in [False, True]:
+            cfg.dataset.numpy_pipeline = numpy_pipeline
+            random.seed(0)
+            np.random.seed(0)
+            dataset = Dataset(data, cfg, opt.mode)
+            throughput = benchmark_dataset(dataset, opt.num_samples)
+            print("{} pipeline: {:.1f} images/s per worker".format("Numpy" if numpy_pipeline else "PIL", throughput))
@@ -1,7 +1,11 @@
 # Copyright (c) 2021 Graphcore Ltd. All rights reserved.
 import argparse
 import collections
+import contextlib
+import copy
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import io
 import json
 import math
 import numpy as np
@@ -87,63 +91,78 @@ class StatRecorder:
             predictions (np.array): M X 85 array of predictions
             image_size (torch.Tensor): contains the original image size
         """
-        num_labels = len(labels)
-        target_cls = labels[:, 0].tolist() if num_labels else []
-        self.seen = self.seen + 1
-
-        # Handle case where we get no predictions
-        if predictions is None:
-            if num_labels:
-                self.eval_stats.append((torch.zeros(0, self.num_ious, dtype=torch.bool), torch.Tensor(), torch.Tensor(), target_cls))
-        else:
-            bboxes = xywh_to_xyxy(predictions[:, :4]).detach()
-            scores = predictions[:, 4].cpu().detach().numpy()
-            class_pred = predictions[:, 5].cpu().detach().numpy()
-
-            clip_coords(bboxes, image_size)
-
-            # save the predictions in json format for COCOeval [{"image_id":42,"category_id":18,"bbox":[258.15,41.29,348.26,243.78],"score":0.236}]
-            if run_coco_eval:
-                for i, bbox in enumerate(bboxes):
-                    width = bbox[2] - bbox[0]
-                    height = bbox[3] - bbox[1]
-                    self.bbox_summary.append({
-                        "image_id": int(image_id),
-                        "category_id": self.coco_91_class[int(class_pred[i])],
-                        "bbox": [bbox[0].item(), bbox[1].item(), width.item(), height.item()],
-                        "score": scores[i].item()
-                    })
-            # Assign all predictions as inccorect
-            correct = torch.zeros(predictions.shape[0], self.num_ious, dtype=torch.bool)
-
-            if num_labels:
-                detected = []
-                target_cls_tensor = labels[:, 0]
-
-                # target boxes
-                target_box = xywh_to_xyxy(labels[:, 1:])
-
-                # Per target class
-                for cls in torch.unique(target_cls_tensor):
-                    target_indx = (cls == target_cls_tensor).nonzero(as_tuple=False).view(-1)  # target indices
-                    pred_indx = (cls == predictions[:, 5]).nonzero(as_tuple=False).view(-1)  # prediction indices
-
-                    # Search for detections
-                    if pred_indx.shape[0]:
-                        # Prediction to target ious
-                        best_ious, best_indxs = iou(bboxes[pred_indx, :4], target_box[target_indx]).max(1)  # best ious, indices
-                        # Appended detections
-                        detected_set = set()
-                        for iou_indx in (best_ious > self.iou_values[0]).nonzero(as_tuple=False):
-                            detected_target = target_indx[best_indxs[iou_indx]]
-                            if detected_target.item() not in detected_set:
-                                detected_set.add(detected_target.item())
-                                detected.append(detected_target)
-                                correct[pred_indx[iou_indx]] = best_ious[iou_indx] > self.iou_values  # iou_thres is 1xn
-                                if len(detected) == num_labels:  # all targets already located in image
-                                    break
-
-            self.eval_stats.append((correct.cpu().detach().numpy(), scores, class_pred, target_cls))
+        self.record_eval_stats_batch([labels], [predictions], image_size[None], [image_id], run_coco_eval)
+
+    def record_eval_stats_batch(
+        self,
+        labels: List[torch.Tensor],
+        predictions: List[torch.Tensor],
+        image_sizes: torch.Tensor,
+        image_ids: List[str],
+        run_coco_eval: bool
+    ):
+        """
+        Records the statistics needed to compute the metrics of a batch of images. The labels and predictions
+        are padded to batch tensors, and matched for all the images, classes and IoU thresholds at once.
+        Parameters:
+            labels (List[torch.Tensor]): N X 5 labels of each image
+            predictions (List[torch.Tensor]): M X 6 predictions of each image, or None if it has no predictions
+            image_sizes (torch.Tensor): B X 2 original image sizes
+            image_ids (List[str]): ids of the images
+        """
+        batch_size = len(labels)
+        self.seen = self.seen + batch_size
+        num_labels = torch.tensor([len(label) for label in labels], dtype=torch.long)
+        num_preds = torch.tensor([0 if prediction is None else len(prediction) for prediction in predictions], dtype=torch.long)
+        max_labels = max(int(num_labels.max()), 1)
+        max_preds = max(int(num_preds.max()), 1)
+
+        padded_labels = torch.zeros(batch_size, max_labels, 5)
+        padded_preds = torch.zeros(batch_size, max_preds, 6)
+        for i, (label, prediction) in enumerate(zip(labels, predictions)):
+            padded_labels[i, :len(label)] = torch.as_tensor(label, dtype=torch.float32)
+            if prediction is not None:
+                padded_preds[i, :len(prediction)] = prediction[:, :6].detach().cpu().float()
+        valid_labels = torch.arange(max_labels) < num_labels[:, None]
+        valid_preds = torch.arange(max_preds) < num_preds[:, None]
+
+        # Clip the predicted boxes to the image sizes
+        bboxes = xywh_to_xyxy(padded_preds[..., :4])
+        bboxes = torch.min(bboxes.clamp(min=0), image_sizes[:, None, [0, 1, 0, 1]].to(bboxes.dtype))
+        scores = padded_preds[..., 4]
+        class_pred = padded_preds[..., 5]
+
+        # Each prediction is matched to the target of its class with the best IoU, and it is correct for the IoU
+        # thresholds below this IoU if it is the first prediction matched to this target above the lowest threshold
+        ious = iou(bboxes, xywh_to_xyxy(padded_labels[..., 1:]))
+        same_class = (class_pred[..., None] == padded_labels[:, None, :, 0]) & valid_preds[..., None] & valid_labels[:, None]
+        best_ious, best_indxs = torch.where(same_class, ious, torch.zeros(1)).max(2)
+        batch_indxs, pred_indxs = (best_ious > self.iou_values[0]).nonzero(as_tuple=True)
+        detected_targets = batch_indxs * max_labels + best_indxs[batch_indxs, pred_indxs]
+        _, first_detections = np.unique(detected_targets.numpy(), return_index=True)
+        batch_indxs, pred_indxs = batch_indxs[first_detections], pred_indxs[first_detections]
+        correct = torch.zeros(batch_size, max_preds, self.num_ious, dtype=torch.bool)
+        correct[batch_indxs, pred_indxs] = best_ious[batch_indxs, pred_indxs, None] > self.iou_values
+
+        self.eval_stats.append((correct[valid_preds].numpy(),
+                                scores[valid_preds].numpy(),
+                                class_pred[valid_preds].numpy(),
+                                padded_labels[..., 0][valid_labels].numpy()))
+
+        # save the predictions as rows of [image_id, x, y, width, height, score, category_id] for COCOeval
+        if run_coco_eval:
+            image_ids = torch.tensor([int(image_id) for image_id in image_ids], dtype=torch.float64)
+            bboxes = bboxes.double()
+            coco_91_class = torch.tensor(self.coco_91_class, dtype=torch.float64)
+            self.bbox_summary.append(torch.stack([
+                image_ids[:, None].expand(-1, max_preds),
+                bboxes[..., 0],
+                bboxes[..., 1],
+                bboxes[..., 2] - bboxes[..., 0],
+                bboxes[..., 3] - bboxes[..., 1],
+                scores.double(),
+                coco_91_class[class_pred.long()]
+            ], dim=-1)[valid_preds].numpy())
 
     def compute_and_print_eval_metrics(self, output_function):
         """
@@ -173,16 +192,20 @@ class StatRecorder:
         return self.seen, nt.sum(), mean_precision, mean_recall, m_ap50, m_ap
 
     def write_and_eval_coco(self):
+        # COCO json format [{"image_id":42,"category_id":18,"bbox":[258.15,41.29,348.26,243.78],"score":0.236}]
+        detections = np.concatenate(self.bbox_summary) if len(self.bbox_summary) else np.zeros((0, 7))
+        bbox_summary = [{
+            "image_id": int(image_id),
+            "category_id": int(category_id),
+            "bbox": [x, y, width, height],
+            "score": score
+        } for image_id, x, y, width, height, score, category_id in detections.tolist()]
         temp_pred_file = "temp_detections_{}.json".format(datetime.now().strftime("%Y%m%d_%H%M%S.%f")[:-4])
         with open(temp_pred_file, "w") as f:
-            json.dump(self.bbox_summary, f)
+            json.dump(bbox_summary, f)
         annotation_file = self.data_path + '/' + self.cfg.dataset.name + '/annotations/' + self.cfg.dataset.test.annotation
         try:
-            ground_truth = COCO(annotation_file)
-            predictions = ground_truth.loadRes(temp_pred_file)
-            coco_eval = COCOeval(ground_truth, predictions, iouType='bbox')
-            coco_eval.evaluate()
-            coco_eval.accumulate()
+            coco_eval = evaluate_coco(annotation_file, temp_pred_file, self.cfg.eval.coco_workers)
             coco_eval.summarize()
         except Exception as e:
             print("pycocotools failed with: ", e)
@@ -294,6 +317,60 @@ class StatRecorder:
                 self.write_and_eval_coco()
 
 
+def evaluate_coco(annotation_file: str, predictions_file: str, num_workers: int = 1) -> COCOeval:
+    """
+    Evaluates and accumulates the COCO bbox metrics of the predictions. With several workers,
+    shards of the images are evaluated in parallel processes and accumulated together.
+    Parameters:
+        annotation_file (str): COCO annotations of the dataset
+        predictions_file (str): COCO json file of the predictions
+        num_workers (int): number of processes evaluating the images
+    Returns:
+        COCOeval: the accumulated evaluation, ready to summarize
+    """
+    ground_truth = COCO(annotation_file)
+    coco_eval = COCOeval(ground_truth, ground_truth.loadRes(predictions_file), iouType='bbox')
+    if num_workers <= 1:
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        return coco_eval
+
+    coco_eval.params.imgIds = sorted(np.unique(coco_eval.params.imgIds))
+    coco_eval.params.catIds = sorted(np.unique(coco_eval.params.catIds))
+    image_ids = coco_eval.params.imgIds
+    shards = [image_ids[i::num_workers] for i in range(num_workers)]
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_coco_worker,
+                             initargs=(annotation_file, predictions_file)) as executor:
+        shards_eval_images = list(executor.map(evaluate_coco_shard, shards))
+
+    # COCOeval.evalImgs is ordered by category, area range and image
+    shard_positions = {image_id: (shard, position) for shard, shard_image_ids in enumerate(shards)
+                       for position, image_id in enumerate(shard_image_ids)}
+    num_areas = len(coco_eval.params.areaRng)
+    coco_eval.evalImgs = []
+    for category_area in range(len(coco_eval.params.catIds) * num_areas):
+        for image_id in image_ids:
+            shard, position = shard_positions[image_id]
+            coco_eval.evalImgs.append(shards_eval_images[shard][category_area * len(shards[shard]) + position])
+    coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
+    coco_eval.accumulate()
+    return coco_eval
+
+
+def init_coco_worker(annotation_file: str, predictions_file: str):
+    global _worker_coco_eval
+    with contextlib.redirect_stdout(io.StringIO()):
+        ground_truth = COCO(annotation_file)
+        _worker_coco_eval = COCOeval(ground_truth, ground_truth.loadRes(predictions_file), iouType='bbox')
+
+
+def evaluate_coco_shard(image_ids: List[int]) -> List[dict]:
+    _worker_coco_eval.params.imgIds = image_ids
+    with contextlib.redirect_stdout(io.StringIO()):
+        _worker_coco_eval.evaluate()
+    return _worker_coco_eval.evalImgs
+
+
 class AutoAnchors:
     """
     Class to calculate the best set of anchors for a dataset with a given image size
@@ -307,21 +384,27 @@ class AutoAnchors:
                                     torch.stack((torch.tensor(cfg.anchors.p5width, requires_grad=False), torch.tensor(cfg.anchors.p5height, requires_grad=False)), dim=1))).view(3 * 4, 2)
         self.n_anchors = self.anchors.shape[0]
         self.n_generations = gen
+        self.population_size = cfg.anchors_population
+        self.max_labels = cfg.anchors_max_labels
+        self.patience = cfg.anchors_patience
+        self.min_improvement = cfg.anchors_min_improvement
+        # Maximum number of label and anchor ratios computed at once when evaluating a population
+        self.max_ratios = 2 ** 20
 
     def best_ratio_metric(self, k_points: Union[torch.Tensor, np.array], width_height: torch.Tensor):
         """
         Computes the best match and ratio of k points with a given width and height
         Parameters:
-            k_points (Union[torch.Tensor, np.array]): k points, in this case anchors
+            k_points (Union[torch.Tensor, np.array]): k points, in this case anchors, or a population of PXKX2 k points
             width_height (torch.Tensor): a width and height to compare to
         Returns:
             best_ratio_in_dim (torch.Tensor): best ratio for each anchor per label
             best (torch.Tensor): best anchor ratio for each label
         """
-        k_points = torch.tensor(k_points).float()
-        ratio = width_height[:, None] / k_points[None]
-        best_ratio_in_dim = torch.min(ratio, 1. / ratio).min(2)[0]
-        best = best_ratio_in_dim.max(1)[0]
+        k_points = torch.as_tensor(k_points).float()
+        ratio = width_height[:, None] / k_points[..., None, :, :]
+        best_ratio_in_dim = torch.min(ratio, 1. / ratio).min(-1)[0]
+        best = best_ratio_in_dim.max(-1)[0]
         return best_ratio_in_dim, best
 
     def metric(self, k_points: np.array, width_height: torch.Tensor):  # compute metric
@@ -352,6 +435,28 @@ class AutoAnchors:
         _, best = self.best_ratio_metric(k_points, width_height)
         return (best * (best > (1. / self.anchor_threshold)).float()).mean()
 
+    def population_fitness(self, population: np.array, width_height: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the fitness of each set of k points of a population. The best ratio of a label and
+        an anchor is computed as exp(-max(|log(ratio)|)), which is the same as the ratio of
+        best_ratio_metric without the divisions, and the population is split in chunks that fit in cache
+        Parameters:
+            population (np.array): PXKX2 sets of k points
+            width_height (torch.Tensor): a width and height to compare to
+        Returns:
+            fitness of each set of k points
+        """
+        log_population = torch.as_tensor(population).float().log()
+        log_width_height = width_height.log()
+        chunk_size = max(1, self.max_ratios // (log_population.shape[1] * width_height.shape[0]))
+        fitness_values = []
+        for log_k_points in log_population.split(chunk_size):
+            distance = (log_width_height[None, :, None, 0] - log_k_points[:, None, :, 0]).abs_()
+            torch.maximum(distance, (log_width_height[None, :, None, 1] - log_k_points[:, None, :, 1]).abs_(), out=distance)
+            best = distance.amin(-1).neg_().exp_()
+            fitness_values.append((best * (best > (1. / self.anchor_threshold)).float()).mean(-1))
+        return torch.cat(fitness_values)
+
     def mutate(self, population: np.array, mutation_prob: float = 0.9, sigma: float = 0.1):
         """
         Computes a new population scaling the original population randomly
@@ -366,6 +471,27 @@ class AutoAnchors:
             population = ((np.random.random(population.shape) < mutation_prob) * np.random.random() * np.random.randn(*population.shape) * sigma + 1).clip(0.3, 3.0)
         return population
 
+    def mutate_population(self, population_size: int, shape: Tuple[int, ...], mutation_prob: float = 0.9, sigma: float = 0.1):
+        """
+        Computes the scaling of a population of mutations at once, each mutation is drawn like in mutate
+        Parameters:
+            population_size (int): number of mutations
+            shape (Tuple[int, ...]): shape of each mutation
+            mutation_prob (float): probability of mutation of the population
+            sigma (float): the step of the change in the mutation
+        Returns:
+            the population of mutations
+        """
+        population = np.ones((population_size,) + shape)
+        unchanged = np.ones(population_size, dtype=bool)
+        while unchanged.any():
+            n_unchanged = unchanged.sum()
+            population[unchanged] = ((np.random.random((n_unchanged,) + shape) < mutation_prob) *
+                                     np.random.random((n_unchanged,) + (1,) * len(shape)) *
+                                     np.random.randn(n_unchanged, *shape) * sigma + 1).clip(0.3, 3.0)
+            unchanged = (population == 1).reshape(population_size, -1).all(1)
+        return population
+
     def kmean_anchors(self, labels_wh: np.array):
         """
         Computes a new set of anchors using k-means and evolving mutation to find the best fit
@@ -387,22 +513,34 @@ class AutoAnchors:
         sigma = labels_wh_filtered.std(0)
         k_points, dist = kmeans(labels_wh_filtered / sigma, self.n_anchors, iter=30)
         k_points *= sigma
+        if self.max_labels and len(labels_wh_filtered) > self.max_labels:
+            labels_wh_filtered = labels_wh_filtered[np.random.choice(len(labels_wh_filtered), self.max_labels, replace=False)]
         labels_wh_filtered = torch.tensor(labels_wh_filtered, dtype=torch.float32)
         k_points = k_points[np.argsort(k_points.prod(1))]
 
-        # Evolve
+        # Evolve a population of mutations of the best k points in each generation
         fitness_value = self.fitness(k_points, labels_wh_filtered)
-        population_size = k_points.shape
+        plateau_fitness_value = fitness_value
+        generations_without_improvement = 0
 
         pbar = tqdm(range(self.n_generations), desc='Evlolving anchors with Genetic Algorithm')
         for _ in pbar:
-            new_population = self.mutate(np.ones(population_size))
-            possible_new_kpoints = (k_points.copy() * new_population).clip(min=2.0)
-            new_fitness_value = self.fitness(possible_new_kpoints, labels_wh_filtered)
-            if new_fitness_value > fitness_value:
-                fitness_value, k_points = new_fitness_value, possible_new_kpoints.copy()
+            new_population = self.mutate_population(self.population_size, k_points.shape)
+            possible_new_kpoints = (k_points * new_population).clip(min=2.0)
+            new_fitness_values = self.population_fitness(possible_new_kpoints, labels_wh_filtered)
+            best_fitness_value, best_index = new_fitness_values.max(0)
+            if best_fitness_value > fitness_value:
+                fitness_value, k_points = best_fitness_value, possible_new_kpoints[int(best_index)].copy()
                 pbar.desc = "Evolving anchors with Genetic Algorithm, fitness: {:.3f}".format(fitness_value)
 
+            if fitness_value > plateau_fitness_value + self.min_improvement:
+                plateau_fitness_value = fitness_value
+                generations_without_improvement = 0
+            else:
+                generations_without_improvement += 1
+                if self.patience and generations_without_improvement >= self.patience:
+                    break
+
         return k_points[np.argsort(k_points.prod(1))]
 
     def __call__(self) -> List[AnchorBoxes]:
@@ -518,11 +656,11 @@ def area(boxes: Union[np.array, torch.Tensor]) -> Union[np.array, torch.Tensor]:
     """
     Find the areas of the given boxes in xmin, ymin, xmax, ymax
     Parameters:
-        boxes (np.array): NX4 array of boxes
+        boxes (np.array): NX4 array of boxes, or a batch of them
     Returns:
         A NX1 array of box areas
     """
-    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
 
 
 def ioa(boxes1: np.array, boxes2: np.array) -> np.array:
@@ -547,17 +685,18 @@ def iou(boxes1: torch.Tensor, boxes2: torch.Tensor):
     Return intersection-over-union of boxes.
     Both sets of boxes are expected to be in (xmin, ymin, xmax, ymax) format
     Arguments:
-        boxes1 (torch.Tensor): a NX4 tensor of boxes
-        boxes2 (torch.Tensor): a MX4 tensor of boxes
+        boxes1 (torch.Tensor): a NX4 tensor of boxes, or a BXNX4 batch of them
+        boxes2 (torch.Tensor): a MX4 tensor of boxes, or a BXMX4 batch of them
     Returns:
-        torch.Tensor: the NxM matrix containing the pairwise
+        torch.Tensor: the NxM (or BxNxM) matrix containing the pairwise
             IoU values for every element in boxes1 and boxes2
     """
     area1 = area(boxes1)
     area2 = area(boxes2)
 
-    inter = (torch.min(boxes1[:, None, 2:], boxes2[:, 2:]) - torch.max(boxes1[:, None, :2], boxes2[:, :2])).clamp(0).prod(2)
-    union = area1[:, None] + torch.finfo(torch.float32).eps + area2 - inter
+    inter = (torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:]) -
+             torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])).clamp(0).prod(-1)
+    union = area1[..., :, None] + torch.finfo(torch.float32).eps + area2[..., None, :] - inter
     return inter / union
 
 